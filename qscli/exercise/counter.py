@@ -1,5 +1,5 @@
-from qscli.ipc import CliClient
+from qscli.ipc import CliClient, socket_path
 
 class Counter(CliClient):
     def __init__(self):
-        CliClient.__init__(self, ['qscount', 'daemon'])
+        CliClient.__init__(self, ['qscount', 'daemon'], socket_path=socket_path('qscount'))
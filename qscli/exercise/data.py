@@ -30,9 +30,9 @@ class Data(object):
     @staticmethod
     def get_rep_exercises(days_ago=None):
         if days_ago is not None:
-            counters = COUNTER.get().run(['list', '--days-ago', str(days_ago)]).splitlines()
+            counters = COUNTER.get().call('list', days_ago=days_ago)
         else:
-            counters = COUNTER.get().run(['list']).splitlines()
+            counters = COUNTER.get().call('list')
 
         exercises = [x.split('.', 1)[1]
             for x in counters if x.startswith('exercise.')]
@@ -208,11 +208,7 @@ class Data(object):
 
     @staticmethod
     def get_exercise_counts(days_ago):
-        data = json.loads(COUNTER.get().run([
-            'summary',
-            '--days-ago',
-            str(days_ago),
-            '--json']))
+        data = COUNTER.get().call('summary', days_ago=days_ago)
 
         return [
             dict_replace(x, name=x['name'].split('.', 1)[1]) for x in data['counts'] if x['name'].startswith('exercise.')]
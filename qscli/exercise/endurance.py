@@ -85,8 +85,9 @@ def endurance_stats():
         data = json.loads(watch.run(['show', 'exercise-endurance', '--json']))
 
     duration = data['duration']
-    SCORER.get().run(['update', 'exercise.endurance.{}'.format(exercise), str(duration)])
-    summary = SCORER.get().run(['summary', 'exercise.endurance.{}'.format(exercise)])
+    _, summary = SCORER.get().run_many([
+        ['update', 'exercise.endurance.{}'.format(exercise), str(duration)],
+        ['summary', 'exercise.endurance.{}'.format(exercise)]])
     print exercise
     print summary.encode('utf8')
 
@@ -115,14 +116,17 @@ def stop_endurance_exercise():
     exercise = Data.get_endurance_exercise()
 
     with Watch() as watch:
-        watch.run(['stop', 'exercise-endurance'])
-        data = json.loads(watch.run(['show', 'exercise-endurance', '--json']))
+        _, data = watch.run_many([
+            ['stop', 'exercise-endurance'],
+            ['show', 'exercise-endurance', '--json']])
+        data = json.loads(data)
 
     duration = data['duration']
 
     print 'Finished'
-    SCORER.get().run(['update', 'exercise.endurance.{}'.format(exercise), str(duration)])
-    summary = SCORER.get().run(['summary', 'exercise.endurance.{}'.format(exercise)])
+    _, summary = SCORER.get().run_many([
+        ['update', 'exercise.endurance.{}'.format(exercise), str(duration)],
+        ['summary', 'exercise.endurance.{}'.format(exercise)]])
     print exercise
     print summary
 
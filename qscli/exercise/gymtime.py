@@ -40,8 +40,9 @@ def arrive():
 
 def leave():
     time_at_gym = json.loads(WATCH.get().run(['show', 'exercise.gymtime', '--json']))['duration']
-    update()
-    summary = SCORER.get().run(['summary', 'exercise.score.gymtime'])
+    _, summary = SCORER.get().run_many([
+        ['update', 'exercise.score.gymtime', str(time_at_gym)],
+        ['summary', 'exercise.score.gymtime']])
     hours_at_gym = time_at_gym // 3600
     seconds_at_gym = time_at_gym % 3600
 
@@ -101,8 +101,10 @@ def record_rep():
     print 'Points: {} (vs {})'.format(points.total, versus_points.total)
 
     print 'Count:', exercise_name
-    COUNTER.get().run(['incr', exercise_name])
-    events = json.loads(COUNTER.get().run(['log', '--set', 'CURRENT', '--json', exercise_name]))
+    _, events, count = COUNTER.get().call_many([
+        ('incr', dict(counter=exercise_name)),
+        ('log', dict(set='CURRENT', counter=exercise_name)),
+        ('count', dict(set='CURRENT', counter=exercise_name))])
 
     if events:
         start = events['events'][0]['time']
@@ -112,13 +114,14 @@ def record_rep():
         duration = 0
 
     print 'Duration: {:.0f}'.format(duration)
-    count = COUNTER.get().run(['count', '--set', 'CURRENT', exercise_name])
-    count = int(count.strip())
+    count = int(count)
     rate = count / duration if (count and duration) else 0
 
     print 'Rate: {:.2f}'.format(rate)
-    SCORER.get().run(['update', exercise_score, str(count)])
-    print SCORER.get().run(['summary', exercise_score, '--update']).encode('utf8')
+    _, summary = SCORER.get().run_many([
+        ['update', exercise_score, str(count)],
+        ['summary', exercise_score, '--update']])
+    print summary.encode('utf8')
 
 def calculate_points(days_ago):
     by_exercise_scores = Data.get_exercise_scores()
@@ -154,13 +157,12 @@ def versus(days_ago):
     if today_points.unscored_exercises:
         print 'Unscored activities', ' '.join(sorted(set(today_points.unscored_exercises) | set(old_points.unscored_exercises)))
 
-    results = json.loads(COUNTER.get().run([
+    results = COUNTER.get().call(
         'compare',
-        '{} days ago'.format(days_ago), '+1d',
-        'today', '+1d',
-        '--regex', '^exercise\\.',
-        '--sort', 'shortfall',
-        '--json']))
+        start1='{} days ago'.format(days_ago), end1='+1d',
+        start2='today', end2='+1d',
+        regex='^exercise\\.',
+        sort='shortfall')
 
     results = [result for result in results if result[0] not in to_ignore]
     print '\n'.join(['{} {} {}'.format(*r) for r in results])
@@ -1,5 +1,5 @@
-from qscli.ipc import CliClient
+from qscli.ipc import CliClient, socket_path
 
 class Scorer(CliClient):
     def __init__(self):
-        CliClient.__init__(self, ['qsscore', 'daemon'])
+        CliClient.__init__(self, ['qsscore', 'daemon'], socket_path=socket_path('qsscore'))
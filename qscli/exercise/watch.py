@@ -1,5 +1,5 @@
-from qscli.ipc import CliClient
+from qscli.ipc import CliClient, socket_path
 
 class Watch(CliClient):
     def __init__(self):
-        CliClient.__init__(self, ['qswatch', 'daemon'])
+        CliClient.__init__(self, ['qswatch', 'daemon'], socket_path=socket_path('qswatch'))
@@ -1,60 +1,841 @@
 """
 Protocol for communicating with a persistent
-server process over standard io
+server process over standard io or a unix socket
 
 Commands are sent as space separated words (with backslash escaping)
 (as for sh)
 
+Each command gets exactly one json reply line. Clients may pipeline
+several commands at once (see `CliClient.run_many`): replies come
+back in the same order as the commands were sent, unless commands
+are prefixed with a request id (@ID), in which case the reply
+contains this id and replies may come back in any order.
+
+Commands with a request id can instead be prefixed with + (@ID +COMMAND)
+to have their output streamed as it is produced (see `CliClient.stream`):
+the server sends {chunk:, id:} lines followed by a final reply with
+end set. `__cancel__ ID` stops a stream early.
+
+Requests can also be typed json of the form {method:, params:, id:} (see
+`CliClient.call`). The method is a subcommand and params are its arguments,
+so no tokenizing or argument parsing is needed. The reply has the form
+{return_code:, result:, error:, id:}, where the result is whatever the
+server's method for this subcommand returns (see `run_server`).
+
+A server listening on a unix socket (see `socket_path`) can be shared
+between many clients. Clients start the server if it is not running,
+and the server exits once it has had no clients for a while.
+
 """
 
 
+import argparse
+import collections
+import contextlib
+import errno
+import hashlib
 import json
+import os
+import Queue
+import select
+import socket
+import stat
 import sys
+import threading
+import time
 import traceback
 import logging
 import subprocess
 
+import fasteners
+
+from . import latency
+
 LOGGER = logging.getLogger('ipc')
 
-def run_server(parser, run_function, debug=True):
+DEFAULT_IDLE_TIMEOUT = 300
+
+DEFAULT_WORKERS = 4
+
+# Seconds without commands before running a server's idle function
+IDLE_DELAY = 1.0
+
+# Built in request returning timings for the commands that the server has run
+STATS_COMMAND = '__stats__'
+
+# Built in request stopping the stream with a given request id
+CANCEL_COMMAND = '__cancel__'
+
+# Requests starting with @ID get replies with this id, which can be sent out of order
+REQUEST_ID_PREFIX = '@'
+
+# Commands (after a request id) starting with this have their output streamed
+STREAM_PREFIX = '+'
+
+# The number of chunks of a stream that can be waiting to be sent before its command is made to wait
+STREAM_BUFFER = 16
+
+# How timings are named for commands without a name
+UNPARSED = '<unparsed>'
+UNNAMED = '<unnamed>'
+
+def socket_path(name, key=None):
+    "The per-user socket on which the daemon for `name` (and `key` e.g. a data directory) listens"
+    if key is not None:
+        name = '{}-{}'.format(name, hashlib.md5(os.path.abspath(key)).hexdigest()[:12])
+
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        directory = os.path.join(runtime_dir, 'qscli')
+    else:
+        directory = os.path.join('/tmp', 'qscli-{}'.format(os.getuid()))
+
+    return os.path.join(directory, name + '.sock')
+
+def add_daemon_arguments(parser):
+    parser.add_argument('--socket', type=str, help='Listen on this unix socket rather than standard in and out')
+    parser.add_argument('--idle-timeout', type=float, help='When listening on a socket, exit after having no clients for this many seconds')
+    parser.add_argument('--stats-file', type=str, help='Write timings for each command to this file when exiting')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Number of threads with which to run read-only commands concurrently')
+
+def read_only_commands(*names):
+    "A `read_only` function for `run_server` for when subcommands never change anything"
+    return lambda options: options.command in names
+
+def run_server(parser, run_function, debug=True, socket_path=None, idle_timeout=None, stats_file=None, read_only=None, workers=DEFAULT_WORKERS, methods=None, idle_function=None):
     """Start a server, and handle requests. `parser` is an `argparse` parse, `run_function` is a function
     that takes the options returned by this parser and returns a string - often json.
+
+    Requests are read from standard in unless `socket_path` is given.
+    Timings for each phase of each command can be read with the `__stats__` request.
+
+    Commands run on worker threads rather than the thread reading requests. If `read_only` is given
+    then there are `workers` of these threads. Commands for which `read_only(options)` is true
+    run concurrently, while other commands run one at a time and never alongside a read-only command.
+    `run_function` must then be thread safe for read-only commands. The chunks of streamed commands
+    are produced without waiting for other commands, so generators must be safe to advance alongside them.
+
+    `methods` maps subcommands to functions which, like `run_function`, take options
+    but return json-serializable data. Typed requests for these subcommands reply with
+    this data; typed requests for other subcommands reply with the output of `run_function`.
+
+    `idle_function` is called when no commands have been running for `IDLE_DELAY` seconds,
+    and again straight away while it returns true (and no commands arrive). It should do
+    a little work at a time, since commands wait for it.
     """
 
     if debug:
         print >>sys.stderr, 'Running'
 
-    while True:
-        command_string = sys.stdin.readline()
-        if command_string == '':
-            break
+    if socket_path is None:
+        listener = None
+        connections = [Connection(sys.stdin.fileno(), sys.stdout.fileno())]
+    else:
+        listener = listen(socket_path)
+        if listener is None:
+            LOGGER.debug('Server already listening on %r', socket_path)
+            return
+        connections = []
+
+    # Stray prints from commands must not end up in the middle of the replies
+    sys.stdout = sys.stderr
+
+    pool = WorkerPool(workers if read_only is not None else 1)
+    server = Server(parser, run_function, debug, read_only, pool, methods, idle_function)
+    try:
+        server.serve(listener, connections, socket_path, idle_timeout)
+    finally:
+        if stats_file is not None:
+            server.stats.write(stats_file)
+
+class Server(object):
+    """Run commands read from connections.
+
+    Commands from one connection see the effects of the commands sent before them:
+    read-only commands wait for earlier commands that change things to finish, and these
+    commands wait for all earlier commands to finish."""
+    def __init__(self, parser, run_function, debug, read_only=None, pool=None, methods=None, idle_function=None):
+        self._parser = parser
+        self._idle_function = idle_function
+        self._idle_work = idle_function is not None
+        self._run_function = run_function
+        self._methods = methods or {}
+        self._method_arguments = {}
+        self._debug = debug
+        self._read_only = read_only or (lambda options: False)
+        self._pool = pool or WorkerPool(1)
+        self._streamer = Streamer()
+        self._lock = ReadWriteLock()
+        self.stats = latency.LatencyStats()
+
+    def serve(self, listener, connections, path, idle_timeout):
+        last_active = time.time()
+        try:
+            while connections or listener is not None:
+                if connections or idle_timeout is None:
+                    timeout = None
+                else:
+                    timeout = last_active + idle_timeout - time.time()
+                    if timeout <= 0:
+                        LOGGER.debug('Idle for %r seconds. Exiting', idle_timeout)
+                        for sock in stop_listening(listener, path):
+                            connections.append(Connection(sock.fileno(), sock.fileno(), sock))
+                        listener = None
+                        continue
+
+                busy = any(stream.requests or stream.executing_reads or stream.executing_writes for stream in connections)
+                if self._idle_work and not busy:
+                    idle_wait = max(last_active + IDLE_DELAY - time.time(), 0)
+                    timeout = idle_wait if timeout is None else min(timeout, idle_wait)
+
+                streams = [stream for stream in connections if not stream.finished_reading()]
+                streams += [listener] if listener is not None else []
+                streams.append(self._pool)
+                streams.append(self._streamer)
+                readable = _select(streams, timeout)
+                if readable:
+                    last_active = time.time()
+                    self._idle_work = self._idle_function is not None
+                elif self._idle_work and not busy and time.time() >= last_active + IDLE_DELAY:
+                    self._run_idle_function()
+
+                for stream in readable:
+                    if stream is listener:
+                        sock, _ = listener.accept()
+                        connections.append(Connection(sock.fileno(), sock.fileno(), sock))
+                    elif stream is self._pool:
+                        self._complete_requests()
+                    elif stream is self._streamer:
+                        self._send_chunks()
+                    else:
+                        self._read_requests(stream)
+
+                for stream in connections[:]:
+                    if stream.finished():
+                        connections.remove(stream)
+                        stream.close()
+        finally:
+            if listener is not None:
+                stop_listening(listener, path)
+
+    def _run_idle_function(self):
+        try:
+            self._idle_work = bool(self._idle_function())
+        except Exception:
+            LOGGER.exception('Error in idle function')
+            self._idle_work = False
+
+    def _read_requests(self, stream):
+        stream.receive()
+        while True:
+            line = stream.buffered_line()
+            if line is None:
+                break
+
+            if line.startswith('{'):
+                self._read_typed_request(stream, line)
+                continue
+
+            try:
+                request_id, command_string = _split_request_id(line.strip('\n'))
+            except ValueError:
+                request = Request(stream.expect_reply(in_order=True), None)
+                request.set_reply(return_code=1, output='', error=traceback.format_exc())
+                stream.requests.append(request)
+                continue
+
+            request = Request(stream.expect_reply(in_order=request_id is None), request_id)
+            self._parse(stream, request, command_string)
+            stream.requests.append(request)
+
+        self._start_requests(stream)
+
+    def _start_requests(self, stream):
+        "Start whichever queued requests can run, then send any replies"
+        while stream.requests:
+            request = stream.requests[0]
+            if request.reply is None:
+                if stream.executing_writes or (not request.read_only and stream.executing_reads):
+                    break
+
+            stream.requests.popleft()
+            if request.reply is not None:
+                self._finish(stream, request)
+            else:
+                if request.read_only:
+                    stream.executing_reads += 1
+                else:
+                    stream.executing_writes += 1
+
+                if request.streamed:
+                    stream.streams[request.request_id] = request
+                    self._streamer.start(self._execute_streamed(request), request, stream)
+                else:
+                    self._pool.submit(self._execute, request, stream)
 
-        if debug:
+        # Replies to a pipelined batch are written together
+        write_timer = latency.PhaseTimer()
+        stream.flush()
+        write_timer.lap('write')
+
+        for request in stream.unflushed:
+            self.stats.record_phases(request.name, write_timer.phases)
+            self.stats.record(request.name, 'total', request.timer.total() + write_timer.total())
+        stream.unflushed = []
+
+    def _complete_requests(self):
+        "Send the replies for requests finished by the worker pool"
+        streams = set()
+        for request, stream in self._pool.completed():
+            self._finish_executing(stream, request)
+            streams.add(stream)
+
+        for stream in streams:
+            self._start_requests(stream)
+
+    def _send_chunks(self):
+        "Send the chunks of output produced by streamed requests"
+        streams = set()
+        finished_streams = set()
+        spaces = []
+        for request, stream, chunk, space in self._streamer.ready():
+            if chunk is None:
+                del stream.streams[request.request_id]
+                self._finish_executing(stream, request)
+                finished_streams.add(stream)
+            else:
+                stream.write(chunk)
+                spaces.append(space)
+                streams.add(stream)
+
+        for stream in streams:
+            stream.flush()
+            if stream.broken:
+                for request in stream.streams.values():
+                    request.cancelled = True
+
+        # Only once a chunk has been sent is there space for another one
+        for space in spaces:
+            space.release()
+
+        for stream in finished_streams:
+            self._start_requests(stream)
+
+    def _finish_executing(self, stream, request):
+        if request.read_only:
+            stream.executing_reads -= 1
+        else:
+            stream.executing_writes -= 1
+        self._finish(stream, request)
+
+    def _finish(self, stream, request):
+        self.stats.record_phases(request.name, request.timer.phases)
+        stream.reply(request.ticket, request.reply)
+        stream.unflushed.append(request)
+
+    def _parse(self, stream, request, command_string):
+        "Parse the command for `request`, or set its reply if it needs no executing"
+        if self._debug:
             print >>sys.stderr, 'Read command {!r}'.format(command_string)
 
-        command = _tokenize_command(command_string.strip('\n'))
+        if command_string == STATS_COMMAND:
+            request.name = STATS_COMMAND
+            request.set_reply(return_code=0, output=json.dumps(self.stats.summary()))
+            return
+
+        if command_string.startswith(CANCEL_COMMAND + ' '):
+            # Streams may well have finished by the time they are cancelled
+            request.name = CANCEL_COMMAND
+            cancel_id = command_string.split(' ', 1)[1].strip()
+            if not cancel_id.isdigit():
+                request.set_reply(return_code=1, output='', error='{} needs a request id, not {!r}\n'.format(CANCEL_COMMAND, cancel_id))
+                return
+
+            cancelled = stream.streams.get(int(cancel_id))
+            if cancelled is not None:
+                cancelled.cancelled = True
+            request.set_reply(return_code=0, output='')
+            return
+
+        if command_string.startswith(STREAM_PREFIX):
+            command_string = command_string[len(STREAM_PREFIX):]
+            request.streamed = True
+            if request.request_id is None:
+                request.set_reply(return_code=1, output='', error='Streamed commands need a request id\n')
+                return
+
+        command = _tokenize_command(command_string)
+        request.timer.lap('tokenize')
+        try:
+            request.options = self._parser.parse_args(command)
+            request.timer.lap('argparse')
+            request.name = getattr(request.options, 'command', None) or UNNAMED
+            request.read_only = self._read_only(request.options)
+        except BaseException:
+            request.set_reply(return_code=1, output='', error=traceback.format_exc())
+            request.timer.lap('serialize')
+
+    def _read_typed_request(self, stream, line):
+        try:
+            message = json.loads(line)
+        except ValueError:
+            message = dict(id=None)
+
+        request_id = message.get('id')
+        request = Request(stream.expect_reply(in_order=request_id is None), request_id)
+        request.typed = True
+        stream.requests.append(request)
+
+        if self._debug:
+            print >>sys.stderr, 'Read typed request {!r}'.format(message)
+
         try:
-            options = parser.parse_args(command)
+            method = message['method']
+            request.options = self._method_options(method, message.get('params', {}))
+            request.timer.lap('parameters')
+            request.name = method
+            request.read_only = self._read_only(request.options)
+        except Exception:
+            request.set_reply(return_code=1, result=None, error=traceback.format_exc())
+            request.timer.lap('serialize')
+
+    def _method_options(self, method, params):
+        """The options for the subcommand `method` with arguments `params`, as if they had been parsed.
+        Parameters are named after the argument's long option or destination. Values are converted
+        with the argument's type, and true values for flags store their constant"""
+        if method not in self._method_arguments:
+            self._method_arguments[method] = _method_arguments(self._parser, method)
+        defaults, arguments = self._method_arguments[method]
 
-            if debug:
-                print >>sys.stderr, 'Running command'
+        options = argparse.Namespace(**defaults)
+        for name, value in params.items():
+            if name not in arguments:
+                raise ValueError('{} has no parameter {!r}'.format(method, name))
+            action = arguments[name]
 
-            result_list = run_function(options)
+            if isinstance(action, argparse._StoreConstAction):
+                value = action.const if value else action.default
+            elif value is not None and action.type is not None:
+                if isinstance(value, list):
+                    value = map(action.type, value)
+                else:
+                    value = action.type(value)
 
-            if debug:
-                print >>sys.stderr, 'Finished running'
+            setattr(options, action.dest, value)
 
-            result = ''.join(result_list) if result_list is not None else ''
+        for action in arguments.values():
+            if action.required and getattr(options, action.dest) is None:
+                raise ValueError('{} needs parameter {!r}'.format(method, action.dest))
+
+        return options
+
+    def _locked(self, request):
+        return self._lock.reading() if request.read_only else self._lock.writing()
+
+    def _execute(self, request):
+        "Run the command for `request`. Errors are confined to its reply"
+        output_key = 'result' if request.typed else 'output'
+        try:
+            with self._locked(request):
+                request.timer.lap('wait')
+
+                if self._debug:
+                    print >>sys.stderr, 'Running command'
+
+                method = self._methods.get(request.options.command) if request.typed else None
+                if method is not None:
+                    result = method(request.options)
+                else:
+                    result_list = self._run_function(request.options)
+                    result = ''.join(result_list) if result_list is not None else ''
+
+                if self._debug:
+                    print >>sys.stderr, 'Finished running'
+
+                request.timer.lap('execute')
         except BaseException:
-            print json.dumps(dict(return_code=1, output='', error=traceback.format_exc()))
+            request.set_reply(return_code=1, error=traceback.format_exc(), **{output_key: None if request.typed else ''})
         else:
-            if debug:
+            if self._debug:
                 print >>sys.stderr, 'Dumping'
 
-            print json.dumps(dict(return_code=0, output=result))
-            sys.stdout.flush()
-            if debug:
-                print >>sys.stderr, 'Finished dumping'
+            request.set_reply(return_code=0, **{output_key: result})
+
+        request.timer.lap('serialize')
+        return request
+
+    def _execute_streamed(self, request):
+        """Run the command for `request`, yielding chunk lines as its output is produced
+        and setting its reply once there is no more.
+
+        The lock is only held while starting the command, so other commands can run
+        while the client is reading a stream, or while a stream is waiting for something to happen"""
+        chunks = iter(())
+        try:
+            with self._locked(request):
+                request.timer.lap('wait')
+                result = self._run_function(request.options)
+                chunks = iter(result if result is not None else ())
+
+            while not request.cancelled:
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    break
+                yield json.dumps(dict(chunk=chunk, id=request.request_id)) + '\n'
+            else:
+                raise StreamCancelled()
+
+            request.timer.lap('execute')
+        except BaseException:
+            request.set_reply(return_code=1, output='', error=traceback.format_exc())
+        else:
+            request.set_reply(return_code=0, output='')
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+        request.timer.lap('serialize')
+
+class StreamCancelled(Exception):
+    "A streamed command was stopped by `CANCEL_COMMAND` or because its client went away"
+
+class Request(object):
+    "A command read by a `Server`, and its reply"
+    def __init__(self, ticket, request_id):
+        self.ticket = ticket
+        self.request_id = request_id
+        self.timer = latency.PhaseTimer()
+        self.name = UNPARSED
+        self.options = None
+        self.read_only = False
+        self.streamed = False
+        self.typed = False
+        self.cancelled = False
+        self.reply = None
+
+    def set_reply(self, **fields):
+        if self.request_id is not None:
+            fields['id'] = self.request_id
+        if self.streamed:
+            fields['end'] = True
+        self.reply = json.dumps(fields) + '\n'
+
+def _method_arguments(parser, method):
+    """Return the defaults for the subcommand `method` of `parser`, and its arguments
+    by long option name and destination"""
+    defaults = {}
+    arguments = {}
+    actions = list(parser._actions)
+    while actions:
+        action = actions.pop(0)
+        if isinstance(action, argparse._SubParsersAction):
+            defaults[action.dest] = method
+            if method not in action.choices:
+                raise ValueError('No such method {!r}'.format(method))
+            actions.extend(action.choices[method]._actions)
+        elif action.dest != argparse.SUPPRESS:
+            defaults[action.dest] = action.default
+            arguments[action.dest] = action
+            for option in action.option_strings:
+                if option.startswith('--'):
+                    arguments[option[2:].replace('-', '_')] = action
+
+    return defaults, arguments
+
+def _split_request_id(command_string):
+    "Requests may start with @ID, in which case the reply contains this id and may be sent out of order"
+    if command_string.startswith(REQUEST_ID_PREFIX):
+        request_id, _, command_string = command_string.partition(' ')
+        try:
+            return int(request_id[len(REQUEST_ID_PREFIX):]), command_string
+        except ValueError:
+            raise ValueError('Request ids must be integers: {!r}'.format(request_id))
+    else:
+        return None, command_string
+
+class ReadWriteLock(object):
+    "Any number of readers or one writer. Waiting writers hold off new readers"
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writing = False
+        self._writers_waiting = 0
+
+    @contextlib.contextmanager
+    def reading(self):
+        with self._condition:
+            while self._writing or self._writers_waiting:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def writing(self):
+        with self._condition:
+            self._writers_waiting += 1
+            while self._writing or self._readers:
+                self._condition.wait()
+            self._writers_waiting -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+class WorkerPool(object):
+    """Run functions on a pool of threads.
+
+    Becomes readable (for `select`) when functions have finished. Their results are then available from `completed`"""
+    def __init__(self, workers):
+        self._requests = Queue.Queue()
+        self._results = Queue.Queue()
+        self._wake_read, self._wake_write = os.pipe()
+        for _ in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.setDaemon(True)
+            thread.start()
+
+    def fileno(self):
+        return self._wake_read
+
+    def submit(self, function, argument, context):
+        self._requests.put((function, argument, context))
+
+    def _work(self):
+        while True:
+            function, argument, context = self._requests.get()
+            self._results.put((function(argument), context))
+            os.write(self._wake_write, '.')
+
+    def completed(self):
+        "Return (result, context) pairs for finished functions"
+        os.read(self._wake_read, 65536)
+        results = []
+        while True:
+            try:
+                results.append(self._results.get_nowait())
+            except Queue.Empty:
+                return results
+
+class Streamer(object):
+    """Run generators of chunks on their own threads.
+
+    Becomes readable (for `select`) when chunks are available from `ready`. Each generator can only get
+    `STREAM_BUFFER` chunks ahead of whoever is reading them, so memory stays bounded for slow readers"""
+    def __init__(self):
+        self._chunks = Queue.Queue()
+        self._wake_read, self._wake_write = os.pipe()
+
+    def fileno(self):
+        return self._wake_read
+
+    def start(self, chunks, request, context):
+        thread = threading.Thread(target=self._run, args=(chunks, request, context))
+        thread.setDaemon(True)
+        thread.start()
+
+    def _run(self, chunks, request, context):
+        space = threading.Semaphore(STREAM_BUFFER)
+        for chunk in chunks:
+            space.acquire()
+            self._put((request, context, chunk, space))
+        self._put((request, context, None, None))
+
+    def _put(self, item):
+        self._chunks.put(item)
+        os.write(self._wake_write, '.')
+
+    def ready(self):
+        """Return (request, context, chunk, space) tuples for chunks that have been produced.
+        `space.release()` must be called once `chunk` has been dealt with. `chunk` is None
+        once a generator has finished"""
+        os.read(self._wake_read, 65536)
+        items = []
+        while True:
+            try:
+                items.append(self._chunks.get_nowait())
+            except Queue.Empty:
+                return items
+
+def _select(streams, timeout):
+    try:
+        readable, _, _ = select.select(streams, [], [], timeout)
+    except select.error as e:
+        if e.args[0] == errno.EINTR:
+            return []
+        raise
+    return readable
+
+class InsecureDirectory(Exception):
+    "A directory for sockets that other users could use"
+
+def check_private_directory(directory):
+    """Raise `InsecureDirectory` unless `directory` is ours and only we can use it. (Otherwise
+    another user could, say, create /tmp/qscli-UID first, and then intercept or impersonate servers)"""
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or stat.S_IMODE(info.st_mode) != 0700:
+        raise InsecureDirectory('Refusing to use {!r} for sockets: it must be a directory (not a link) owned by us with mode 0700'.format(directory))
+
+def private_directory(directory):
+    "Create `directory` if need be, and check that only we can use it"
+    try:
+        os.makedirs(directory, 0700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    else:
+        os.chmod(directory, 0700)
+    check_private_directory(directory)
+
+def listen(path):
+    "Listen on `path`, returning None if another server is already listening"
+    private_directory(os.path.dirname(path))
+
+    with fasteners.InterProcessLock(path + '.lck'):
+        if os.path.exists(path):
+            sock = _try_connect(path)
+            if sock is not None:
+                sock.close()
+                return None
+            os.unlink(path)
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(16)
+        return listener
+
+def stop_listening(listener, path):
+    "Stop listening, returning the sockets of clients that connected just before we stopped"
+    with fasteners.InterProcessLock(path + '.lck'):
+        if os.path.exists(path):
+            os.unlink(path)
+
+    socks = []
+    listener.setblocking(False)
+    while True:
+        try:
+            sock, _ = listener.accept()
+        except socket.error:
+            break
+        sock.setblocking(True)
+        socks.append(sock)
+
+    listener.close()
+    return socks
+
+class Connection(object):
+    """Line-based reading and buffered writing over raw file descriptors.
+
+    Keeps track of the replies that are still to be sent, so that replies without
+    request ids are sent in order"""
+    def __init__(self, read_fd, write_fd, sock=None):
+        self._read_fd = read_fd
+        self._write_fd = write_fd
+        self._sock = sock
+        self._read_buffer = ''
+        self._write_buffer = []
+        self._eof = False
+        self._next_ticket = 0
+        self._in_flight = set()
+        self._ordered_replies = collections.OrderedDict()
+
+        # Book-keeping for `Server`
+        self.requests = collections.deque()
+        self.executing_reads = 0
+        self.executing_writes = 0
+        self.unflushed = []
+        self.streams = {}
+        self.broken = False
+
+    def fileno(self):
+        return self._read_fd
+
+    def receive(self):
+        "Read whatever input is available"
+        try:
+            data = os.read(self._read_fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                return
+            elif e.errno == errno.ECONNRESET:
+                data = ''
+            else:
+                raise
+
+        if not data:
+            self._eof = True
+        else:
+            self._read_buffer += data
+
+    def buffered_line(self):
+        "Return the next complete line that has already been read, or None"
+        if '\n' in self._read_buffer:
+            line, self._read_buffer = self._read_buffer.split('\n', 1)
+            return line + '\n'
+        elif self._eof and self._read_buffer:
+            line, self._read_buffer = self._read_buffer, ''
+            return line
+        else:
+            return None
+
+    def finished_reading(self):
+        return self._eof
+
+    def finished(self):
+        "Has all input been read and replied to"
+        return self._eof and not self._in_flight
+
+    def expect_reply(self, in_order):
+        "Returns a ticket with which to `reply`"
+        ticket = self._next_ticket
+        self._next_ticket += 1
+        self._in_flight.add(ticket)
+        if in_order:
+            self._ordered_replies[ticket] = None
+        return ticket
+
+    def reply(self, ticket, data):
+        self._in_flight.remove(ticket)
+        if ticket not in self._ordered_replies:
+            self.write(data)
+            return
+
+        self._ordered_replies[ticket] = data
+        while self._ordered_replies:
+            first_ticket, first_data = next(iter(self._ordered_replies.items()))
+            if first_data is None:
+                break
+            self.write(first_data)
+            del self._ordered_replies[first_ticket]
+
+    def write(self, data):
+        self._write_buffer.append(data)
+
+    def flush(self):
+        data = ''.join(self._write_buffer)
+        self._write_buffer = []
+        while data and not self.broken:
+            try:
+                written = os.write(self._write_fd, data)
+            except OSError as e:
+                if e.errno in (errno.EPIPE, errno.ECONNRESET):
+                    LOGGER.debug('Client went away before reading its replies')
+                    self.broken = True
+                    return
+                raise
+            data = data[written:]
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
 
 def _tokenize_command(command_string):
     escaping = False
@@ -77,34 +858,225 @@ def _tokenize_command(command_string):
     words.append(''.join(buff))
     return words
 
+class CommandError(Exception):
+    "A command run through a `CliClient` errored out"
+    def __init__(self, command_string, reply):
+        Exception.__init__(self, 'Command errored out {!r} {!r}'.format(command_string, reply))
+        self.command_string = command_string
+        self.reply = reply
+
 class CliClient(object):
-    "Client"
+    """Client
+
+    If `socket_path` is given, connect to a shared server listening on this socket,
+    running `command` with `--socket` to start it if it is not running.
+    Otherwise run `command` as a private server over standard in and out.
+
+    Timings for each command, as seen by the client, are kept in `stats` and
+    are written to `stats_file` on shutdown. Compare with the server's timings
+    (from `run([STATS_COMMAND])`) to see the overhead of communication.
+    """
     # Responses are json with the form {return_code: , output:, error:}
-    def __init__(self, command):
+    def __init__(self, command, socket_path=None, idle_timeout=DEFAULT_IDLE_TIMEOUT, connect_timeout=10.0, stats_file=None):
         self._command = command
+        self._socket_path = socket_path
+        self._idle_timeout = idle_timeout
+        self._connect_timeout = connect_timeout
+        self._stats_file = stats_file
+        self.stats = latency.LatencyStats()
+        self._next_request_id = 0
         self._proc = None
+        self._sock = None
+        self._reader = self._writer = None
 
     def initialize(self):
-        LOGGER.debug('Spawning process %r', self._command)
-        self._proc = subprocess.Popen(self._command, stdout=subprocess.PIPE, stdin=subprocess.PIPE)
+        if self._socket_path is None:
+            LOGGER.debug('Spawning process %r', self._command)
+            self._proc = subprocess.Popen(self._command, stdout=subprocess.PIPE, stdin=subprocess.PIPE)
+            self._reader, self._writer = self._proc.stdout, self._proc.stdin
+        else:
+            self._sock = self._connect()
+            self._reader, self._writer = self._sock.makefile('rb'), self._sock.makefile('wb')
+
+    def _connect(self):
+        sock = _try_connect(self._socket_path)
+        if sock is not None:
+            return sock
+
+        self._spawn_server()
+        deadline = time.time() + self._connect_timeout
+        while time.time() < deadline:
+            sock = _try_connect(self._socket_path)
+            if sock is not None:
+                return sock
+            time.sleep(0.01)
+
+        raise Exception('Could not connect to {!r} started with {!r}'.format(self._socket_path, self._command))
+
+    def _spawn_server(self):
+        command = self._command + ['--socket', self._socket_path]
+        if self._idle_timeout is not None:
+            command += ['--idle-timeout', str(self._idle_timeout)]
+
+        LOGGER.debug('Spawning server %r', command)
+        with open(os.devnull, 'r+') as devnull:
+            subprocess.Popen(command, stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True, preexec_fn=os.setsid)
 
     def run(self, command):
-        command_string = ' '.join(map(_escape_whitespaced, command))
-        LOGGER.debug('Sending command %r %r', self, command_string)
-        if self._proc.poll() is not None:
+        output, = self.run_many([command])
+        return output
+
+    def run_many(self, commands, return_errors=False):
+        """Send all of `commands` before reading any replies, returning their outputs in order.
+
+        Every reply is read before any error is raised, so a failing command
+        does not affect the others. If `return_errors` is set, a `CommandError`
+        is returned in place of the output of each failed command instead.
+        """
+        command_strings = [' '.join(map(_escape_whitespaced, command)) for command in commands]
+        LOGGER.debug('Sending commands %r %r', self, command_strings)
+        request_ids = self._request_ids(len(commands))
+        requests = [
+            '{}{} {}\n'.format(REQUEST_ID_PREFIX, request_id, command_string)
+            for request_id, command_string in zip(request_ids, command_strings)]
+        replies = self._round_trip(request_ids, requests, map(_command_name, commands))
+        return self._results(replies, command_strings, 'output', return_errors)
+
+    def call(self, method, **params):
+        """Run the subcommand `method` with arguments `params`, returning native data.
+
+        Parameters are named after the long option (or destination) of each argument
+        (e.g. days_ago for --days-ago), take json values, and are true or false for flags.
+        If the server has no method for the subcommand, its output is returned.
+        """
+        result, = self.call_many([(method, params)])
+        return result
+
+    def call_many(self, calls, return_errors=False):
+        "Like `run_many`, but for (method, params) pairs as for `call`"
+        request_ids = self._request_ids(len(calls))
+        requests = [
+            json.dumps(dict(id=request_id, method=method, params=params)) + '\n'
+            for request_id, (method, params) in zip(request_ids, calls)]
+        LOGGER.debug('Sending calls %r %r', self, requests)
+        replies = self._round_trip(request_ids, requests, [method for method, _ in calls])
+        return self._results(replies, [request.strip('\n') for request in requests], 'result', return_errors)
+
+    def _request_ids(self, number):
+        request_ids = range(self._next_request_id, self._next_request_id + number)
+        self._next_request_id += number
+        return request_ids
+
+    def _round_trip(self, request_ids, requests, names):
+        "Send `requests` with `request_ids`, returning their replies in order"
+        if self._proc is not None and self._proc.poll() is not None:
             raise Exception('Process has died %r', self._command)
-        self._proc.stdin.write(command_string + '\n')
-        self._proc.stdin.flush()
-        reply = self._proc.stdout.readline()
+
+        send_timer = latency.PhaseTimer()
+        self._writer.write(''.join(requests))
+        self._writer.flush()
+        send_timer.lap('send')
+
+        # Replies can arrive in any order
+        replies = {}
+        while len(replies) < len(requests):
+            reply_timer = latency.PhaseTimer()
+            data = self._read_reply()
+            reply_timer.lap('reply')
+            replies[data['id']] = data
+
+            name = names[data['id'] - request_ids[0]]
+            self.stats.record_phases(name, send_timer.phases + reply_timer.phases)
+            self.stats.record(name, 'round-trip', time.time() - send_timer.start)
+
+        return [replies[request_id] for request_id in request_ids]
+
+    @staticmethod
+    def _results(replies, request_strings, result_key, return_errors):
+        results = []
+        for data, request_string in zip(replies, request_strings):
+            if not data['return_code'] == 0:
+                results.append(CommandError(request_string, data))
+            else:
+                results.append(data[result_key])
+
+        if not return_errors:
+            for result in results:
+                if isinstance(result, CommandError):
+                    raise result
+
+        return results
+
+    def stream(self, command):
+        """Run `command`, yielding chunks of its output as the server produces them.
+
+        The command must return a generator for there to be more than one chunk.
+        Nothing else can be run with this client until the iterator is exhausted or
+        closed. Closing it early cancels the command on the server.
+        """
+        command_string = ' '.join(map(_escape_whitespaced, command))
+        LOGGER.debug('Streaming command %r %r', self, command_string)
+        request_id, = self._request_ids(1)
+
+        timer = latency.PhaseTimer()
+        self._send([(request_id, STREAM_PREFIX + command_string)])
+        timer.lap('send')
+
+        data = None
+        try:
+            while True:
+                data = self._read_reply()
+                if data.get('end'):
+                    break
+                yield data['chunk']
+        finally:
+            if data is None or not data.get('end'):
+                self._cancel(request_id)
+
+        timer.lap('stream')
+        self.stats.record_phases(_command_name(command), timer.phases)
+        if data['return_code'] != 0:
+            raise CommandError(command_string, data)
+
+    def _cancel(self, stream_id):
+        cancel_id, = self._request_ids(1)
+        self._send([(cancel_id, '{} {}'.format(CANCEL_COMMAND, stream_id))])
+
+        # Chunks already sent are dropped
+        finished = set()
+        while finished != set([stream_id, cancel_id]):
+            data = self._read_reply()
+            if data['id'] == cancel_id or data.get('end'):
+                finished.add(data['id'])
+
+    def _send(self, requests):
+        "Send (request_id, command_string) pairs"
+        self._writer.write(''.join(
+            '{}{} {}\n'.format(REQUEST_ID_PREFIX, request_id, command_string)
+            for request_id, command_string in requests))
+        self._writer.flush()
+
+    def _read_reply(self):
+        reply = self._reader.readline()
         LOGGER.debug('Got reply %r', reply)
-        data = json.loads(reply)
-        if not data['return_code'] == 0:
-            raise Exception('Command errored out {!r} {!r}'.format(command_string, data))
-        return data['output']
+        if not reply:
+            raise Exception('Server has gone away %r', self._command)
+        return json.loads(reply)
 
     def shutdown(self):
-        self._proc.stdin.close()
-        self._proc.wait()
+        if self._stats_file is not None:
+            self.stats.write(self._stats_file)
+
+        if self._proc is not None:
+            self._proc.stdin.close()
+            self._proc.wait()
+            self._proc = None
+
+        if self._sock is not None:
+            self._reader.close()
+            self._writer.close()
+            self._sock.close()
+            self._sock = None
 
     def __del__(self):
         self.shutdown()
@@ -116,5 +1088,26 @@ class CliClient(object):
     def __exit__(self, exc_type, exc_info, tb):
         self.shutdown()
 
+def _command_name(command):
+    "Guess the subcommand of `command`, for naming its timings"
+    for word in command:
+        if not word.startswith('-'):
+            return word
+    return UNNAMED
+
+def _try_connect(path):
+    if os.path.lexists(os.path.dirname(path)):
+        check_private_directory(os.path.dirname(path))
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error as e:
+        sock.close()
+        if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+            return None
+        raise
+    return sock
+
 def _escape_whitespaced(command):
     return command.replace('\\', '\\\\').replace(' ', '\ ').replace('\n', '\\n')
@@ -0,0 +1,84 @@
+"""Record how long things take, in histograms with logarithmically sized buckets
+
+Keeps a bounded amount of memory however many timings are recorded.
+"""
+
+import json
+import math
+import time
+
+# Buckets grow by a factor of 2 ** (1 / BUCKETS_PER_DOUBLING)
+BUCKETS_PER_DOUBLING = 4
+MIN_SECONDS = 1e-6
+
+class LatencyHistogram(object):
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, seconds):
+        bucket = int(math.floor(math.log(max(seconds, MIN_SECONDS) / MIN_SECONDS, 2) * BUCKETS_PER_DOUBLING))
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.minimum = seconds if self.minimum is None else min(self.minimum, seconds)
+        self.maximum = seconds if self.maximum is None else max(self.maximum, seconds)
+
+    def quantile(self, target):
+        "An upper bound on the `target` quantile"
+        seen = 0
+        for bucket, count in sorted(self.counts.items()):
+            seen += count
+            if seen >= target * self.count:
+                return min(MIN_SECONDS * 2 ** (float(bucket + 1) / BUCKETS_PER_DOUBLING), self.maximum)
+        return self.maximum
+
+    def summary(self):
+        "Summary statistics in milliseconds"
+        return dict(
+            count=self.count,
+            mean=1000 * self.total / self.count,
+            min=1000 * self.minimum,
+            max=1000 * self.maximum,
+            p50=1000 * self.quantile(0.5),
+            p90=1000 * self.quantile(0.9),
+            p99=1000 * self.quantile(0.99))
+
+class LatencyStats(object):
+    "Histograms of how long each phase of each command takes"
+    def __init__(self):
+        self._histograms = {}
+
+    def record(self, name, phase, seconds):
+        self._histograms.setdefault((name, phase), LatencyHistogram()).add(seconds)
+
+    def record_phases(self, name, phases):
+        for phase, seconds in phases:
+            self.record(name, phase, seconds)
+
+    def summary(self):
+        result = {}
+        for (name, phase), histogram in self._histograms.items():
+            result.setdefault(name, {})[phase] = histogram.summary()
+        return result
+
+    def write(self, filename):
+        with open(filename, 'w') as stream:
+            stream.write(json.dumps(self.summary(), indent=4, sort_keys=True))
+
+class PhaseTimer(object):
+    "Time consecutive phases of some piece of work"
+    def __init__(self):
+        self.start = self._last = time.time()
+        self.phases = []
+
+    def lap(self, phase):
+        now = time.time()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def total(self):
+        return self._last - self.start
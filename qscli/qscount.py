@@ -13,8 +13,15 @@ qscount list # list the things that you are counting
 """
 
 import argparse
+import array
+import base64
+import bisect
+import collections
 import contextlib
+import csv
 import datetime
+import errno
+import heapq
 import json
 import logging
 import os
@@ -27,11 +34,14 @@ import tempfile
 import threading
 import time
 import unittest
+import urllib
 
 import fasteners
 
 from . import ipc
 
+LOGGER = logging.getLogger('qscount')
+
 CURRENT = 'CURRENT'
 
 def get_set_id(string):
@@ -69,7 +79,8 @@ merge = PARSERS.add_parser('merge', help='Merge together two counters')
 merge.add_argument('target', type=str)
 merge.add_argument('merged', type=str)
 
-PARSERS.add_parser('daemon')
+daemon_parser = PARSERS.add_parser('daemon')
+ipc.add_daemon_arguments(daemon_parser)
 
 note = PARSERS.add_parser('note', help='Record a note about a counter')
 counter_arg(note)
@@ -94,7 +105,73 @@ def fuzzy_date(string):
         return fuzzy_date_raw(string)
 
 def fuzzy_date_raw(string):
-    return datetime.datetime.fromtimestamp(float(backticks(['date', '-d', string, '+%s'])))
+    if string not in FUZZY_DATES:
+        if len(FUZZY_DATES) >= MAX_FUZZY_DATES:
+            FUZZY_DATES.clear()
+        FUZZY_DATES[string] = parse_fuzzy_date(string)
+
+    parsed = FUZZY_DATES[string]
+    if parsed is None:
+        return datetime.datetime.fromtimestamp(float(backticks(['date', '-d', string, '+%s'])))
+    else:
+        return parsed(datetime.datetime.now())
+
+# Parsed dates (see `parse_fuzzy_date`) by string. Dates we cannot parse are None
+FUZZY_DATES = dict()
+MAX_FUZZY_DATES = 1000
+
+WEEKDAYS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+
+DATE_UNITS = dict(
+    second=datetime.timedelta(seconds=1),
+    minute=datetime.timedelta(minutes=1),
+    hour=datetime.timedelta(hours=1),
+    day=datetime.timedelta(days=1),
+    week=datetime.timedelta(weeks=1))
+
+def midnight(dt):
+    return datetime.datetime.combine(dt.date(), datetime.time())
+
+def parse_fuzzy_date(string):
+    """Parse the forms of date that we use with `date -d`, returning a function of the current
+    time which gives the date as `date -d` would. Returns None for any other form"""
+    string = ' '.join(string.lower().split())
+
+    if string in ('now', 'today'):
+        return lambda now: now
+    elif string == 'yesterday':
+        return lambda now: now - DATE_UNITS['day']
+    elif string == 'tomorrow':
+        return lambda now: now + DATE_UNITS['day']
+
+    match = re.search(r'^(\d+) (second|minute|hour|day|week)s? ago$', string)
+    if match:
+        offset = int(match.group(1)) * DATE_UNITS[match.group(2)]
+        return lambda now: now - offset
+
+    for date_format in ('%Y-%m-%d', '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dt%H:%M:%S'):
+        try:
+            dt = datetime.datetime.strptime(string, date_format)
+        except ValueError:
+            continue
+        return lambda now: dt
+
+    match = re.search(r'^(?:(last|this|next) )?([a-z]+)$', string)
+    weekdays = [day for day in WEEKDAYS if match and match.group(2) in (day, day[:3])]
+    if weekdays:
+        weekday = WEEKDAYS.index(weekdays[0])
+        relative = match.group(1)
+        def weekday_date(now):
+            # As for date: the next such day (or today), last is a week earlier
+            days_ahead = (weekday - now.weekday()) % 7
+            if relative == 'last':
+                days_ahead -= 7
+            elif relative == 'next' and days_ahead == 0:
+                days_ahead = 7
+            return midnight(now) + days_ahead * DATE_UNITS['day']
+        return weekday_date
+
+    return None
 
 
 def rel_or_fuzzy_date(string):
@@ -146,6 +223,19 @@ days_ago_argument(list_parser)
 count_parser = PARSERS.add_parser('count', help='Show the count')
 counter_arg(count_parser)
 count_parser.add_argument('--set', type=get_set_id, help='Show the count for a particular set (CURRENT) for the current set)')
+count_parser.add_argument('--since', type=fuzzy_date, help='Only count events from this time (format suitable for `date -d`)')
+count_parser.add_argument('--until', type=fuzzy_date, help='Only count events up to this time (format suitable for `date -d`)')
+
+incr.add_argument('--times', '-n', type=int, default=1, help='Record this many events')
+incr.add_argument('--at', type=fuzzy_date, help='Record events at this time rather than now (format suitable for `date -d`)')
+
+import_parser = PARSERS.add_parser('import', help='Record events read from a file')
+import_parser.add_argument(
+    'file', type=argparse.FileType('r'), nargs='?',
+    help='Read events from this file (default standard in). Each event has a counter, a time '
+    '(a unix timestamp or something suitable for `date -d`) and optionally a set')
+import_parser.add_argument('--format', choices=('jsonl', 'csv'), default='jsonl', help='One json object per line, or csv rows of counter,time,set')
+import_parser.add_argument('--record', type=json.loads, action='append', dest='records', help='Use this json event rather than reading a file')
 
 PARSERS.add_parser('shell')
 
@@ -159,41 +249,106 @@ def main():
 
 DATA_FILE = 'data'
 
+READ_ONLY_COMMANDS = ('count', 'log', 'summary', 'compare', 'list')
+
 def run(options):
     if options.command == 'daemon':
-        return ipc.run_server(PARSER, run)
-
-    with with_data(os.path.join(options.config_dir, DATA_FILE)) as data:
-        counter = Counter(data)
-        if options.command == 'shell':
-            return str(counter.shell())
-        if options.command == 'new-set':
-            return str(counter.new_set(options.counter))
-        elif options.command == 'move':
-            return str(counter.move(options.before, options.after))
-        elif options.command == 'merge':
-            return str(counter.merge(options.target, options.merged))
-        elif options.command == 'delete':
-            return str(counter.delete(options.counter))
-        elif options.command == 'incr':
-            return str(counter.incr(options.counter))
-        elif options.command == 'count':
-            return str(counter.count(options.counter, options.set))
-        elif options.command == 'log':
-            return str(counter.log(options.counter, options.set, options.json))
-        elif options.command == 'summary':
-            return str(counter.summary(options.date, options.regexp, options.zeros, options.json))
-        elif options.command == 'compare':
-            end1 = options.start1 + options.end1 if isinstance(options.end1, datetime.timedelta) else options.end1
-            end2 = options.start2 + options.end2 if isinstance(options.end2, datetime.timedelta) else options.end2
-            sort_func = compare_sort_method(options.sort)
-            return str(counter.compare(options.start1, end1, options.start2, end2, sort_func=sort_func, is_json=options.is_json, regex=options.regex))
-        elif options.command == 'note':
-            return str(counter.note(options.counter, options.note))
-        elif options.command == 'list':
-            return str(counter.list(options.date))
-        else:
-            raise ValueError(options.command)
+        # Commands use the daemon's config directory unless they say otherwise
+        PARSER.set_defaults(config_dir=options.config_dir)
+
+        shards = ResidentShards()
+        methods = dict(
+            (name, lambda command_options, method=method: shards.call(method, command_options))
+            for name, method in METHODS.items())
+        def run_daemon_command(command_options):
+            check_daemon_options(command_options)
+            return shards.call(run_command, command_options)
+
+        try:
+            return ipc.run_server(
+                PARSER, run_daemon_command,
+                socket_path=options.socket, idle_timeout=options.idle_timeout, stats_file=options.stats_file,
+                read_only=ipc.read_only_commands(*READ_ONLY_COMMANDS), workers=options.workers, methods=methods)
+        finally:
+            shards.close()
+
+    with open_counters(options.config_dir, read_only=options.command in READ_ONLY_COMMANDS) as counter:
+        return run_command(counter, options)
+
+def check_daemon_options(options):
+    "Refuse options that the daemon cannot run, such as reading events from its standard in"
+    if options.command == 'import' and options.records is None:
+        raise ValueError('import needs --record when run by the daemon')
+
+def run_command(counter, options):
+    if options.command == 'shell':
+        return str(counter.shell())
+    if options.command == 'new-set':
+        return str(counter.new_set(options.counter))
+    elif options.command == 'move':
+        return str(counter.move(options.before, options.after))
+    elif options.command == 'merge':
+        return str(counter.merge(options.target, options.merged))
+    elif options.command == 'delete':
+        return str(counter.delete(options.counter))
+    elif options.command == 'incr':
+        return str(counter.incr(options.counter, options.times, options.at))
+    elif options.command == 'import':
+        records = options.records if options.records is not None else read_import_records(options.file or sys.stdin, options.format)
+        return str(counter.import_events(records))
+    elif options.command == 'count':
+        return str(counter.count(options.counter, options.set, options.since, options.until))
+    elif options.command == 'log':
+        return str(counter.log(options.counter, options.set, options.json))
+    elif options.command == 'summary':
+        return str(counter.summary(options.date, options.regexp, options.zeros, options.json))
+    elif options.command == 'compare':
+        return str(counter.compare(*compare_arguments(options), is_json=options.is_json, regex=options.regex))
+    elif options.command == 'note':
+        return str(counter.note(options.counter, options.note))
+    elif options.command == 'list':
+        return str(counter.list(options.date))
+    else:
+        raise ValueError(options.command)
+
+def read_import_records(stream, format):
+    "Read dictionaries with a counter, time and (optionally) set from `stream` for `Counter.import_events`"
+    if format == 'jsonl':
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+    elif format == 'csv':
+        for row in csv.reader(stream):
+            if not row or row[0] == 'counter':
+                # Blank lines and a header
+                continue
+            yield dict(zip(('counter', 'time', 'set'), row))
+    else:
+        raise ValueError(format)
+
+def import_time(value):
+    "A unix timestamp or a date suitable for `date -d` as a timestamp"
+    try:
+        return float(value)
+    except ValueError:
+        return to_timestamp(fuzzy_date(value))
+
+def compare_arguments(options):
+    end1 = options.start1 + options.end1 if isinstance(options.end1, datetime.timedelta) else options.end1
+    end2 = options.start2 + options.end2 if isinstance(options.end2, datetime.timedelta) else options.end2
+    return options.start1, end1, options.start2, end2, compare_sort_method(options.sort)
+
+# Methods for typed requests to the daemon (see `ipc.run_server`), called with a `Counter` and the options
+METHODS = dict(
+    incr=lambda counter, options: counter.incr(options.counter, options.times, options.at),
+    count=lambda counter, options: counter.count(options.counter, options.set, options.since, options.until),
+    log=lambda counter, options: dict(events=counter.events(options.counter, options.set)),
+    summary=lambda counter, options: dict(counts=[
+        dict(name=name, count=count)
+        for name, count in counter.summary_counts(options.date, options.regexp, options.zeros)]),
+    compare=lambda counter, options: counter.compare_counts(*compare_arguments(options), regex=options.regex),
+    list=lambda counter, options: counter.list_counters(options.date),
+    )
 
 def compare_sort_name((name, _count1, _count2)):
     return name
@@ -206,160 +361,337 @@ def compare_sort_shortfall((_name, count1, count2)):
     return result
 
 class Counter(object):
-    def __init__(self, data):
-        self._data = data
+    "Counters stored in a `CounterStore`"
+    def __init__(self, store):
+        self._store = store
+
+    @property
+    def store(self):
+        return self._store
 
     @contextlib.contextmanager
     def with_counter(self, name):
-        if '\n' in name:
-            raise ValueError(name)
-        counters = self._data.setdefault('counters', dict())
-        counter = counters.setdefault(name, dict())
-        counter.setdefault('events', [])
-        counter.setdefault('notes', [])
-        counter.setdefault('set', 0)
-        yield counter
+        yield self._store.counter(name)
+
+    def _change(self, change):
+        self._store.change(change)
 
     def new_set(self, name):
-        with self.with_counter(name) as counter:
-            counter['set'] += 1
+        self._change(dict(op='new-set', counter=name))
 
     def shell(self):
         pdb.set_trace()
 
-    def incr(self, name):
+    def incr(self, name, times=1, at=None):
+        timestamp = time.time() if at is None else to_timestamp(at)
         with self.with_counter(name) as counter:
-            event = dict(time=time.time(), set=counter['set'])
-            counter['events'].append(event)
+            if times == 1:
+                self._change(dict(op='incr', counter=name, time=timestamp, set=counter.set))
+            else:
+                self.add_events(name, [(timestamp, counter.set)] * times)
 
         return self.count(name)
 
-    def count(self, name, set_id=None):
+    def add_events(self, name, events):
+        "Add (timestamp, set) `events` to a counter in one change"
+        if len(events) > COMPACT_AFTER:
+            # Too big for the journal
+            self._store.counter(name).add_events(events)
+            self._store.rewrite(name)
+        elif events:
+            self._change(dict(op='incr-many', counter=name, events=events))
+
+    def import_events(self, records):
+        "Add events from dictionaries with a counter, time and (optionally) set. Returns the number added"
+        records_by_name = collections.defaultdict(list)
+        for record in records:
+            records_by_name[record['counter']].append((import_time(record['time']), record.get('set')))
+
+        self._store.use(*records_by_name)
+        for name, named_records in sorted(records_by_name.items()):
+            with self.with_counter(name) as counter:
+                self.add_events(name, [
+                    (timestamp, counter.set if set_id in (None, '') else int(set_id))
+                    for timestamp, set_id in named_records])
+        return sum(map(len, records_by_name.values()))
+
+    def count(self, name, set_id=None, since=None, until=None):
         with self.with_counter(name) as counter:
             if set_id == CURRENT:
-                set_id = counter['set']
-
-            events = counter['events']
-            events = [event for event in events if set_id is None or event.get('set', None) == set_id]
+                set_id = counter.set
 
-            return len(events)
+            start, end = counter.event_range(since, until)
+            if set_id is None:
+                return end - start
+            else:
+                sets = counter.sets
+                return sum(1 for index in xrange(start, end) if sets[index] == set_id)
 
-    def log(self, name, set_id, is_json):
+    def events(self, name, set_id):
         with self.with_counter(name) as counter:
             if set_id == CURRENT:
-                set_id = counter['set']
+                set_id = counter.set
 
-            events = counter['events']
-            events = [event for event in events if set_id is None or event.get('set', None) == set_id]
+            return [
+                dict(time=timestamp, set=event_set)
+                for timestamp, event_set in zip(counter.times, counter.sets)
+                if set_id is None or event_set == set_id]
 
-            if not is_json:
-                string_result = '\n'.join(datetime.datetime.fromtimestamp(event['time']).isoformat() for event in events)
-                return string_result
-            else:
-                return json.dumps(dict(events=events))
+    def log(self, name, set_id, is_json):
+        events = self.events(name, set_id)
+        if not is_json:
+            string_result = '\n'.join(datetime.datetime.fromtimestamp(event['time']).isoformat() for event in events)
+            return string_result
+        else:
+            return json.dumps(dict(events=events))
 
     def delete(self, name):
-        del self._data['counters'][name]
+        self._store.delete(name)
         return ''
 
     def list(self, date=None):
-        counters = sorted(self._data['counters'])
-        if days_ago is not None:
-            new_counters = []
-            for c in counters:
-                counter_events = self._data['counters'][c]['events']
-                if filter_events(counter_events, date=date):
-                    new_counters.append(c)
-            counters = new_counters
+        return '\n'.join(self.list_counters(date))
 
-        return '\n'.join(counters)
+    def list_counters(self, date=None):
+        "Counters with events (on `date`)"
+        if date is None:
+            return self._store.names()
+        else:
+            return [name for name in self._store.names() if self._store.counter(name).count_on(date)]
 
     def note(self, name, note):
-        with self.with_counter(name) as counter:
-            counter['notes'].append(dict(time=time.time(), note=note))
+        self._change(dict(op='note', counter=name, time=time.time(), note=note))
         return ''
 
     def move(self, before, after):
-        self._data['counters'][after] = self._data['counters'][before]
-        del self._data['counters'][before]
+        self._store.move(before, after)
 
     def merge(self, target, merged):
+        self._store.use(target, merged)
         with self.with_counter(target) as target_counter:
             with self.with_counter(merged) as merged_counter:
-
-                is_simple_counter = target_counter['set'] == merged_counter['set'] == 0
-
-                merged_set_offset = target_counter.get('set', 1)
-
-                if not is_simple_counter:
-                    for event in merged_counter['events']:
-                        event['set'] = merged_set_offset + event.get('set', 0)
-
-                new_events = target_counter['events'] + merged_counter['events']
-                new_events.sort(key=lambda x: x['time'])
-
-                if not is_simple_counter:
-                    set_id = 0
-                    for event in new_events:
-                        set_id = max(event.get('set', 0), set_id)
-                        if event.get('set', 0) < set_id:
-                            raise Exception('Overlapping sets')
-
-                target_counter['events'] = 'events'
-                target_counter['notes'] = sorted(target_counter['notes'] + merged_counter['notes'], key=lambda x: x['time'])
-                target_counter['set'] = max([event['set'] for event in target_counter['events']]) + 1
-
+                target_counter.merge(merged_counter)
+        self._store.rewrite(target)
 
     def summary(self, date, regexp, show_zeros, json_format):
+        counts = self.summary_counts(date, regexp, show_zeros)
+        if json_format:
+            json_counts = [dict(name=name, count=count) for (name, count) in counts]
+            return json.dumps(dict(counts=json_counts, indent=4))
+        else:
+            return '\n'.join('{}: {}'.format(action, count) for action, count in sorted(counts))
+
+    def summary_counts(self, date, regexp, show_zeros):
         counts = []
-        for name, counter in sorted(self._data['counters'].items()):
+        for name in self._store.names():
             if regexp and not regexp.search(name):
                 continue
 
-            events = counter['events']
-            events = filter_events(events, date=date)
-
-            count = len(events)
+            count = self._store.counter(name).count_on(date)
 
             if count == 0 and not show_zeros:
                 continue
             else:
                 counts.append((name, count))
 
-        if json_format:
-            json_counts = [dict(name=name, count=count) for (name, count) in counts]
-            return json.dumps(dict(counts=json_counts, indent=4))
-        else:
-            return '\n'.join('{}: {}'.format(action, count) for action, count in sorted(counts))
+        return counts
 
     def compare(self, period1_start, period1_end, period2_start, period2_end, sort_func=compare_sort_name, is_json=False, regex=None):
+        results = self.compare_counts(period1_start, period1_end, period2_start, period2_end, sort_func=sort_func, regex=regex)
+        if is_json:
+            return json.dumps(results)
+        else:
+            return '\n'.join('{} {} {}'.format(*result) for result in results)
+
+    def compare_counts(self, period1_start, period1_end, period2_start, period2_end, sort_func=compare_sort_name, regex=None):
         results = []
-        for name, counter in sorted(self._data['counters'].items()):
+        for name in self._store.names():
             if regex and not regex.search(name):
                 continue
 
-            events = counter['events']
+            counter = self._store.counter(name)
+            period1_count = counter.count_between(period1_start, period1_end)
+            period2_count = counter.count_between(period2_start, period2_end)
 
-            period1_events = [event for event in events if
-                                  period1_start <= datetime.datetime.fromtimestamp(event['time']) <= period1_end]
+            if period1_count or period2_count:
+                results.append((name, period1_count, period2_count))
 
-            period2_events = [event for event in events if
-                                  period2_start <= datetime.datetime.fromtimestamp(event['time']) <= period2_end]
+        results.sort(key=sort_func)
+        return results
 
-            if period1_events or period2_events:
-                results.append((name, len(period1_events), len(period2_events)))
+def counter_data(data, name):
+    if '\n' in name:
+        raise ValueError(name)
+    counters = data.setdefault('counters', dict())
+    return counters.setdefault(name, CounterColumns())
+
+def apply_change(data, change):
+    "Apply a change recorded by `Counter` (and stored in the journal) to `data`"
+    counter = counter_data(data, change['counter'])
+    if change['op'] == 'incr':
+        counter.add_event(change['time'], change['set'])
+    elif change['op'] == 'incr-many':
+        counter.add_events([(timestamp, set_id) for timestamp, set_id in change['events']])
+    elif change['op'] == 'note':
+        counter.notes.append(Note(change['time'], change['note']))
+    elif change['op'] == 'new-set':
+        counter.set += 1
+    else:
+        raise ValueError(change['op'])
 
-        results.sort(key=sort_func)
-        if is_json:
-            return json.dumps(results)
-        else:
-            return '\n'.join('{} {} {}'.format(*result) for result in results)
+class Note(object):
+    __slots__ = ('time', 'note')
+
+    def __init__(self, time, note):
+        self.time = time
+        self.note = note
+
+    def to_json(self):
+        return dict(time=self.time, note=self.note)
 
-def filter_events(events, date=None):
-    events = events[:]
-    if date:
-        events = [event for event in events if datetime.datetime.fromtimestamp(event['time']).date() == date]
-    return events
+class CounterColumns(object):
+    """The events and notes for a counter.
+
+    Events are stored as columns: their `times` (in order) and the `sets` they were in,
+    rather than as a dictionary for each event."""
+    __slots__ = ('times', 'sets', 'notes', 'set', '_days')
+
+    def __init__(self):
+        self.times = array.array('d')
+        self.sets = array.array('i')
+        self.notes = []
+        self.set = 0
+        self._days = None
+
+    def add_event(self, timestamp, set_id):
+        if self.times and self.times[-1] > timestamp:
+            # The clock went backwards, events stay in order
+            index = bisect.bisect_right(self.times, timestamp)
+            self.times.insert(index, timestamp)
+            self.sets.insert(index, set_id)
+        else:
+            self.times.append(timestamp)
+            self.sets.append(set_id)
+
+        if self._days is not None:
+            day = day_key(timestamp)
+            self._days[day] = self._days.get(day, 0) + 1
+
+    def add_events(self, events):
+        "Add (timestamp, set) `events`, merging them into the events we have"
+        added = sorted(events)
+        if not added:
+            return
+
+        # Only the events after the earliest new one need to move
+        start = bisect.bisect_right(self.times, added[0][0])
+        merged = list(heapq.merge(zip(self.times[start:], self.sets[start:]), added))
+        del self.times[start:]
+        del self.sets[start:]
+        self.times.extend(timestamp for timestamp, _ in merged)
+        self.sets.extend(set_id for _, set_id in merged)
+
+        if self._days is not None:
+            for timestamp, _ in added:
+                day = day_key(timestamp)
+                self._days[day] = self._days.get(day, 0) + 1
+
+    def days(self):
+        """The number of events on each (local) day, by iso date.
+
+        This index is kept up to date by `add_event` and stored with the counter,
+        but is built from the events if it is missing (e.g. for old data or after a merge)"""
+        if self._days is None:
+            days = dict()
+            for timestamp in self.times:
+                day = day_key(timestamp)
+                days[day] = days.get(day, 0) + 1
+            self._days = days
+        return self._days
+
+    def count_on(self, date=None):
+        "The number of events on `date` (or ever)"
+        if date is None:
+            return len(self.times)
+        else:
+            return self.days().get(date.isoformat(), 0)
+
+    def event_range(self, since=None, until=None):
+        "The indexes (start, end) of the events between the datetimes `since` and `until` inclusive"
+        start = bisect.bisect_left(self.times, to_timestamp(since)) if since is not None else 0
+        end = bisect.bisect_right(self.times, to_timestamp(until)) if until is not None else len(self.times)
+        return start, max(start, end)
+
+    def count_between(self, start, end):
+        "The number of events between the datetimes `start` and `end`"
+        start_index, end_index = self.event_range(start, end)
+        return end_index - start_index
+
+    def merge(self, other):
+        "Add the events and notes of `other`. Unless both only have one set, the sets of `other` come after ours"
+        is_simple_counter = self.set == other.set == 0
+        set_offset = 0 if is_simple_counter else self.set
+
+        events = sorted(
+            zip(self.times, self.sets) +
+            [(timestamp, set_id + set_offset) for timestamp, set_id in zip(other.times, other.sets)])
+
+        if not is_simple_counter:
+            set_id = 0
+            for _, event_set in events:
+                set_id = max(event_set, set_id)
+                if event_set < set_id:
+                    raise Exception('Overlapping sets')
+
+        self.times = array.array('d', [timestamp for timestamp, _ in events])
+        self.sets = array.array('i', [event_set for _, event_set in events])
+        self._days = None
+        self.notes = sorted(self.notes + other.notes, key=lambda note: note.time)
+        if not is_simple_counter:
+            self.set = max(self.sets) + 1
+
+    def to_json(self):
+        return dict(
+            times=encode_column(self.times),
+            sets=encode_column(self.sets),
+            notes=[note.to_json() for note in self.notes],
+            set=self.set,
+            days=self.days())
+
+    @classmethod
+    def from_json(cls, data):
+        "Read a counter from `to_json`, or from the original format with a dictionary per event"
+        counter = cls()
+        if 'events' in data:
+            counter.times = array.array('d', [event['time'] for event in data['events']])
+            counter.sets = array.array('i', [event.get('set', 0) for event in data['events']])
+        else:
+            counter.times = decode_column('d', data['times'])
+            counter.sets = decode_column('i', data['sets'])
+            counter._days = data.get('days')
+        counter.notes = [Note(note['time'], note['note']) for note in data.get('notes', [])]
+        counter.set = data.get('set', 0)
+        return counter
+
+def encode_column(column):
+    "Columns are stored as the base64 of their little-endian bytes"
+    if sys.byteorder != 'little':
+        column = array.array(column.typecode, column)
+        column.byteswap()
+    return base64.b64encode(column.tostring())
+
+def decode_column(typecode, string):
+    column = array.array(typecode)
+    column.fromstring(base64.b64decode(string))
+    if sys.byteorder != 'little':
+        column.byteswap()
+    return column
+
+def day_key(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).date().isoformat()
+
+def to_timestamp(dt):
+    return time.mktime(dt.timetuple()) + dt.microsecond / 1e6
 
 def read_json(filename):
     if os.path.exists(filename):
@@ -368,16 +700,416 @@ def read_json(filename):
     else:
         return dict()
 
+def write_atomically(filename, content):
+    temp_file = '{}.{}.tmp'.format(filename, threading.current_thread().ident)
+    with open(temp_file, 'w') as stream:
+        stream.write(content)
+    os.rename(temp_file, filename)
+
+# Each counter is stored in its own shard (`shard_file`) with its own lock, and
+#   the names of counters with events are kept in a catalog (`CATALOG_FILE`).
+#   Originally all counters were stored in one data file (`DATA_FILE`).
+#
+# A shard (or the original data file) is stored as a json snapshot (`data_file`) and
+#   a journal of the changes made since (`journal_file`), one json change per line.
+#   After `COMPACT_AFTER` changes, the journal is folded into a new snapshot with the
+#   next generation. A data file without a generation (the original format) is generation 0.
+#   Snapshots of `DATA_VERSION` store counters with `CounterColumns.to_json`.
+
+CATALOG_FILE = 'catalog'
+SHARD_DIR = 'counters'
+
+DATA_VERSION = 2
+
+COMPACT_AFTER = 1000
+
+def journal_file(data_file, generation):
+    return '{}.journal.{}'.format(data_file, generation)
+
+def read_journal(filename, offset=0):
+    """Return the changes in a journal from `offset`, and the length of the file up to the last
+    complete change. A change that was being written when we crashed is ignored"""
+    if not os.path.exists(filename):
+        return [], offset
+
+    with open(filename) as stream:
+        stream.seek(offset)
+        content = stream.read()
+
+    complete, _, _partial = content.rpartition('\n')
+    changes = [json.loads(line) for line in complete.splitlines()]
+    return changes, offset + len(complete) + 1 if complete else offset
+
+def read_data(data_file):
+    """Return the data in the snapshot and journal for `data_file`, the number
+    of changes in the journal and the length of the journal"""
+    data = read_json(data_file)
+    data['counters'] = dict(
+        (name, CounterColumns.from_json(counter))
+        for name, counter in data.get('counters', dict()).items())
+    changes, journal_length = read_journal(journal_file(data_file, data.get('generation', 0)))
+    for change in changes:
+        apply_change(data, change)
+    return data, len(changes), journal_length
+
+def write_snapshot(data_file, data):
+    """Write `data` as the snapshot for the next generation.
+
+    The journal for the previous generation is kept until the generation after, so that
+    readers in this process (see `ipc.run_server`), who are not excluded by the lock, can
+    still read the journal for the snapshot that they read"""
+    old_generation = data.get('generation', 0)
+    data = dict(data, generation=old_generation + 1, version=DATA_VERSION)
+    data['counters'] = dict((name, counter.to_json()) for name, counter in data['counters'].items())
+
+    write_atomically(data_file, json.dumps(data))
+
+    stale_journal = journal_file(data_file, old_generation - 1)
+    if os.path.exists(stale_journal):
+        os.unlink(stale_journal)
+
+    return data['generation']
+
+def append_journal(data_file, generation, journal_length, changes):
+    "Append `changes` to the journal, returning its new length"
+    output = ''.join(json.dumps(change) + '\n' for change in changes)
+    with open(journal_file(data_file, generation), 'a') as stream:
+        # Drop any partly written change
+        stream.truncate(journal_length)
+        stream.write(output)
+    return journal_length + len(output)
+
+def shard_file(directory, name):
+    "The data file for the counter `name`"
+    quoted = urllib.quote(name, safe='')
+    if quoted.startswith('.'):
+        # Not . or ..
+        quoted = '%2E' + quoted[1:]
+    return os.path.join(directory, SHARD_DIR, quoted, DATA_FILE)
+
+def read_catalog(directory):
+    return set(read_json(os.path.join(directory, CATALOG_FILE)).get('counters', []))
+
+def update_catalog(directory, added, removed):
+    catalog_file = os.path.join(directory, CATALOG_FILE)
+    with fasteners.InterProcessLock(catalog_file + '.lck'):
+        names = (read_catalog(directory) | added) - removed
+        write_atomically(catalog_file, json.dumps(dict(counters=sorted(names))))
+
+def migrate_data_file(directory):
+    "Split the counters in the original data file into shards, unless this has been done"
+    if os.path.exists(os.path.join(directory, CATALOG_FILE)):
+        return
+
+    with fasteners.InterProcessLock(os.path.join(directory, DATA_FILE + '.lck')):
+        if os.path.exists(os.path.join(directory, CATALOG_FILE)):
+            return
+
+        # The original data file is left as it was
+        data, _, _ = read_data(os.path.join(directory, DATA_FILE))
+        for name, counter in data.get('counters', dict()).items():
+            data_file = shard_file(directory, name)
+            if not os.path.isdir(os.path.dirname(data_file)):
+                os.makedirs(os.path.dirname(data_file))
+            write_snapshot(data_file, dict(counters={name: counter}))
+
+        update_catalog(directory, set(name for name, counter in data.get('counters', dict()).items() if counter.times), set())
+
+class DiskShard(object):
+    """A shard read for a command. Unless `read_only`, we hold the shard's lock until it is closed.
+
+    Simple changes are recorded in `changes` (see `apply_change`) so that they can be
+    appended to the journal. Other changes set `rewrite`"""
+    def __init__(self, data_file, read_only):
+        self._data_file = data_file
+        self._lock = None if read_only else fasteners.InterProcessLock(data_file + '.lck')
+        if self._lock is not None:
+            self._lock.acquire()
+        self.data, self._num_journaled, self._journal_length = read_data(data_file)
+        self.changes = []
+        self.rewrite = False
+
+    def save(self):
+        if self.rewrite or (self.changes and self._num_journaled + len(self.changes) > COMPACT_AFTER):
+            write_snapshot(self._data_file, self.data)
+        elif self.changes:
+            append_journal(self._data_file, self.data.get('generation', 0), self._journal_length, self.changes)
+
+    def close(self):
+        if self._lock is not None:
+            self._lock.release()
+
+class CounterStore(object):
+    """The counters under `directory` for a command.
+
+    Counters are read from their shards (with `open_shard`, see `DiskShard`) when they are
+    first used, so commands only read, lock and write the counters that they use.
+    Commands using several counters should `use` them first so that they are
+    locked in the same order by every process. `catalog` is the set of names in the
+    catalog, which is not changed"""
+    def __init__(self, directory, open_shard, catalog):
+        self._directory = directory
+        self._open_shard = open_shard
+        self._catalog = catalog
+        self._shards = dict()
+
+    def _shard(self, name):
+        if '\n' in name:
+            raise ValueError(name)
+        if name not in self._shards:
+            self._shards[name] = self._open_shard(shard_file(self._directory, name))
+        return self._shards[name]
+
+    def use(self, *names):
+        for name in sorted(names):
+            self._shard(name)
+
+    def names(self):
+        "The names of counters with events"
+        return sorted(self._catalog)
+
+    def counter(self, name):
+        return counter_data(self._shard(name).data, name)
+
+    def change(self, change):
+        shard = self._shard(change['counter'])
+        apply_change(shard.data, change)
+        shard.changes.append(change)
+
+    def rewrite(self, name):
+        self._shard(name).rewrite = True
+
+    def delete(self, name):
+        self._shard(name).data['counters'] = dict()
+        self.rewrite(name)
+
+    def move(self, before, after):
+        self.use(before, after)
+        counter = self.counter(before)
+        self.delete(before)
+        self._shard(after).data['counters'] = {after: counter}
+        self.rewrite(after)
+
+    def save(self):
+        for shard in self._shards.values():
+            shard.save()
+
+        with_events = set(
+            name for name, shard in self._shards.items()
+            if name in shard.data['counters'] and shard.data['counters'][name].times)
+        added = with_events - self._catalog
+        removed = (set(self._shards) - with_events) & self._catalog
+        if added or removed:
+            update_catalog(self._directory, added, removed)
+
+    def close(self):
+        for shard in self._shards.values():
+            shard.close()
+
 @contextlib.contextmanager
-def with_data(data_file):
-    "Read from a json file, write back to it when we are finished"
-    with fasteners.InterProcessLock(data_file + '.lck'):
-        data = read_json(data_file)
-        yield data
-        output_data = json.dumps(data)
-
-        with open(data_file, 'w') as stream:
-            stream.write(output_data)
+def open_counters(directory, read_only=False, open_shard=None, catalog=None):
+    "Yield a `Counter` for the counters stored under `directory`, saving changes when we are finished"
+    migrate_data_file(directory)
+    if open_shard is None:
+        open_shard = lambda data_file: DiskShard(data_file, read_only)
+    if catalog is None:
+        catalog = read_catalog(directory)
+
+    store = CounterStore(directory, open_shard, catalog)
+    try:
+        yield Counter(store)
+        if not read_only:
+            store.save()
+    finally:
+        store.close()
+
+# The daemon keeps shards in memory and writes changes behind, appending
+#   them to the journal together after `FLUSH_DELAY` seconds or once
+#   there are `FLUSH_AFTER` of them
+
+FLUSH_DELAY = 1.0
+FLUSH_AFTER = 100
+
+FileState = collections.namedtuple('FileState', 'inode size mtime')
+
+def file_state(filename):
+    try:
+        stat = os.stat(filename)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    return FileState(stat.st_ino, stat.st_size, stat.st_mtime)
+
+class ResidentData(object):
+    """The data for the shard `data_file`, kept in memory.
+
+    Changes made by other processes are noticed from the inode, size and modification
+    time of the snapshot and journal: appends to the journal are read in, and anything
+    else causes the data to be reloaded (with our unwritten changes applied again)."""
+    def __init__(self, data_file):
+        self._data_file = data_file
+        self._lock = threading.RLock()
+        self._pending = []
+        self._timer = None
+        with fasteners.InterProcessLock(self._data_file + '.lck'):
+            self._load()
+
+    def _load(self):
+        self.data, self._num_journaled, self._journal_length = read_data(self._data_file)
+        self._file_state = self._current_file_state()
+
+    def _journal_file(self):
+        return journal_file(self._data_file, self.data.get('generation', 0))
+
+    def _current_file_state(self):
+        return file_state(self._data_file), file_state(self._journal_file())
+
+    def open(self, read_only):
+        """Open the data for a command (see `DiskShard`). Commands that change things hold our lock
+        until they close it, and must not run concurrently with any other command (see `ipc.run_server`)"""
+        self._lock.acquire()
+        try:
+            if self._current_file_state() != self._file_state:
+                with fasteners.InterProcessLock(self._data_file + '.lck'):
+                    self._read_changes()
+        finally:
+            if read_only:
+                self._lock.release()
+        return ResidentShard(self, read_only)
+
+    def release(self):
+        "Release our lock, held by a command that changes things since it opened us"
+        self._lock.release()
+
+    def _read_changes(self):
+        "Read in changes made by other processes. Our locks must be held"
+        snapshot_state, journal_state = self._current_file_state()
+        old_snapshot_state, old_journal_state = self._file_state
+        appended = (
+            snapshot_state == old_snapshot_state and journal_state is not None and
+            (old_journal_state is None or journal_state.inode == old_journal_state.inode) and
+            journal_state.size >= self._journal_length)
+
+        if appended:
+            LOGGER.debug('Reading changes appended to %r', self._journal_file())
+            changes, self._journal_length = read_journal(self._journal_file(), self._journal_length)
+            for change in changes:
+                apply_change(self.data, change)
+            self._num_journaled += len(changes)
+            self._file_state = self._current_file_state()
+        else:
+            LOGGER.debug('Reloading %r', self._data_file)
+            self._load()
+            for change in self._pending:
+                apply_change(self.data, change)
+
+    def commit(self, changes, rewrite):
+        "Write `changes` (already applied to our data) behind, or everything now if we must `rewrite`"
+        self._pending.extend(changes)
+        if rewrite or len(self._pending) >= FLUSH_AFTER:
+            self._flush(rewrite)
+        elif self._timer is None:
+            self._timer = threading.Timer(FLUSH_DELAY, self.flush)
+            self._timer.setDaemon(True)
+            self._timer.start()
+
+    def flush(self):
+        "Write any changes that have not been written"
+        with self._lock:
+            if self._pending:
+                self._flush(rewrite=False)
+
+    def close(self):
+        "Write any changes that have not been written, waiting for the timer to finish"
+        with self._lock:
+            timer = self._timer
+            if self._pending:
+                self._flush(rewrite=False)
+        if timer is not None:
+            timer.join()
+
+    def _flush(self, rewrite):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        with fasteners.InterProcessLock(self._data_file + '.lck'):
+            # A rewrite (e.g. a move) must win over changes made elsewhere since the command started
+            if not rewrite and self._current_file_state() != self._file_state:
+                self._read_changes()
+
+            if rewrite or self._num_journaled + len(self._pending) > COMPACT_AFTER:
+                self.data['generation'] = write_snapshot(self._data_file, self.data)
+                self._num_journaled = self._journal_length = 0
+            else:
+                self._journal_length = append_journal(
+                    self._data_file, self.data.get('generation', 0), self._journal_length, self._pending)
+                self._num_journaled += len(self._pending)
+
+            self._pending = []
+            self._file_state = self._current_file_state()
+
+class ResidentShard(object):
+    "A command's use of `ResidentData` (like a `DiskShard`)"
+    def __init__(self, resident, read_only):
+        self._resident = resident
+        self._read_only = read_only
+        self.data = resident.data
+        self.changes = []
+        self.rewrite = False
+
+    def save(self):
+        if self.changes or self.rewrite:
+            self._resident.commit(self.changes, self.rewrite)
+
+    def close(self):
+        if not self._read_only:
+            self._resident.release()
+
+class ResidentShards(object):
+    """`ResidentData` for each shard used by the daemon, and the catalog, which
+    is read again only when its file changes"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._shards = {}
+        self._catalogs = {}
+
+    def _catalog(self, directory):
+        catalog_file = os.path.join(directory, CATALOG_FILE)
+        with self._lock:
+            state = file_state(catalog_file)
+            if directory not in self._catalogs or self._catalogs[directory][0] != state:
+                LOGGER.debug('Reading %r', catalog_file)
+                self._catalogs[directory] = state, read_catalog(directory)
+            return self._catalogs[directory][1]
+
+    def _open_shard(self, data_file, read_only):
+        with self._lock:
+            if data_file not in self._shards:
+                if read_only and not os.path.exists(os.path.dirname(data_file)):
+                    # Keep no state for counters that do not exist
+                    return DiskShard(data_file, read_only)
+                self._shards[data_file] = ResidentData(data_file)
+            shard = self._shards[data_file]
+        return shard.open(read_only)
+
+    def call(self, function, options):
+        "Call `function` with a `Counter` for the counters for `options`, and the options"
+        read_only = options.command in READ_ONLY_COMMANDS
+        open_shard = lambda data_file: self._open_shard(data_file, read_only)
+        migrate_data_file(options.config_dir)
+        catalog = self._catalog(options.config_dir)
+        with open_counters(options.config_dir, read_only, open_shard, catalog) as counter:
+            return function(counter, options)
+
+    def flush(self):
+        for shard in self._shards.values():
+            shard.flush()
+
+    def close(self):
+        for shard in self._shards.values():
+            shard.close()
 
 class TestCounter(unittest.TestCase):
     def setUp(self):
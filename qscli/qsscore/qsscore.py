@@ -45,7 +45,8 @@ def build_parser():
 
     store.add_parsers(parsers)
 
-    parsers.add_parser('daemon', help='Run a daemon')
+    daemon_command = parsers.add_parser('daemon', help='Run a daemon')
+    ipc.add_daemon_arguments(daemon_command)
 
     records_command = parsers.add_parser('records', help='Display when all time bests were obtained')
     records_command.add_argument('--json', action='store_true', help='Output results in machine readable json', default=False)
@@ -129,7 +130,9 @@ def run(options, stdin):
         os.mkdir(options.config_dir)
 
     if options.command == 'daemon':
-        return ipc.run_server(build_parser(), lambda more_options: run(more_options, stdin))
+        return ipc.run_server(
+            build_parser(), lambda more_options: run(more_options, stdin),
+            socket_path=options.socket, idle_timeout=options.idle_timeout, stats_file=options.stats_file)
 
     data_file = os.path.join(options.config_dir, 'data.jsdb')
 
@@ -1,7 +1,5 @@
 "Store timeseries using qstimeseries"
 
-import itertools
-import json
 import subprocess
 import logging
 
@@ -23,9 +21,8 @@ class TimeSeriesStore(GenericTimeseriesStore):
 
     def get_timeseries(self, metric_data):
         metric_name = metric_data['name']
-        raw_result = self.timeseries('show', '--series', metric_name, '--json')
-        LOGGER.debug('RAW RESULT %r', raw_result)
-        series_entries = json.loads(raw_result)
+        series_entries = self.call('show', series=metric_name)
+        LOGGER.debug('RAW RESULT %r', series_entries)
         return [DataPoint(time=entry['time'], value=entry['value'], id=entry['id']) for entry in series_entries]
 
     def get_raw_values(self, metric_data):
@@ -38,7 +35,7 @@ class TimeSeriesStore(GenericTimeseriesStore):
         return [d.value for d in self.get_timeseries(metric_data)]
 
     def store(self, metric_data, time, value):
-        return self.timeseries('append', '--time', time, metric_data['name'], value)
+        return self.call('append', time=time, series=metric_data['name'], value=str(value))
 
     def check_if_empty(self, metric_data):
         values = self.get_timeseries(metric_data)
@@ -52,39 +49,37 @@ class TimeSeriesStore(GenericTimeseriesStore):
             index = -1
 
         if index:
-            return json.loads(self.timeseries('show', '--series', metric_data['name'], '--index', index, '--json'))[0]['value']
+            return self.call('show', series=metric_data['name'], index=[index])[0]['value']
         else:
-            raw_json = self.timeseries('show', '--series', metric_data['name'], '--id', ident, '--json')
-            print 'Raw result', raw_json
-            return json.loads(raw_json)[0]['value']
+            entries = self.call('show', series=metric_data['name'], id=[ident])
+            return entries[0]['value']
 
-    def timeseries(self, *args):
+    def client(self):
         if self._client is None:
             debug_flags = ['--debug'] if self._debug else []
-            self._client = ipc.CliClient(['qstimeseries'] + debug_flags + ['--config-dir', self._config_dir, 'daemon'])
+            self._client = ipc.CliClient(
+                ['qstimeseries'] + debug_flags + ['--config-dir', self._config_dir, 'daemon'],
+                socket_path=ipc.socket_path('qstimeseries', self._config_dir))
             self._client.initialize()
-        self._client.run(map(str, args))
+        return self._client
+
+    def call(self, method, **params):
+        return self.client().call(method, **params)
 
     def get_has_ids(self, metric_data):
         return any(not entry.id.startswith('internal--') for entry in self.get_timeseries(metric_data))
 
     def update(self, metric_data, value, ident, time=None):
-        if time:
-            time_args = ['--time', time]
-        else:
-            time_args = []
-
-        self.timeseries('append', metric_data['name'], '--id', ident, '--update', value, *time_args)
+        self.call('append', series=metric_data['name'], id=str(ident), update=True, value=str(value), time=time or None)
 
     def update_ids(self, metric_data, values_by_id):
-        for ident, value in values_by_id.items():
-            LOGGER.debug('Setting %r %r %r', metric_data, value, ident)
-            self.update(metric_data, value, ident)
+        LOGGER.debug('Setting %r %r', metric_data, values_by_id)
+        self.call('append-many', update=True, record=[
+            dict(series=metric_data['name'], id=str(ident), value=str(value))
+            for ident, value in values_by_id.items()])
 
     def delete_ids(self, metric_data, ids):
-        id_args = list(itertools.chain.from_iterable([('--id', ident) for ident in ids]))
-        print 'ID_ARGS', id_args, ids
-        self.timeseries('show', '--series', metric_data['name'], '--delete',  *id_args)
+        self.call('delete-many', record=[dict(series=metric_data['name'], id=str(ident)) for ident in ids])
 
 
 def shell_collect(command):
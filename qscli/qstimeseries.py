@@ -8,16 +8,20 @@ qstimeseries append stringseries --string "this is a string value"
 """
 
 import argparse
-import calendar
+import array
 import collections
+import csv
 import datetime
+import itertools
 import json
 import logging
+import math
 import os
 import sqlite3
+import struct
 import sys
+import threading
 import time
-import pytz
 
 from . import sqlexp
 from . import ipc
@@ -28,32 +32,227 @@ DEFAULT_CONFIG_DIR = os.path.join(os.environ['HOME'], '.config', 'qstimeseries')
 
 IdentUnion = collections.namedtuple('IdentUnion', 'native_id given_id')
 
-def ensure_database(config_dir):
+# In write-ahead log mode readers and a writer do not block each other. New databases use it.
+#   (The journal mode is stored in the database, and wal does not work over network filesystems)
+JOURNAL_MODES = ('wal', 'delete', 'truncate', 'persist')
+NEW_JOURNAL_MODE = 'wal'
+# normal is durable in wal mode except on power loss, when the last commits may be lost
+SYNCHRONOUS_MODES = ('off', 'normal', 'full', 'extra')
+DEFAULT_SYNCHRONOUS = 'normal'
+# Seconds to wait for another process's write to finish before giving up
+DEFAULT_BUSY_TIMEOUT = 10.0
+# Values deleted in each transaction by compact
+COMPACT_BATCH_SIZE = 1000
+
+# Rollups: the count, sum, min and max of the (float) values of a series in each period
+#   of a given length (see `enable_rollups`). These are kept up to date by triggers.
+#   Removing a value only needs to look at the period's values if it was the min or max.
+#   (The triggers avoid ON CONFLICT clauses, which the statement firing them would override.)
+
+# The rowids of the rollup_values for `row` of timeseries. (A CROSS JOIN makes
+#   sqlite look up each rollup's period rather than scan the series' periods)
+ROLLUP_STARTS = '''
+    SELECT rollup_values.rowid FROM rollups CROSS JOIN rollup_values
+    ON rollup_values.series = rollups.series AND rollup_values.period = rollups.period
+    AND rollup_values.start = CAST({row}.time AS INTEGER) / rollups.period * rollups.period
+    WHERE rollups.series = {row}.series
+'''
+
+ROLLUP_PERIOD_VALUES = '''
+    SELECT {function}(float_value) FROM timeseries WHERE series = rollup_values.series
+    AND time >= rollup_values.start AND time < rollup_values.start + rollup_values.period
+'''
+
+def add_to_rollups(row):
+    return '''
+    INSERT INTO rollup_values(series, period, start, count, sum, min, max)
+    SELECT series, period, CAST({row}.time AS INTEGER) / period * period, 0, 0, {row}.float_value, {row}.float_value
+    FROM rollups WHERE series = {row}.series AND {row}.float_value IS NOT NULL AND NOT EXISTS (
+        SELECT 1 FROM rollup_values WHERE rollup_values.series = rollups.series AND rollup_values.period = rollups.period
+        AND rollup_values.start = CAST({row}.time AS INTEGER) / rollups.period * rollups.period);
+
+    UPDATE rollup_values SET
+        count = count + 1, sum = sum + {row}.float_value,
+        min = min(min, {row}.float_value), max = max(max, {row}.float_value)
+    WHERE {row}.float_value IS NOT NULL AND rowid IN ({starts});
+    '''.format(row=row, starts=ROLLUP_STARTS.format(row=row))
+
+# The time before which the values of the series of `row` have been compacted into rollups
+#   (see `compact_batches`)
+COMPACTED_UNTIL = 'coalesce((SELECT compacted_until FROM retention WHERE series = {row}.series), 0)'
+
+def remove_from_rollups(row, compacted=False):
+    "If `compacted`, values that have been compacted are deleted but stay in the rollups"
+    kept = ' AND {row}.time >= {compacted_until}'.format(row=row, compacted_until=COMPACTED_UNTIL.format(row=row)) if compacted else ''
+    return '''
+    UPDATE rollup_values SET
+        count = count - 1, sum = sum - {row}.float_value,
+        min = CASE WHEN {row}.float_value > min THEN min ELSE ({period_min}) END,
+        max = CASE WHEN {row}.float_value < max THEN max ELSE ({period_max}) END
+    WHERE {row}.float_value IS NOT NULL{kept} AND rowid IN ({starts});
+
+    DELETE FROM rollup_values WHERE count = 0{kept} AND rowid IN ({starts});
+    '''.format(
+        row=row, starts=ROLLUP_STARTS.format(row=row), kept=kept,
+        period_min=ROLLUP_PERIOD_VALUES.format(function='min'), period_max=ROLLUP_PERIOD_VALUES.format(function='max'))
+
+# Values replaced by INSERT OR REPLACE (append --update) are only removed with recursive_triggers
+ROLLUP_TRIGGERS = (
+    'CREATE TRIGGER timeseries_rollup_insert AFTER INSERT ON timeseries BEGIN {} END;'.format(add_to_rollups('NEW')),
+    'CREATE TRIGGER timeseries_rollup_delete AFTER DELETE ON timeseries BEGIN {} END;'.format(remove_from_rollups('OLD')),
+    'CREATE TRIGGER timeseries_rollup_update AFTER UPDATE ON timeseries BEGIN {} {} END;'.format(
+        remove_from_rollups('OLD'), add_to_rollups('NEW')),
+    )
+
+# Retention: series whose values before `compacted_until` have been deleted, leaving only the
+#   rollup of their means over `period`. Values older than `raw` seconds are compacted
+RETENTION_TRIGGERS = (
+    'DROP TRIGGER timeseries_rollup_delete;',
+    'DROP TRIGGER timeseries_rollup_update;',
+    'CREATE TRIGGER timeseries_rollup_delete AFTER DELETE ON timeseries BEGIN {} END;'.format(remove_from_rollups('OLD', compacted=True)),
+    'CREATE TRIGGER timeseries_rollup_update AFTER UPDATE ON timeseries BEGIN {} {} END;'.format(
+        remove_from_rollups('OLD', compacted=True), add_to_rollups('NEW')),
+    )
+
+# The values of the timeseries table, with the compacted values of series replaced by their
+#   mean over each period of their retention. Queries read this when there are compacted series
+VALUES_VIEW = '''
+    CREATE VIEW timeseries_values AS
+    SELECT timeseries.id, timeseries.series, given_ident, time, float_value, string_value FROM timeseries
+    LEFT JOIN retention ON retention.series = timeseries.series
+    WHERE retention.compacted_until IS NULL OR time >= retention.compacted_until
+    UNION ALL
+    SELECT NULL, rollup_values.series, NULL, start, sum / count, NULL FROM retention
+    JOIN rollup_values ON rollup_values.series = retention.series AND rollup_values.period = retention.period
+    WHERE start < retention.compacted_until
+'''
+
+# Changes to the schema, in order: sql statements (or tuples of them). The schema version of
+#   a database (its user_version) is the number of these that have been applied to it.
+#   Databases from before we had versions are version 0 but already have the table.
+MIGRATIONS = [
+    '''
+    CREATE TABLE IF NOT EXISTS timeseries(id INTEGER PRIMARY KEY, series TEXT NOT NULL, given_ident TEXT, time TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL, float_value REAL, string_value TEXT,
+
+    CONSTRAINT unique_ident UNIQUE (series, given_ident)
+
+    );
+    ''',
+    # Showing a series in time order should not scan and sort every series
+    'CREATE INDEX timeseries_series_time ON timeseries(series, time);',
+    'CREATE INDEX timeseries_series_id ON timeseries(series, id);',
+    # Store times as unix time rather than text, so that they need not be parsed
+    (
+        '''
+        CREATE TABLE timeseries_epoch(id INTEGER PRIMARY KEY, series TEXT NOT NULL, given_ident TEXT, time REAL DEFAULT ((julianday('now') - 2440587.5) * 86400.0) NOT NULL, float_value REAL, string_value TEXT,
+
+        CONSTRAINT unique_ident UNIQUE (series, given_ident)
+
+        );
+        ''',
+        '''
+        INSERT INTO timeseries_epoch(id, series, given_ident, time, float_value, string_value)
+        SELECT id, series, given_ident, CAST(strftime('%s', time) AS REAL), float_value, string_value FROM timeseries;
+        ''',
+        'DROP TABLE timeseries;',
+        'ALTER TABLE timeseries_epoch RENAME TO timeseries;',
+        'CREATE INDEX timeseries_series_time ON timeseries(series, time);',
+        'CREATE INDEX timeseries_series_id ON timeseries(series, id);',
+    ),
+    (
+        'CREATE TABLE rollups(series TEXT NOT NULL, period INTEGER NOT NULL, PRIMARY KEY (series, period));',
+        '''
+        CREATE TABLE rollup_values(series TEXT NOT NULL, period INTEGER NOT NULL, start INTEGER NOT NULL, count INTEGER NOT NULL, sum REAL NOT NULL, min REAL, max REAL,
+
+        CONSTRAINT unique_start UNIQUE (series, period, start)
+
+        );
+        ''',
+    ) + ROLLUP_TRIGGERS,
+    (
+        'CREATE TABLE retention(series TEXT PRIMARY KEY, raw INTEGER, period INTEGER NOT NULL, compacted_until INTEGER NOT NULL DEFAULT 0);',
+        VALUES_VIEW,
+    ) + RETENTION_TRIGGERS,
+    ]
+
+def ensure_database(config_dir, read_only=False, journal_mode=None, synchronous=DEFAULT_SYNCHRONOUS, busy_timeout=DEFAULT_BUSY_TIMEOUT):
+    """Connect to the database in `config_dir`, creating or migrating it if needed.
+    Connections that are `read_only` refuse to change anything. Statements wait
+    up to `busy_timeout` seconds for other processes' writes. Changing the `journal_mode`
+    of an existing database needs other connections to be closed"""
     if not os.path.isdir(config_dir):
         os.mkdir(config_dir)
 
-    data_file = os.path.join(config_dir, 'data.sqlite')
-    if not os.path.exists(data_file):
+    db = sqlite3.connect(os.path.join(config_dir, 'data.sqlite'), timeout=busy_timeout)
+    db.execute('PRAGMA recursive_triggers = ON')
+    if schema_version(db) == 0 and not db.execute("SELECT 1 FROM sqlite_master WHERE name = 'timeseries'").fetchone():
+        # A new database (rather than one from before schema versions, which keeps its journal mode).
+        # So that space freed by compact can be returned without rewriting the database
+        db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        if journal_mode is None:
+            journal_mode = NEW_JOURNAL_MODE
+    if journal_mode is not None and db.execute('PRAGMA journal_mode').fetchone()[0] != journal_mode:
+        db.execute('PRAGMA journal_mode = {}'.format(journal_mode))
+    if synchronous is not None:
+        db.execute('PRAGMA synchronous = {}'.format(synchronous))
+    migrate(db)
+    if read_only:
+        db.execute('PRAGMA query_only = ON')
+    return db
+
+def database_settings(options):
+    "The arguments for `ensure_database` given on the command line"
+    return dict(journal_mode=options.journal_mode, synchronous=options.synchronous, busy_timeout=options.busy_timeout)
+
+def is_locked(error):
+    return isinstance(error, sqlite3.OperationalError) and 'locked' in str(error)
+
+def retry_locked(db, function, timeout=DEFAULT_BUSY_TIMEOUT):
+    """Call `function` until `db` is not locked or `timeout` seconds have passed, rolling
+    back what it did each time. sqlite gives up immediately rather than wait when waiting
+    could deadlock"""
+    deadline = time.time() + timeout
+    delay = 0.01
+    while True:
         try:
-            LOGGER.debug('Creating database')
-            db = sqlite3.connect(data_file)
-            cursor = db.cursor()
-            cursor.execute('''
-            CREATE TABLE timeseries(id INTEGER PRIMARY KEY, series TEXT NOT NULL, given_ident TEXT, time TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL, float_value REAL, string_value TEXT,
-
-            CONSTRAINT unique_ident UNIQUE (series, given_ident)
-
-            );
-            ''')
-            db.commit()
-            return db
+            return function()
+        except sqlite3.OperationalError as error:
+            if not is_locked(error):
+                raise
+            db.rollback()
+            if time.time() + delay > deadline:
+                raise
+            LOGGER.debug('Database locked, retrying in %.2fs', delay)
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+def schema_version(db):
+    version, = db.execute('PRAGMA user_version').fetchone()
+    return version
+
+def migrate(db):
+    "Apply any `MIGRATIONS` that have not been applied to `db`"
+    if schema_version(db) == len(MIGRATIONS):
+        return
+
+    isolation_level = db.isolation_level
+    db.isolation_level = None # We start our own transaction
+    try:
+        # Other processes may be migrating too
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            version = schema_version(db)
+            for new_version, migration in enumerate(MIGRATIONS[version:], version + 1):
+                LOGGER.debug('Migrating database to version %r', new_version)
+                for statement in (migration if isinstance(migration, tuple) else (migration,)):
+                    db.execute(statement)
+                db.execute('PRAGMA user_version = {:d}'.format(new_version))
+            db.execute('COMMIT')
         except:
-            os.unlink(data_file)
+            db.execute('ROLLBACK')
             raise
-    else:
-        LOGGER.debug('Database already exists')
-
-    return sqlite3.connect(data_file)
+    finally:
+        db.isolation_level = isolation_level
 
 def append(db, series, value_string, value_type, ident, time_value, update):
     if ident and ident.native_id is not None:
@@ -70,8 +269,7 @@ def append(db, series, value_string, value_type, ident, time_value, update):
     query.insert_field('series', series)
     query.insert_field(value_field, value)
     query.insert_field('given_ident', ident and ident.given_id)
-    if time_value is not None:
-        query.insert_field_expression('time', "datetime(?, 'unixepoch')", time_value)
+    query.insert_field('time', time.time() if time_value is None else time_value)
     cursor = db.cursor()
     try:
         cursor.execute(query.query(), query.values())
@@ -81,9 +279,250 @@ def append(db, series, value_string, value_type, ident, time_value, update):
         raise
     db.commit()
 
-def get_values(db, series, ids=None):
+def append_many(db, records, value_type, update):
+    """Add values from dictionaries with a series, value and optionally a time and id, in one
+    transaction. Returns the number of values added"""
+    now = time.time()
+    rows = []
+    for record in records:
+        ident = parse_ident(record.get('id') and str(record['id']))
+        if ident.native_id is not None:
+            raise Exception('internal-- ids reserved for internal assignment')
+        value = value_type(record['value'])
+        rows.append((
+            record['series'], ident.given_id, float(record.get('time') or now),
+            value if value_type is float else None, value if value_type is str else None))
+
+    action = 'INSERT OR REPLACE' if update else 'INSERT'
+    with db:
+        db.executemany(
+            '{} INTO timeseries(series, given_ident, time, float_value, string_value) VALUES (?, ?, ?, ?, ?)'.format(action),
+            rows)
+    return len(rows)
+
+def delete_many(db, records):
+    "Delete values given by dictionaries with a series and id, in one transaction. Returns the number deleted"
+    given_ids = []
+    native_ids = []
+    for record in records:
+        ident = parse_ident(str(record['id']))
+        if ident.native_id is not None:
+            native_ids.append((record['series'], ident.native_id))
+        else:
+            given_ids.append((record['series'], ident.given_id))
+
+    deleted = 0
+    with db:
+        for query, rows in (
+                ('DELETE FROM timeseries WHERE series = ? AND given_ident = ?', given_ids),
+                ('DELETE FROM timeseries WHERE series = ? AND id = ?', native_ids)):
+            if rows:
+                deleted += db.executemany(query, rows).rowcount
+    return deleted
+
+def enable_rollups(db, series, periods):
+    """Keep rollups of `series` for periods of these lengths (in seconds), starting with the values
+    it has. (Rollups of values that have been compacted are kept)"""
+    with db:
+        compacted_until = get_compacted_until(db, series)
+        for period in periods:
+            kept_until = compacted_until // period * period
+            db.execute('INSERT OR IGNORE INTO rollups(series, period) VALUES (?, ?)', (series, period))
+            db.execute('DELETE FROM rollup_values WHERE series = ? AND period = ? AND start >= ?', (series, period, kept_until))
+            db.execute('''
+            INSERT INTO rollup_values(series, period, start, count, sum, min, max)
+            SELECT series, :period, CAST(time AS INTEGER) / :period * :period AS start,
+                count(float_value), sum(float_value), min(float_value), max(float_value)
+            FROM timeseries WHERE series = :series AND float_value IS NOT NULL AND time >= :kept_until GROUP BY start
+            ''', dict(series=series, period=period, kept_until=kept_until))
+
+def disable_rollups(db, series, periods=None):
+    "Stop keeping rollups of `series` for periods of these lengths (or any)"
+    for retention_series, _raw, period, compacted_until in get_retention(db, series):
+        if compacted_until and (periods is None or period in periods):
+            raise ValueError('{} has been compacted to its rollup for {}'.format(series, period_string(period)))
+
+    with db:
+        for table in ('rollups', 'rollup_values'):
+            if periods is None:
+                db.execute('DELETE FROM {} WHERE series = ?'.format(table), (series,))
+            else:
+                db.executemany('DELETE FROM {} WHERE series = ? AND period = ?'.format(table), [(series, period) for period in periods])
+
+def get_rollups(db, series=None):
+    "(series, period) for each rollup (of `series`)"
+    query = sqlexp.Query(action='SELECT', table='rollups', fields=('series', 'period'))
+    if series is not None:
+        query.where_equals('series', series)
+    query.order('series, period')
+    return execute(db, query.query(), query.values())
+
+def rollup(db, action, series, periods):
+    if action == 'list':
+        return ''.join('{} {}\n'.format(rollup_series, period_string(period)) for rollup_series, period in get_rollups(db, series)),
+
+    if series is None:
+        raise ValueError('{} needs a series'.format(action))
+
+    if action == 'enable':
+        if not periods:
+            raise ValueError('enable needs --periods')
+        enable_rollups(db, series, periods)
+    elif action == 'disable':
+        disable_rollups(db, series, periods)
+    else:
+        raise ValueError(action)
+
+def get_retention(db, series=None):
+    "(series, raw, period, compacted_until) for each retention policy (for `series`)"
+    query = sqlexp.Query(action='SELECT', table='retention', fields=('series', 'raw', 'period', 'compacted_until'))
+    if series is not None:
+        query.where_equals('series', series)
+    query.order('series')
+    return execute(db, query.query(), query.values())
+
+def get_compacted_until(db, series):
+    for _series, _raw, _period, compacted_until in get_retention(db, series):
+        return compacted_until
+    return 0
+
+def set_retention(db, series, raw, period):
+    """Keep the values of `series` for `raw` seconds, after which `compact` deletes them
+    leaving their means over each `period`"""
+    for _series, _raw, old_period, compacted_until in get_retention(db, series):
+        if compacted_until and period != old_period:
+            raise ValueError('{} has already been compacted to periods of {}'.format(series, period_string(old_period)))
+
+    enable_rollups(db, series, [period])
+    with db:
+        db.execute('INSERT OR IGNORE INTO retention(series, period) VALUES (?, ?)', (series, period))
+        db.execute('UPDATE retention SET raw = ?, period = ? WHERE series = ?', (raw, period, series))
+
+def remove_retention(db, series):
+    "Stop compacting `series`. Values that have already been compacted stay compacted"
+    with db:
+        db.execute('UPDATE retention SET raw = NULL WHERE series = ?', (series,))
+        db.execute('DELETE FROM retention WHERE series = ? AND compacted_until = 0', (series,))
+
+def retention(db, action, series, raw, period):
+    if action == 'list':
+        lines = []
+        for retention_series, raw, period, compacted_until in get_retention(db, series):
+            lines.append('{} raw {} period {}{}\n'.format(
+                retention_series, period_string(raw) if raw is not None else 'forever', period_string(period),
+                ' compacted until {}'.format(datetime.datetime.utcfromtimestamp(compacted_until).isoformat()) if compacted_until else ''))
+        return ''.join(lines),
+
+    if series is None:
+        raise ValueError('{} needs a series'.format(action))
+
+    if action == 'set':
+        if raw is None or period is None:
+            raise ValueError('set needs --raw and --period')
+        set_retention(db, series, raw, period)
+    elif action == 'remove':
+        remove_retention(db, series)
+    else:
+        raise ValueError(action)
+
+def compact_batches(db, now=None, batch_size=COMPACT_BATCH_SIZE):
+    """Delete the values that retention policies no longer keep, leaving their rollups, in
+    transactions of `batch_size` values. Yields the number of values deleted by each
+    transaction, then frees their space if the database uses incremental vacuuming"""
+    now = time.time() if now is None else now
+    for series, raw, period, compacted_until in get_retention(db):
+        if raw is not None:
+            horizon = int(now - raw) // period * period
+            if horizon > compacted_until:
+                # Values are hidden (and stop being removed from rollups when deleted) at once
+                with db:
+                    db.execute('UPDATE retention SET compacted_until = ? WHERE series = ?', (horizon, series))
+                compacted_until = horizon
+
+        while True:
+            with db:
+                deleted = db.execute('''
+                DELETE FROM timeseries WHERE id IN (SELECT id FROM timeseries WHERE series = ? AND time < ? LIMIT ?)
+                ''', (series, compacted_until, batch_size)).rowcount
+            LOGGER.debug('Compacted %r values of %r', deleted, series)
+            yield deleted
+            if deleted < batch_size:
+                break
+
+    reclaim_space(db)
+
+def reclaim_space(db, vacuum=False):
+    """Return unused pages of the database to the file system. If `vacuum`, rewrite the
+    database (which lets older databases vacuum incrementally from then on)"""
+    if vacuum:
+        db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        db.execute('VACUUM')
+    elif db.execute('PRAGMA auto_vacuum').fetchone()[0] == 2: # incremental
+        db.execute('PRAGMA incremental_vacuum').fetchall()
+
+def values_table(db, series):
+    """The table of values to read for `series` (or every series): the timeseries table,
+    or a view with the values that have been compacted. (The view's rows can only be
+    ordered by sorting them, but compacted series are kept small)"""
+    query = sqlexp.Query(action='SELECT', table='retention', fields=('1',))
+    query.where('compacted_until > 0')
+    if series is not None:
+        query.where_equals('series', series)
+    query.limit(1)
+    return 'timeseries_values' if execute(db, query.query(), query.values()) else 'timeseries'
+
+def read_records(stream, format, fields):
+    "Read dictionaries from json lines or csv rows of `fields` (skipping a header and empty fields)"
+    if format == 'jsonl':
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+    elif format == 'csv':
+        for row in csv.reader(stream):
+            if not row or row[0] == fields[0]:
+                continue
+            yield dict((field, value) for field, value in zip(fields, row) if value != '')
+    else:
+        raise ValueError(format)
+
+def json_record(value):
+    "A record as json, or already decoded (in typed requests to the daemon)"
+    return value if isinstance(value, dict) else json.loads(value)
+
+def option_records(options, fields):
+    "The records given with --record, or else in the file (or standard in)"
+    if options.records is not None:
+        return options.records
+    else:
+        return read_records(options.file or sys.stdin, options.format, fields)
+
+APPEND_FIELDS = ('series', 'time', 'value', 'id')
+DELETE_FIELDS = ('series', 'id')
+RECORDS_FIELDS = {'append-many': APPEND_FIELDS, 'delete-many': DELETE_FIELDS}
+
+def read_option_records(options):
+    "Read the records for commands that take them, so that the command can be retried"
+    if options.command in RECORDS_FIELDS:
+        options.records = list(option_records(options, RECORDS_FIELDS[options.command]))
+
+def check_daemon_options(options):
+    "Refuse options that the daemon cannot run: reading records from its standard in or exporting to its output"
+    if options.command in RECORDS_FIELDS and options.records is None:
+        raise ValueError('{} needs --record when run by the daemon'.format(options.command))
+    elif options.command == 'export' and not options.output:
+        # The binary columns cannot be sent in json replies
+        raise ValueError('export needs --output when run by the daemon')
+
+# Rows are fetched from sqlite this many at a time
+FETCH_SIZE = 1000
+
+def get_values(db, series, ids=None, since=None, until=None, limit=None, tail=None, index=None):
+    """Yield (time, series, id, value) for values in time order, from the unix time `since`
+    until `until`. Only yield the first `limit` or last `tail` of these, or the one at `index`
+    (counting from the end if negative)"""
     query = sqlexp.Query(
         action='SELECT',
+        table=values_table(db, series),
         fields=('time', 'series', "coalesce(given_ident, 'internal--' || id)", "coalesce(float_value, string_value)"))
 
     if series is not None:
@@ -96,9 +535,30 @@ def get_values(db, series, ids=None):
             if ident.native_id:
                 query.where_equals('id', ident.native_id)
 
-    query.order('time')
+    if since is not None:
+        query.where('time >= ?', since)
+    if until is not None:
+        query.where('time <= ?', until)
 
-    return execute(db, query.query(), query.values())
+    if index is not None:
+        select_index(query, index)
+    else:
+        reverse = tail is not None
+        query.limit(tail if reverse else limit)
+        query.order('time DESC, id DESC' if reverse else 'time, id')
+
+    records = iterate(db, query.query(), query.values())
+    if tail is not None and index is None:
+        return reversed(list(records))
+    else:
+        return records
+
+def select_index(query, index):
+    "Select only the entry at `index` in time order (counting from the end if negative)"
+    reverse = index < 0
+    query.limit(1)
+    query.offset(-index - 1 if reverse else index)
+    query.order('time DESC, id DESC' if reverse else 'time, id')
 
 def execute(db, query, values):
     cursor = db.cursor()
@@ -106,44 +566,151 @@ def execute(db, query, values):
     LOGGER.debug('Running %r %r', query, values)
     return cursor.fetchall()
 
-def only_show_indexes(iterable, indexes):
-    if any(index < 0 for index in indexes):
-        items = list(iterable)
-        for index in indexes:
-            yield items[index]
+def iterate(db, query, values):
+    "Like `execute` but yield the rows as they are fetched"
+    LOGGER.debug('Running %r %r', query, values)
+    cursor = db.execute(query, values)
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            yield row
+
+def show_values(db, options):
+    "The values selected by the options for `show`"
+    ranges = dict(since=options.since, until=options.until, limit=options.limit, tail=options.tail)
+    if options.index is None:
+        return get_values(db, options.series, ids=options.ident, **ranges)
     else:
-        for index, x in enumerate(iterable):
-            if index in indexes:
-                yield x
-
-def show(db, series, ids, json_output, indexes=None):
-    records = get_values(db, series, ids=ids)
-    records = only_show_indexes(records, indexes) if indexes is not None else records
-    if not json_output:
-        result = []
-        for time_string, series, ident, value in records:
+        return itertools.chain.from_iterable(
+            get_values(db, options.series, ids=options.ident, index=index, **ranges)
+            for index in options.index)
+
+def show(db, options):
+    records = show_values(db, options)
+    if not options.json:
+        for unix_time, series, ident, value in records:
             if isinstance(value, (str, unicode)):
                 value = value.strip('\n')
 
-            dt = datetime.datetime.strptime(time_string, '%Y-%m-%d %H:%M:%S')
-            result.append('{} {} {} {}'.format(dt.isoformat(), ident, series, value))
-        return '\n'.join(result),
+            dt = datetime.datetime.utcfromtimestamp(unix_time)
+            yield '{} {} {} {}\n'.format(dt.isoformat(), ident, series, value)
     else:
-        result = []
-        for time_string, series, ident, value in records:
-            dt = pytz.UTC.localize(datetime.datetime.strptime(time_string, '%Y-%m-%d %H:%M:%S'), is_dst=None)
-            unix_time = calendar.timegm(dt.timetuple())
-            result.append(dict(time=unix_time, series=series, id=ident, value=value))
-        return json.dumps(result),
+        yield '['
+        for i, record in enumerate(record_dicts(records)):
+            yield (', ' if i else '') + json.dumps(record)
+        yield ']\n'
+
+def record_dicts(records):
+    for unix_time, series, ident, value in records:
+        yield dict(time=unix_time, series=series, id=ident, value=value)
+
+# export writes the times and then the float values of a series as contiguous columns of
+#   little-endian float64s. npy files hold these as an array of shape (2, count), so can be
+#   read with `numpy.load(path, mmap_mode='r')`. raw files have no header
+EXPORT_FORMATS = ('npy', 'raw')
+NPY_MAGIC = '\x93NUMPY\x01\x00'
+
+def npy_header(shape):
+    "The header of a (version 1.0) npy file of little-endian float64s with this `shape`"
+    header = "{{'descr': '<f8', 'fortran_order': False, 'shape': {!r}, }}".format(tuple(shape))
+    # numpy aligns the data to 64 bytes
+    header += ' ' * (-(len(NPY_MAGIC) + 2 + len(header) + 1) % 64) + '\n'
+    return NPY_MAGIC + struct.pack('<H', len(header)) + header
+
+def float64_bytes(column):
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column.tostring()
+
+def export(db, series, since=None, until=None, format='npy'):
+    """Yield the bytes of the times and then the float values of `series` from the unix
+    time `since` until `until` as float64 columns, in the `format` npy or raw"""
+    table = values_table(db, series)
+    def column_query(fields):
+        query = sqlexp.Query(action='SELECT', table=table, fields=fields)
+        query.where_equals('series', series)
+        query.where('float_value IS NOT NULL')
+        if since is not None:
+            query.where('time >= ?', since)
+        if until is not None:
+            query.where('time <= ?', until)
+        return query
+
+    # The count and columns are read from one snapshot of the database
+    isolation_level = db.isolation_level
+    db.isolation_level = None
+    db.execute('BEGIN')
+    try:
+        query = column_query(('count(*)',))
+        (count,), = execute(db, query.query(), query.values())
+        if format == 'npy':
+            yield npy_header((2, count))
+
+        for field in ('time', 'float_value'):
+            query = column_query((field,))
+            query.order('time, id')
+            column = array.array('d')
+            for value, in iterate(db, query.query(), query.values()):
+                column.append(value)
+                if len(column) == FETCH_SIZE:
+                    yield float64_bytes(column)
+                    column = array.array('d')
+            yield float64_bytes(column)
+    finally:
+        db.execute('COMMIT')
+        db.isolation_level = isolation_level
+
+def write_export(chunks, path):
+    "Write `chunks` to `path`, which is only replaced once they are all written"
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as stream:
+        for chunk in chunks:
+            stream.write(chunk)
+    os.rename(temp_path, path)
+
+def show_method(db, options):
+    if options.delete:
+        return delete(db, options.series, options.ident, indexes=options.index)
+    else:
+        return list(record_dicts(show_values(db, options)))
+
+# Methods for typed requests to the daemon (see `ipc.run_server`)
+METHODS = dict(
+    show=show_method,
+    series=lambda db, options: [name for name in get_series(db) if not options.prefix or name.startswith(options.prefix)],
+    **{
+        'append-many': lambda db, options: append_many(db, option_records(options, APPEND_FIELDS), options.value_type, options.update),
+        'delete-many': lambda db, options: delete_many(db, option_records(options, DELETE_FIELDS)),
+    })
+
+def add_records_arguments(parser, fields, description):
+    parser.add_argument('file', type=argparse.FileType('r'), nargs='?', help='Read from this file (default standard in)')
+    parser.add_argument(
+        '--format', choices=('jsonl', 'csv'), default='jsonl',
+        help='One json object per line with {}, or csv rows of {}'.format(description, ','.join(fields)))
+    parser.add_argument('--record', type=json_record, action='append', dest='records', help='Use this json record rather than reading a file')
 
 def build_parser():
     parser = argparse.ArgumentParser(description='Very simple command line timeseries')
     parser.add_argument('--debug', action='store_true', help='Include debug output (to stderr)')
     parser.add_argument('--config-dir', '-C', help='Directory to store configuration and data')
+    parser.add_argument(
+        '--journal-mode', choices=JOURNAL_MODES,
+        help='Change how sqlite journals changes. wal, used for new databases, lets readers and a writer run at once')
+    parser.add_argument(
+        '--synchronous', choices=SYNCHRONOUS_MODES, default=DEFAULT_SYNCHRONOUS,
+        help='How often sqlite waits for data to reach the disk (default %(default)s)')
+    parser.add_argument(
+        '--busy-timeout', type=float, default=DEFAULT_BUSY_TIMEOUT,
+        help='Seconds to wait for other processes to finish writing (default %(default)s)')
 
     parsers = parser.add_subparsers(dest='command')
 
-    append_command = parsers.add_parser('daemon', help='Start a daemon to run commands')
+    daemon_command = parsers.add_parser('daemon', help='Start a daemon to run commands')
+    ipc.add_daemon_arguments(daemon_command)
+    daemon_command.add_argument('--compact', action='store_true', help='Compact series (see compact) a batch at a time when idle')
 
     append_command = parsers.add_parser('append', help='Add a value')
     append_command.add_argument('series', type=str, help='Timeseries')
@@ -153,6 +720,29 @@ def build_parser():
     append_command.add_argument('--update', action='store_true', help='Update existing values rather than erroring out')
     append_command.add_argument('value', type=str)
 
+    append_many_command = parsers.add_parser('append-many', help='Add many values in one transaction')
+    add_records_arguments(append_many_command, APPEND_FIELDS, 'a series, value, and optionally a time and id')
+    append_many_command.add_argument('--string', action='store_const', dest='value_type', const=str, default=float)
+    append_many_command.add_argument('--update', action='store_true', help='Update existing values rather than erroring out')
+
+    delete_many_command = parsers.add_parser('delete-many', help='Delete many values in one transaction')
+    add_records_arguments(delete_many_command, DELETE_FIELDS, 'a series and id')
+
+    rollup_command = parsers.add_parser('rollup', help='Keep aggregates of a series up to date for aggregate to use')
+    rollup_command.add_argument('action', choices=('enable', 'disable', 'list'))
+    rollup_command.add_argument('series', type=str, nargs='?', help='Which series')
+    rollup_command.add_argument('--periods', type=time_periods, help='Comma separated periods, e.g. 1h,1d (disable defaults to every period)')
+
+    retention_command = parsers.add_parser('retention', help='Only keep the values of a series for so long, and then their means over periods')
+    retention_command.add_argument('action', choices=('set', 'remove', 'list'))
+    retention_command.add_argument('series', type=str, nargs='?', help='Which series')
+    retention_command.add_argument('--raw', type=lambda string: int(time_period(string).total_seconds()), help='Keep values for this long, e.g. 90d')
+    retention_command.add_argument('--period', type=lambda string: int(time_period(string).total_seconds()), help='And then their means over periods of this length, e.g. 1h')
+
+    compact_command = parsers.add_parser('compact', help='Delete values that retention policies no longer keep')
+    compact_command.add_argument('--batch-size', type=int, default=COMPACT_BATCH_SIZE, help='Delete this many values in each transaction (default %(default)s)')
+    compact_command.add_argument('--vacuum', action='store_true', help='Rewrite the database to return all unused space to the file system')
+
     series_command = parsers.add_parser('series', help='List the series')
     series_command.add_argument('--quiet', '-q', action='store_true', help='Only show names')
     series_command.add_argument('--prefix', '-p', type=str, help='Find series with this prefix')
@@ -178,6 +768,18 @@ def build_parser():
     show_command.add_argument('--json', action='store_true', help='Output in machine readable json')
     show_command.add_argument('--index', type=int, help='Only show the INDEX entry', action='append')
     show_command.add_argument('--delete', help='Delete the matches entries', action='store_true')
+    show_command.add_argument('--since', type=float, help='Only show entries from this unix time')
+    show_command.add_argument('--until', type=float, help='Only show entries up to this unix time')
+    show_mutex = show_command.add_mutually_exclusive_group()
+    show_mutex.add_argument('--limit', type=int, help='Only show the first LIMIT entries')
+    show_mutex.add_argument('--tail', type=int, help='Only show the last TAIL entries')
+
+    export_command = parsers.add_parser('export', help='Write the times and float values of a series as binary columns')
+    export_command.add_argument('--series', type=str, help='Export this timeseries', required=True)
+    export_command.add_argument('--format', choices=EXPORT_FORMATS, default='npy', help='npy for numpy.load, or raw float64s (default npy)')
+    export_command.add_argument('--output', '-o', type=str, help='Write to this file (which can be memory-mapped) rather than standard out')
+    export_command.add_argument('--since', type=float, help='Only export entries from this unix time')
+    export_command.add_argument('--until', type=float, help='Only export entries up to this unix time')
 
     delete_parser = parsers.add_parser('delete', help='Delete a value from a timeseries')
     delete_parser.add_argument('series', type=str, help='Which series to delete from')
@@ -191,75 +793,368 @@ PERIODS = {
     'd': datetime.timedelta(days=1),
 }
 
-def mean(lst):
-    return float(sum(lst)) /  len(lst)
-
-def rng(lst):
-    return max(lst) - min(lst)
-
-def display_values(lst):
-    return ' '.join(map(str, lst))
-
-def sorted_values(lst):
-    return ' '.join(map(str, sorted(lst)))
-
+# Aggregators take values with `add` as they are read, without keeping them,
+# `merge` adds in the values added to another aggregator of the same type
+# and `result` returns the aggregate
+
+class Count(object):
+    def __init__(self):
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+
+    def merge(self, other):
+        self.count += other.count
+
+    def result(self):
+        return self.count
+
+class Sum(object):
+    def __init__(self):
+        self.sum = 0
+
+    def add(self, value):
+        self.sum += value
+
+    def merge(self, other):
+        self.sum += other.sum
+
+    def result(self):
+        return self.sum
+
+class Min(object):
+    def __init__(self):
+        self.value = None
+
+    def add(self, value):
+        if self.value is None or value < self.value:
+            self.value = value
+
+    def merge(self, other):
+        if other.value is not None:
+            self.add(other.value)
+
+    def result(self):
+        return self.value
+
+class Max(Min):
+    def add(self, value):
+        if self.value is None or value > self.value:
+            self.value = value
+
+class Range(object):
+    def __init__(self):
+        self.min = Min()
+        self.max = Max()
+
+    def add(self, value):
+        self.min.add(value)
+        self.max.add(value)
+
+    def merge(self, other):
+        self.min.merge(other.min)
+        self.max.merge(other.max)
+
+    def result(self):
+        return self.max.value - self.min.value if self.min.value is not None else None
+
+class Moments(object):
+    "The mean and variance, updated for each value (Welford's method)"
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.squares = 0.0 # Sum of squared differences from the mean
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.squares += delta * (value - self.mean)
+
+    def merge(self, other):
+        count = self.count + other.count
+        if count:
+            delta = other.mean - self.mean
+            self.mean += delta * other.count / count
+            self.squares += other.squares + delta ** 2 * self.count * other.count / count
+            self.count = count
+
+class Mean(Moments):
+    def result(self):
+        return self.mean if self.count else None
+
+class Stddev(Moments):
+    "The population standard deviation"
+    def result(self):
+        return (self.squares / self.count) ** 0.5 if self.count else None
+
+class Quantile(object):
+    """Estimate the `quantile` of values from a t-digest: a sorted list of centroids
+    (means of neighbouring values and their counts) that are kept small for extreme
+    quantiles so that these are accurate. There are at most about `compression` centroids"""
+    quantile = 0.5
+    compression = 100
+    buffer_size = 500
+
+    def __init__(self):
+        self.centroids = []
+        self.buffer = []
+        self.min = Min()
+        self.max = Max()
+
+    def add(self, value):
+        self.buffer.append((value, 1))
+        self.min.add(value)
+        self.max.add(value)
+        if len(self.buffer) >= self.buffer_size:
+            self._compress()
+
+    def merge(self, other):
+        self.buffer.extend(other.centroids + other.buffer)
+        self.min.merge(other.min)
+        self.max.merge(other.max)
+        self._compress()
+
+    def _compress(self):
+        points = sorted(self.centroids + self.buffer)
+        total = float(sum(weight for _, weight in points))
+        # Each centroid covers at most one unit of this scale, which is stretched at the extremes
+        scale = lambda weight: self.compression / (2 * math.pi) * math.asin(2 * min(weight / total, 1.0) - 1)
+        centroids = []
+        before = 0 # Weight of the centroids before the last one
+        for mean, weight in points:
+            if centroids:
+                last_mean, last_weight = centroids[-1]
+                if scale(before + last_weight + weight) - scale(before) <= 1:
+                    centroids[-1] = ((last_mean * last_weight + mean * weight) / (last_weight + weight), last_weight + weight)
+                    continue
+                before += last_weight
+            centroids.append((mean, weight))
+        self.centroids = centroids
+        self.buffer = []
+
+    def result(self):
+        self._compress()
+        if not self.centroids:
+            return None
+
+        # Values are numbered by rank from 0. Centroids are at the mean rank of their values
+        total = sum(weight for _, weight in self.centroids)
+        rank = self.quantile * (total - 1)
+        previous_rank, previous_mean = 0, self.min.result()
+        before = 0
+        for mean, weight in self.centroids + [(self.max.result(), 1)]:
+            centroid_rank = min(before + (weight - 1) / 2.0, total - 1)
+            if rank <= centroid_rank:
+                if centroid_rank == previous_rank:
+                    return mean
+                fraction = (rank - previous_rank) / (centroid_rank - previous_rank)
+                return previous_mean + fraction * (mean - previous_mean)
+            previous_rank, previous_mean = centroid_rank, mean
+            before += weight
+        return self.max.result()
+
+class Median(Quantile):
+    quantile = 0.5
+
+class Percentile90(Quantile):
+    quantile = 0.9
+
+class Percentile99(Quantile):
+    quantile = 0.99
+
+class Values(object):
+    "Display every value (so these are kept)"
+    def __init__(self):
+        self.values = []
+
+    def add(self, value):
+        self.values.append(value)
+
+    def merge(self, other):
+        self.values.extend(other.values)
+
+    def result(self):
+        return ' '.join(map(str, self.values))
+
+class SortedValues(Values):
+    def result(self):
+        return ' '.join(map(str, sorted(self.values)))
+
+# Types of aggregator by name
 AGGREGATION_FUNCTIONS = {
-    'min': min,
-    'max': max,
-    'mean': mean,
-    'rng': rng,
-    'values': display_values,
-    'sorted_values': sorted_values,
+    'min': Min,
+    'max': Max,
+    'mean': Mean,
+    'rng': Range,
+    'count': Count,
+    'sum': Sum,
+    'stddev': Stddev,
+    'median': Median,
+    'p90': Percentile90,
+    'p99': Percentile99,
+    'values': Values,
+    'sorted_values': SortedValues,
 }
 
 def time_period(string):
     time_string, unit = string[:-1], string[-1]
     return int(time_string) * PERIODS[unit]
 
-def get_agg_func(string):
-    return AGGREGATION_FUNCTIONS[string]
+def time_periods(string):
+    "Comma separated periods as seconds"
+    return [int(time_period(period).total_seconds()) for period in string.split(',')]
+
+def period_string(seconds):
+    "A number of seconds as a period for `time_period`"
+    for unit, length in sorted(PERIODS.items(), key=lambda item: item[1], reverse=True):
+        if seconds % length.total_seconds() == 0:
+            return '{}{}'.format(int(seconds // length.total_seconds()), unit)
+    return '{}s'.format(seconds)
+
+# Aggregation functions that sqlite can compute, as sql for a value expression
+SQL_AGGREGATION_FUNCTIONS = {
+    'min': 'min({})',
+    'max': 'max({})',
+    'mean': 'avg({})',
+    'rng': 'max({0}) - min({0})',
+    'count': 'count({})',
+    'sum': 'sum({})',
+}
+
+# Aggregation functions as sql over rollups (see `enable_rollups`)
+ROLLUP_AGGREGATION_FUNCTIONS = {
+    'min': 'min(min)',
+    'max': 'max(max)',
+    'mean': 'sum(sum) / sum(count)',
+    'rng': 'max(max) - min(min)',
+    'count': 'sum(count)',
+    'sum': 'sum(sum)',
+}
 
 def main():
     result = run(sys.argv[1:])
     if result:
-        for x in result:
-            print x,
+        # Output is streamed as it is produced
+        for chunk in result:
+            sys.stdout.write(chunk)
 
 def run(args):
     options = build_parser().parse_args(args)
     if options.command == 'daemon':
-        db = ensure_database(options.config_dir)
-        return ipc.run_server(build_parser(), lambda x: run_options(x, db, options.debug), options.debug)
+        settings = database_settings(options)
+        ensure_database(options.config_dir, **settings)
+
+        # Each thread has its own connections, and reads use a read-only connection
+        databases = threading.local()
+        def thread_database(command_options):
+            read_only = is_read_only(command_options)
+            name = 'reader' if read_only else 'writer'
+            if not hasattr(databases, name):
+                setattr(databases, name, ensure_database(options.config_dir, read_only=read_only, **settings))
+            return getattr(databases, name)
+
+        def run_daemon_command(command_options):
+            check_daemon_options(command_options)
+            return run_options(command_options, thread_database(command_options), options.debug)
+
+        def run_daemon_method(method, command_options):
+            check_daemon_options(command_options)
+            return run_method(method, thread_database(command_options), command_options)
+
+        methods = dict(
+            (name, lambda command_options, method=method: run_daemon_method(method, command_options))
+            for name, method in METHODS.items())
+
+        idle_function = None
+        if options.compact:
+            compact_db = ensure_database(options.config_dir, **settings)
+            batches = [None]
+            def idle_function():
+                "Compact one batch, returning whether there is more to do"
+                if batches[0] is None:
+                    batches[0] = compact_batches(compact_db)
+                if next(batches[0], None) is None:
+                    batches[0] = None
+                    return False
+                return True
+
+        return ipc.run_server(
+            build_parser(), run_daemon_command, options.debug,
+            socket_path=options.socket, idle_timeout=options.idle_timeout, stats_file=options.stats_file,
+            read_only=is_read_only, workers=options.workers, methods=methods, idle_function=idle_function)
     else:
         return run_options(options, None, options.debug)
 
+def is_read_only(options):
+    if options.command == 'show':
+        return not options.delete
+    elif options.command in ('rollup', 'retention'):
+        return options.action == 'list'
+    else:
+        return options.command in ('series', 'aggregate', 'export')
+
+def run_method(method, db, options):
+    if is_read_only(options):
+        return method(db, options)
+    else:
+        read_option_records(options)
+        return retry_locked(db, lambda: method(db, options), options.busy_timeout)
+
 def run_options(options, db, debug):
     if debug:
         logging.basicConfig(level=logging.DEBUG)
 
     if db is None:
-        db = ensure_database(options.config_dir)
+        db = ensure_database(options.config_dir, read_only=is_read_only(options), **database_settings(options))
 
+    if is_read_only(options):
+        return run_command(db, options)
+    else:
+        # Writes run to completion so can be retried
+        read_option_records(options)
+        return retry_locked(db, lambda: run_command(db, options), options.busy_timeout)
 
+def run_command(db, options):
     if options.command == 'append':
         return append(db, options.series, options.value, options.value_type, options.ident, options.time, options.update)
+    elif options.command == 'append-many':
+        return '{}\n'.format(append_many(db, option_records(options, APPEND_FIELDS), options.value_type, options.update)),
+    elif options.command == 'delete-many':
+        return '{}\n'.format(delete_many(db, option_records(options, DELETE_FIELDS))),
     elif options.command == 'show':
 
         if options.delete:
             return delete(db, options.series, options.ident, indexes=options.index)
         else:
-            return show(db, options.series, options.ident, options.json, indexes=options.index)
+            return show(db, options)
 
     elif options.command == 'aggregate':
         return aggregate(
             db, options.series, options.period, options.record_stream,
-            funcs=map(get_agg_func, options.func or ['min']),
+            funcs=options.func or ['min'],
             missing_value=options.missing_value,
             include_missing=options.missing)
+    elif options.command == 'export':
+        chunks = export(db, options.series, options.since, options.until, options.format)
+        if options.output:
+            write_export(chunks, options.output)
+        else:
+            return chunks
     elif options.command == 'delete':
         return delete(db, options.series, options.ident)
     elif options.command == 'series':
         return show_series(db, prefix=options.prefix)
+    elif options.command == 'rollup':
+        return rollup(db, options.action, options.series, options.periods)
+    elif options.command == 'retention':
+        return retention(db, options.action, options.series, options.raw, options.period)
+    elif options.command == 'compact':
+        deleted = sum(compact_batches(db, batch_size=options.batch_size))
+        if options.vacuum:
+            reclaim_space(db, vacuum=True)
+        return '{}\n'.format(deleted),
     else:
         raise ValueError(options.command)
 
@@ -272,7 +1167,7 @@ def aggregate(db, series, period, record_stream, missing_value, include_missing,
         dt_time = time.mktime(dt.timetuple())
         if record_stream:
             value = values[0] if len(values) == 1 else values
-            yield json.dumps(dict(isodate=dt.isoformat(), value=value, series=series, time=dt_time))
+            yield json.dumps(dict(isodate=dt.isoformat(), value=value, series=series, time=dt_time)) + '\n'
         else:
             result = []
             result.append('{} {} '.format(dt, series))
@@ -282,44 +1177,103 @@ def aggregate(db, series, period, record_stream, missing_value, include_missing,
             yield ''.join(result)
 
 EPOCH = datetime.datetime(1970, 1, 1)
-def aggregate_values(db, series, period, agg_funcs, include_empty=False):
-    # Could be done in sql but this would
-    #   be less generalisable
-
-    all_series = get_series(db)
-    group_dt = None
-    group_values = collections.defaultdict(list)
-    for time_string, series, _ident, value in get_values(db, series):
-        dt = datetime.datetime.strptime(time_string, '%Y-%m-%d %H:%M:%S')
-        seconds_since_epoch = (dt - EPOCH).total_seconds() // period.total_seconds() * period.total_seconds()
-        period_dt = EPOCH + datetime.timedelta(seconds=seconds_since_epoch)
-        if period_dt != group_dt:
-            LOGGER.debug('Group values %r %r', period_dt, group_values)
-            for series in sorted(group_values):
-                yield [group_dt, series] + [f(group_values[series]) for f in agg_funcs]
-            group_values = collections.defaultdict(list)
-
-            if include_empty:
-                while True:
-                    if group_dt is None:
-                        break
-
-                    group_dt += period
-                    if group_dt >= period_dt:
-                        break
-
-                    for value_series in all_series:
-                        if series is None or series == value_series:
-                            yield [group_dt, series] + [None] * len(agg_funcs)
-
-            group_dt = period_dt
-
-        group_values[series].append(value)
+def aggregate_values(db, series, period, funcs, include_empty=False):
+    """Yield [start of period, series] followed by the value of each of the aggregation
+    functions named `funcs`, for each series in each period with values.
+    If `include_empty`, also yield None values for series without values in periods between these"""
+    period_seconds = int(period.total_seconds())
+    rollup_period = None
+    if series is not None and all(name in ROLLUP_AGGREGATION_FUNCTIONS for name in funcs):
+        rollup_period = find_rollup_period(db, series, period_seconds)
+
+    if rollup_period is not None:
+        rows = rollup_aggregate_rows(db, series, rollup_period, period_seconds, funcs)
+    elif all(name in SQL_AGGREGATION_FUNCTIONS for name in funcs):
+        rows = sql_aggregate_rows(db, series, period_seconds, funcs)
+    else:
+        rows = python_aggregate_rows(db, series, period_seconds, [AGGREGATION_FUNCTIONS[name] for name in funcs])
+
+    if include_empty:
+        rows = fill_missing_rows(rows, period_seconds, [series] if series is not None else get_series(db), len(funcs))
+
+    for row in rows:
+        yield [EPOCH + datetime.timedelta(seconds=row[0]), row[1]] + list(row[2:])
+
+def sql_aggregate_rows(db, series, period_seconds, funcs):
+    """Rows of (period in unix time, series, values...) ordered by period and series, aggregated by sqlite.
+    Like rollups (see `rollup_aggregate_rows`), only float values are aggregated"""
+    period = 'CAST(time AS INTEGER) / {0:d} * {0:d}'.format(period_seconds)
+    query = sqlexp.Query(
+        action='SELECT',
+        table=values_table(db, series),
+        fields=(period + ' AS period', 'series') + tuple(SQL_AGGREGATION_FUNCTIONS[name].format('float_value') for name in funcs))
+    query.where('float_value IS NOT NULL')
+    if series is not None:
+        query.where_equals('series', series)
+    query.group('series', 'period')
+    query.order('period, series')
+
+    LOGGER.debug('Running %r %r', query.query(), query.values())
+    return db.execute(query.query(), query.values())
+
+def find_rollup_period(db, series, period_seconds):
+    "The longest period of a rollup of `series` that periods of `period_seconds` are made of"
+    periods = [period for _, period in get_rollups(db, series) if period_seconds % period == 0]
+    return max(periods) if periods else None
+
+def rollup_aggregate_rows(db, series, rollup_period, period_seconds, funcs):
+    "Like `sql_aggregate_rows` but from the rollup of `series` for `rollup_period`"
+    query = sqlexp.Query(
+        action='SELECT',
+        table='rollup_values',
+        fields=('start / {0:d} * {0:d} AS bucket'.format(period_seconds), 'series') + tuple(ROLLUP_AGGREGATION_FUNCTIONS[name] for name in funcs))
+    query.where_equals('series', series)
+    query.where_equals('period', rollup_period)
+    query.group('series', 'bucket')
+    query.order('bucket, series')
+
+    LOGGER.debug('Running %r %r', query.query(), query.values())
+    return db.execute(query.query(), query.values())
+
+def python_aggregate_rows(db, series, period_seconds, aggregator_types):
+    """Like `sql_aggregate_rows` for any types of aggregator, which are all computed
+    in one pass over the values"""
+    group_period = None
+    group_aggregators = {}
+    for unix_time, value_series, _ident, value in get_values(db, series):
+        period = int(unix_time) // period_seconds * period_seconds
+        if period != group_period:
+            for name in sorted(group_aggregators):
+                yield [group_period, name] + [aggregator.result() for aggregator in group_aggregators[name]]
+            group_aggregators = {}
+            group_period = period
+
+        if value_series not in group_aggregators:
+            group_aggregators[value_series] = [aggregator_type() for aggregator_type in aggregator_types]
+        for aggregator in group_aggregators[value_series]:
+            aggregator.add(value)
+
+    for name in sorted(group_aggregators):
+        yield [group_period, name] + [aggregator.result() for aggregator in group_aggregators[name]]
+
+def fill_missing_rows(rows, period_seconds, all_series, num_values):
+    "Add rows of None values for `all_series` missing from `rows` between its first and last periods"
+    previous_period = None
+    for period, period_rows in itertools.groupby(rows, key=lambda row: row[0]):
+        if previous_period is not None:
+            for missing_period in xrange(previous_period + period_seconds, period, period_seconds):
+                for name in all_series:
+                    yield [missing_period, name] + [None] * num_values
+
+        rows_by_series = dict((row[1], row) for row in period_rows)
+        for name in sorted(set(all_series) | set(rows_by_series)):
+            yield rows_by_series.get(name, [period, name] + [None] * num_values)
+        previous_period = period
 
 def get_series(db):
     cursor = db.cursor()
     cursor.execute('''
-    SELECT DISTINCT series FROM timeseries ORDER BY 1;
+    SELECT series FROM timeseries UNION SELECT series FROM retention WHERE compacted_until > 0 ORDER BY 1;
     ''')
     return [x for (x,) in cursor.fetchall()]
 
@@ -352,36 +1306,21 @@ def delete(db, series, ids=None, indexes=None):
         cursor.execute(query.query(), query.values())
         db.commit()
     else:
+        # Indexes refer to the entries (in time order, as for `show`) before any are deleted
+        table = values_table(db, series)
+        native_ids = []
         for index in indexes:
-            if index < 0:
-                backwards = index < 0
-                index = -index -1
-            else:
-                index = index
-
-            cursor = db.cursor()
-
-            #values = [series] + ([ident] if ident else [])
-
-            query = sqlexp.Query(action='DELETE')
+            query = sqlexp.Query(action='SELECT', table=table, fields=('id',))
             query.where_equals('series', series)
-            if ident:
-                query.where_equals('given_ident', ident)
+            select_index(query, index)
+            native_ids.extend(native_id for native_id, in execute(db, query.query(), query.values()))
 
-            query.order('id', reverse=backwards)
-            query.offset(index)
-            query.limit(1)
-
-            cursor.execute(query.query(), query.values())
-            db.commit()
+        with db:
+            db.executemany('DELETE FROM timeseries WHERE id = ?', [(native_id,) for native_id in native_ids])
 
 def show_series(db, prefix=None):
-    cursor = db.cursor()
-    cursor.execute('''
-    SELECT series FROM timeseries GROUP BY 1 ORDER BY 1
-    ''')
     result = []
-    for name, in cursor.fetchall():
+    for name in get_series(db):
         if prefix:
             if not name.startswith(prefix):
                 continue
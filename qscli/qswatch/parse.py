@@ -25,7 +25,9 @@ def run(data_dir, time_mod, stdout, args):
 
     if options.command == 'daemon':
         watch = qswatch.Watch(data_dir, time_mod)
-        ipc.run_server(PARSER, lambda options: watch_run(watch, options))
+        ipc.run_server(
+            PARSER, lambda command_options: watch_run(watch, command_options),
+            socket_path=options.socket, idle_timeout=options.idle_timeout, stats_file=options.stats_file)
     else:
         watch = qswatch.Watch(data_dir, time_mod)
         for part in watch_run(watch, options):
@@ -97,7 +99,8 @@ def build_parser():
     parser.add_argument('--debug', action='store_true', help='Print debug output')
     daemon = parsers.add_parser(
         'daemon',
-        help='Run in a daemon mode. Commands are read from stdin, response written to stdout as json')
+        help='Run in a daemon mode. Commands are read from stdin (or a socket), response written to stdout as json')
+    ipc.add_daemon_arguments(daemon)
 
     toggle = parsers.add_parser('toggle', help='Stop or start the stopwatch')
     toggle.add_argument('clock', type=str, nargs='?', default=DEFAULT_CLOCK)
@@ -30,6 +30,7 @@ class Query(object):
                 raise Exception('Cannot delete with fields')
 
         self.order_key = None
+        self.group_keys = ()
         self._offset = None
         self._limit = None
 
@@ -65,6 +66,9 @@ class Query(object):
         self.conditions.append(condition)
         self.where_values.extend(values)
 
+    def group(self, *keys):
+        self.group_keys = keys
+
     def order(self, key, reverse=False):
         if reverse:
             self.order_key = '{} DESC'.format(key)
@@ -82,27 +86,33 @@ class Query(object):
         else:
             condition_string = ''
 
+        if self.group_keys:
+            group_string = 'GROUP BY {}'.format(', '.join(self.group_keys))
+        else:
+            group_string = ''
+
         if self.order_key:
             order_string = 'ORDER BY {}'.format(self.order_key)
         else:
             order_string = ''
 
-        if self._limit:
+        if self._limit is not None:
             limit_string = 'LIMIT {}'.format(self._limit)
         else:
             limit_string = ''
 
-        if self._offset:
+        if self._offset is not None:
             offset_string = 'OFFSET {}'.format(self._offset)
         else:
             offset_string = ''
 
         if self.action in ('SELECT', 'DELETE'):
-            return '''{action} {field_string} FROM {table} {condition_string} {order_string} {limit_string} {offset_string}'''.format(
+            return '''{action} {field_string} FROM {table} {condition_string} {group_string} {order_string} {limit_string} {offset_string}'''.format(
                 action=self.action,
                 field_string=field_string,
                 table=self.table,
                 condition_string=condition_string,
+                group_string=group_string,
                 order_string=order_string,
                 limit_string=limit_string,
                 offset_string=offset_string,
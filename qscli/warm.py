@@ -0,0 +1,390 @@
+"""Run qscli tools in an already running interpreter, to avoid paying
+for interpreter start up and imports on every invocation.
+
+python -S -m qscli.warm qscount incr # run `qscount incr`
+python -m qscli.warm --serve qscount # run a resident server for qscount
+
+The client sends its arguments and working directory to a resident
+server for the tool, which forks a child to run the command.
+The child's standard out and standard error are streamed back to
+the client, and it reads standard in from the client on demand.
+
+If no server is running the command runs in process, and a server is
+started in the background for next time. Servers exit when idle.
+
+The client must start quickly so it avoids importing anything
+beyond what the interpreter has already loaded.
+
+Only output written through sys.stdout and sys.stderr reaches the
+client, so tools that hand the terminal to subprocesses (editors,
+prompts) should not be run like this.
+"""
+
+import os
+import stat
+import struct
+import sys
+
+import _socket
+
+DEFAULT_IDLE_TIMEOUT = 1800
+
+# Tools that are packages rather than modules
+MAIN_MODULES = {
+    'exercise': 'qscli.exercise.exercise',
+    'qsscore': 'qscli.qsscore.qsscore',
+    'qswatch': 'qscli.qswatch.parse',
+}
+
+HEADER = struct.Struct('!cI')
+
+# Client to server
+ARGUMENT = 'A'
+CWD = 'C'
+RUN = 'R'
+STDIN_DATA = 'I'
+
+# Server to client
+STDOUT_DATA = 'O'
+STDERR_DATA = 'E'
+STDIN_REQUEST = 'i'
+EXIT = 'X'
+
+def main():
+    args = sys.argv[1:]
+    if args[:1] == ['--serve']:
+        import argparse
+        parser = argparse.ArgumentParser(description='Resident server for a qscli tool')
+        parser.add_argument('--serve', type=str, dest='tool', help='Serve this tool', required=True)
+        parser.add_argument('--idle-timeout', type=float, default=DEFAULT_IDLE_TIMEOUT, help='Exit after this many seconds without clients')
+        options = parser.parse_args(args)
+        serve(options.tool, options.idle_timeout)
+    else:
+        tool, tool_args = args[0], args[1:]
+        if is_daemon_command(tool_args):
+            # daemons talk over their own standard in and out
+            sys.exit(run_in_process(tool, tool_args))
+        sys.exit(run_client(tool, tool_args))
+
+def is_daemon_command(args):
+    """Whether `args` run a tool's daemon subcommand. The subcommand is the first argument
+    that is not an option, or (since we do not know which options take values) the one after
+    that if the first might be the value of an option"""
+    previous = None
+    for arg in args:
+        if not arg.startswith('-'):
+            if arg == 'daemon':
+                return True
+            elif previous is None or not previous.startswith('-') or '=' in previous:
+                return False
+        previous = arg
+    return False
+
+def socket_path(tool):
+    # Matches ipc.socket_path, which is too expensive to import here
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        directory = os.path.join(runtime_dir, 'qscli')
+    else:
+        directory = os.path.join('/tmp', 'qscli-{}'.format(os.getuid()))
+    return os.path.join(directory, 'warm-{}.sock'.format(tool))
+
+def is_private_directory(directory):
+    "Like ipc.check_private_directory: is `directory` missing, or ours and only usable by us"
+    try:
+        info = os.lstat(directory)
+    except OSError:
+        return True
+    return stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid() and stat.S_IMODE(info.st_mode) == 0700
+
+def run_client(tool, args):
+    "Run `tool` with `args` through its server if there is one. Returns the exit code"
+    path = socket_path(tool)
+    if not is_private_directory(os.path.dirname(path)):
+        sys.stderr.write('Not using a server since other users can use {}\n'.format(os.path.dirname(path)))
+        return run_in_process(tool, args)
+
+    sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except _socket.error:
+        sock.close()
+        start_server(tool)
+        return run_in_process(tool, args)
+
+    try:
+        for arg in args:
+            send_frame(sock, ARGUMENT, arg)
+        send_frame(sock, CWD, os.getcwd())
+        send_frame(sock, RUN, '')
+    except _socket.error:
+        pass # We find out that the server has gone away below
+
+    started = False
+    while True:
+        try:
+            kind, data = recv_frame(sock)
+        except _socket.error:
+            kind = data = None
+
+        if kind is None and not started:
+            # The server exited without running anything
+            start_server(tool)
+            return run_in_process(tool, args)
+        started = True
+
+        if kind == STDOUT_DATA:
+            _write_all(1, data)
+        elif kind == STDERR_DATA:
+            _write_all(2, data)
+        elif kind == STDIN_REQUEST:
+            send_frame(sock, STDIN_DATA, os.read(0, int(data)))
+        elif kind == EXIT:
+            return int(data)
+        elif kind is None:
+            _write_all(2, 'Lost connection to the {} server\n'.format(tool))
+            return 1
+        else:
+            raise ValueError(kind)
+
+def run_in_process(tool, args):
+    import site # pylint: disable=unused-import
+    sys.argv = [tool] + args
+    sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
+    try:
+        load_tool(tool).main()
+    except SystemExit as e:
+        return _exit_code(e)
+    return 0
+
+def start_server(tool):
+    import subprocess
+    with open(os.devnull, 'r+') as devnull:
+        subprocess.Popen(
+            [sys.executable, '-m', 'qscli.warm', '--serve', tool],
+            stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True, preexec_fn=os.setsid)
+
+def load_tool(tool):
+    import importlib
+    return importlib.import_module(MAIN_MODULES.get(tool, 'qscli.' + tool))
+
+def serve(tool, idle_timeout):
+    "Import `tool` and then run a copy of it in a forked child for each client"
+    import select
+    import signal
+    from . import ipc
+
+    sys.argv = [tool] # used by parsers created on import
+    module = load_tool(tool)
+
+    path = socket_path(tool)
+    listener = ipc.listen(path)
+    if listener is None:
+        return
+
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN) # reap children automatically
+    source_mtimes = _source_mtimes()
+    pending = []
+    try:
+        while True:
+            readable, _, _ = select.select([listener], [], [], idle_timeout)
+            if not readable:
+                break
+            sock, _ = listener.accept()
+
+            if _source_mtimes() != source_mtimes:
+                # The client runs the command itself and starts a new server
+                sock.close()
+                break
+
+            _fork_child(module, tool, sock, listener)
+    finally:
+        pending = ipc.stop_listening(listener, path)
+
+    for sock in pending:
+        _fork_child(module, tool, sock, None)
+
+def _source_mtimes():
+    "Modification times for the source of loaded qscli modules, to detect that the code has changed"
+    result = {}
+    for name, module in sys.modules.items():
+        filename = getattr(module, '__file__', None)
+        if not name.startswith('qscli') or filename is None:
+            continue
+
+        source = os.path.splitext(filename)[0] + '.py'
+        try:
+            result[source] = os.stat(source).st_mtime
+        except OSError:
+            result[source] = None
+    return result
+
+def _fork_child(module, tool, sock, listener):
+    if os.fork() == 0:
+        import signal
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        if listener is not None:
+            listener.close()
+        import random
+        random.seed() # otherwise every child makes the same random choices
+        try:
+            _run_child(module, tool, sock)
+        finally:
+            os._exit(0)
+    else:
+        sock.close()
+
+def _run_child(module, tool, sock):
+    import traceback
+
+    args = []
+    while True:
+        kind, data = recv_frame(sock)
+        if kind == ARGUMENT:
+            args.append(data)
+        elif kind == CWD:
+            os.chdir(data)
+        elif kind == RUN:
+            break
+        else:
+            return
+
+    sys.argv = [tool] + args
+    sys.stdin = RemoteInput(sock)
+    sys.stdout = RemoteOutput(sock, STDOUT_DATA)
+    sys.stderr = RemoteOutput(sock, STDERR_DATA)
+
+    code = 0
+    try:
+        module.main()
+    except SystemExit as e:
+        code = _exit_code(e)
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+
+    if sys.stdout.softspace:
+        # as the interpreter does on exit after `print x,`
+        sys.stdout.write('\n')
+
+    send_frame(sock, EXIT, str(code))
+
+def _exit_code(exit_exception):
+    code = exit_exception.code
+    if code is None:
+        return 0
+    elif isinstance(code, int):
+        return code
+    else:
+        sys.stderr.write('{}\n'.format(code))
+        return 1
+
+class RemoteOutput(object):
+    "Stream written output back to the client"
+    def __init__(self, sock, kind):
+        self._sock = sock
+        self._kind = kind
+        self.softspace = 0
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf8')
+        if data:
+            send_frame(self._sock, self._kind, data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+class RemoteInput(object):
+    "Read input from the client as it is needed"
+    def __init__(self, sock):
+        self._sock = sock
+        self._buffer = ''
+        self._eof = False
+
+    def _fill(self):
+        if self._eof:
+            return False
+
+        send_frame(self._sock, STDIN_REQUEST, '65536')
+        kind, data = recv_frame(self._sock)
+        if kind != STDIN_DATA or not data:
+            self._eof = True
+            return False
+
+        self._buffer += data
+        return True
+
+    def read(self, size=-1):
+        while (size < 0 or len(self._buffer) < size) and self._fill():
+            pass
+
+        if size < 0:
+            result, self._buffer = self._buffer, ''
+        else:
+            result, self._buffer = self._buffer[:size], self._buffer[size:]
+        return result
+
+    def readline(self):
+        while '\n' not in self._buffer and self._fill():
+            pass
+
+        if '\n' in self._buffer:
+            index = self._buffer.index('\n') + 1
+        else:
+            index = len(self._buffer)
+
+        result, self._buffer = self._buffer[:index], self._buffer[index:]
+        return result
+
+    def readlines(self):
+        return list(self)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            yield line
+
+    def isatty(self):
+        return False
+
+def send_frame(sock, kind, data):
+    sock.sendall(HEADER.pack(kind, len(data)) + data)
+
+def recv_frame(sock):
+    "Returns (kind, data) or (None, None) if the connection has closed"
+    header = _recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None, None
+
+    kind, length = HEADER.unpack(header)
+    data = _recv_exactly(sock, length)
+    if data is None:
+        return None, None
+    return kind, data
+
+def _recv_exactly(sock, length):
+    parts = []
+    while length:
+        part = sock.recv(length)
+        if not part:
+            return None
+        parts.append(part)
+        length -= len(part)
+    return ''.join(parts)
+
+def _write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+if __name__ == '__main__':
+    main()
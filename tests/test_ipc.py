@@ -0,0 +1,356 @@
+import argparse
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from qscli import ipc
+
+class TestIpc(unittest.TestCase):
+    def setUp(self):
+        self.direc = tempfile.mkdtemp()
+        self.client = ipc.CliClient([sys.executable, '-m', 'qscli.qstimeseries', '--config-dir', self.direc, 'daemon'])
+        self.client.initialize()
+
+    def tearDown(self):
+        self.client.shutdown()
+        shutil.rmtree(self.direc)
+
+    def test_run(self):
+        self.client.run(['append', 'metric', '1'])
+        value, = json.loads(self.client.run(['show', '--series', 'metric', '--json']))
+        self.assertEquals(value['value'], 1)
+
+    def test_run_many(self):
+        results = self.client.run_many([
+            ['append', 'metric', '1'],
+            ['append', 'metric', '2'],
+            ['show', '--series', 'metric', '--json']])
+        self.assertEquals(len(results), 3)
+        self.assertEquals(sorted(value['value'] for value in json.loads(results[2])), [1, 2])
+
+    def test_run_many_errors_isolated(self):
+        with self.assertRaises(ipc.CommandError):
+            self.client.run_many([
+                ['append', 'metric', '1', '--id', 'one'],
+                ['append', 'metric', '1', '--id', 'one'],
+                ['append', 'metric', '2']])
+
+        first, error, third = self.client.run_many([
+            ['show', '--series', 'metric', '--json'],
+            ['no-such-command'],
+            ['series']], return_errors=True)
+        self.assertEquals(sorted(value['value'] for value in json.loads(first)), [1, 2])
+        self.assertTrue(isinstance(error, ipc.CommandError))
+        self.assertEquals(third, 'metric\n')
+
+    def test_call(self):
+        self.client.call_many([
+            ('append', dict(series='metric', value='1', id='one')),
+            ('append', dict(series='metric', value='2', time=1000))])
+        self.assertEquals(self.client.call('series'), ['metric'])
+        self.assertEquals(self.client.call('series', prefix='other'), [])
+
+        values = self.client.call('show', series='metric')
+        self.assertEquals(sorted(value['value'] for value in values), [1, 2])
+        value, = self.client.call('show', series='metric', id=['one'])
+        self.assertEquals(value['value'], 1)
+
+        self.client.call('show', series='metric', id=['one'], delete=True)
+        self.assertEquals([value['time'] for value in self.client.call('show', series='metric')], [1000])
+
+        # Subcommands without methods return their output
+        self.assertEquals(self.client.call('aggregate', period='1d', series='metric'), '1970-01-01 00:00:00 metric 2.0 \n')
+
+        with self.assertRaises(ipc.CommandError):
+            self.client.call('show', no_such_parameter=1)
+        with self.assertRaises(ipc.CommandError):
+            self.client.call('append', series='metric')
+
+    def test_records_in_daemon(self):
+        # Records are not read from the daemon's standard in, which carries requests
+        error, series = self.client.run_many([['append-many'], ['series']], return_errors=True)
+        self.assertTrue(isinstance(error, ipc.CommandError))
+        self.assertTrue('needs --record' in error.reply['error'])
+        self.assertEquals(series, '')
+        with self.assertRaises(ipc.CommandError):
+            self.client.call('delete-many')
+
+        self.assertEquals(self.client.run(['append-many', '--record', json.dumps(dict(series='metric', value=1))]), '1\n')
+        self.assertEquals(self.client.call('delete-many', records=[dict(series='metric', id='internal--1')]), 1)
+
+    def test_export_in_daemon(self):
+        self.client.run(['append', 'metric', '1', '--time', '1000'])
+        with self.assertRaises(ipc.CommandError) as context:
+            self.client.run(['export', '--series', 'metric'])
+        self.assertTrue('needs --output' in context.exception.reply['error'])
+
+        path = os.path.join(self.direc, 'metric.npy')
+        self.client.run(['export', '--series', 'metric', '--output', path])
+        self.assertTrue(os.path.exists(path))
+
+    def test_stats(self):
+        self.client.run_many([
+            ['append', 'metric', '1'],
+            ['append', 'metric', '2'],
+            ['show', '--series', 'metric', '--json'],
+            ['no-such-command']], return_errors=True)
+
+        stats = json.loads(self.client.run([ipc.STATS_COMMAND]))
+        self.assertEquals(stats['append']['execute']['count'], 2)
+        self.assertEquals(stats['show']['total']['count'], 1)
+        self.assertEquals(sorted(stats['show']), ['argparse', 'execute', 'serialize', 'tokenize', 'total', 'wait', 'write'])
+        self.assertEquals(stats[ipc.UNPARSED]['total']['count'], 1)
+
+        client_stats = self.client.stats.summary()
+        self.assertEquals(client_stats['append']['round-trip']['count'], 2)
+        self.assertTrue(client_stats['show']['round-trip']['max'] >= stats['show']['total']['min'])
+
+class TestSocketIpc(unittest.TestCase):
+    def setUp(self):
+        self.direc = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.direc, 'qstimeseries.sock')
+        self.command = [sys.executable, '-m', 'qscli.qstimeseries', '--config-dir', self.direc, 'daemon']
+
+    def tearDown(self):
+        shutil.rmtree(self.direc)
+
+    def client(self):
+        client = ipc.CliClient(self.command, socket_path=self.socket_path, idle_timeout=0.5)
+        client.initialize()
+        return client
+
+    def test_shared_server(self):
+        first = self.client()
+        second = self.client()
+        first.run(['append', 'metric', '1'])
+        second.run(['append', 'metric', '2'])
+        self.assertEquals(first.run(['series']), 'metric\n')
+        values = json.loads(second.run(['show', '--series', 'metric', '--json']))
+        self.assertEquals(sorted(value['value'] for value in values), [1, 2])
+        first.shutdown()
+        second.shutdown()
+
+        self.assertTrue(os.path.exists(self.socket_path))
+        deadline = time.time() + 10
+        while os.path.exists(self.socket_path) and time.time() < deadline:
+            time.sleep(0.1)
+        self.assertFalse(os.path.exists(self.socket_path))
+
+        # The server is started again when needed
+        client = self.client()
+        self.assertEquals(client.run(['series']), 'metric\n')
+        client.shutdown()
+
+class TestSocketDirectory(unittest.TestCase):
+    def setUp(self):
+        self.direc = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.direc)
+
+    def test_private_directory(self):
+        path = os.path.join(self.direc, 'qscli', 'server.sock')
+        ipc.listen(path).close()
+        self.assertEquals(os.stat(os.path.dirname(path)).st_mode & 0777, 0700)
+
+        # Directories that other users could have made or can use are refused
+        os.chmod(os.path.dirname(path), 0755)
+        with self.assertRaises(ipc.InsecureDirectory):
+            ipc.listen(path)
+        with self.assertRaises(ipc.InsecureDirectory):
+            ipc.CliClient(['unused'], socket_path=path).initialize()
+
+        os.chmod(os.path.dirname(path), 0700)
+        link = os.path.join(self.direc, 'link')
+        os.symlink(os.path.dirname(path), link)
+        with self.assertRaises(ipc.InsecureDirectory):
+            ipc.listen(os.path.join(link, 'server.sock'))
+
+class TestConcurrentServer(unittest.TestCase):
+    def setUp(self):
+        self.direc = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.direc, 'server.sock')
+        self.slow_started = threading.Event()
+        self.release_slow = threading.Event()
+        self.running_writes = []
+
+        parser = argparse.ArgumentParser()
+        parsers = parser.add_subparsers(dest='command')
+        for name in ('slow', 'fast', 'write'):
+            parsers.add_parser(name)
+
+        server = ipc.Server(parser, self.run_command, False, ipc.read_only_commands('slow', 'fast'), ipc.WorkerPool(2))
+        listener = ipc.listen(self.socket_path)
+        self.thread = threading.Thread(target=server.serve, args=(listener, [], self.socket_path, 0.1))
+        self.thread.start()
+
+    def tearDown(self):
+        self.release_slow.set()
+        self.thread.join()
+        shutil.rmtree(self.direc)
+
+    def run_command(self, options):
+        if options.command == 'slow':
+            self.slow_started.set()
+            self.release_slow.wait(10)
+        elif options.command == 'write':
+            self.running_writes.append(self.release_slow.is_set())
+        return options.command
+
+    def test_out_of_order(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+        reader = sock.makefile('rb')
+        sock.sendall('@1 slow\n')
+        self.slow_started.wait(10)
+        sock.sendall('@2 fast\n@3 write\n')
+
+        # The read-only command runs alongside the slow one, writes wait for it to finish
+        self.assertEquals(json.loads(reader.readline()), dict(id=2, return_code=0, output='fast'))
+        self.release_slow.set()
+        replies = [json.loads(reader.readline()), json.loads(reader.readline())]
+        self.assertEquals(sorted(reply['id'] for reply in replies), [1, 3])
+        self.assertEquals(self.running_writes, [True])
+
+        # Replies without ids stay in order
+        sock.sendall('slow\nfast\n')
+        self.assertEquals(json.loads(reader.readline())['output'], 'slow')
+        self.assertEquals(json.loads(reader.readline())['output'], 'fast')
+        reader.close()
+        sock.close()
+
+    def test_bad_request_id(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+        reader = sock.makefile('rb')
+        sock.sendall('@x fast\n@ fast\n__cancel__ abc\n__cancel__ \n@2 fast\n')
+
+        # Errors are only replied to the client that sent them
+        replies = [json.loads(reader.readline()) for _ in range(5)]
+        self.assertEquals([reply for reply in replies if 'id' in reply], [dict(id=2, return_code=0, output='fast')])
+        errors = [reply['error'] for reply in replies if 'id' not in reply]
+        self.assertEquals([('must be integers' in error, 'needs a request id' in error) for error in errors],
+            [(True, False), (True, False), (False, True), (False, True)])
+        reader.close()
+        sock.close()
+
+    def test_idle_function(self):
+        idle_calls = []
+        def idle_function():
+            idle_calls.append(self.slow_started.is_set() and not self.release_slow.is_set())
+            return len(idle_calls) % 3 != 0
+
+        parser = argparse.ArgumentParser()
+        parsers = parser.add_subparsers(dest='command')
+        for name in ('slow', 'fast', 'write'):
+            parsers.add_parser(name)
+        socket_path = os.path.join(self.direc, 'idle.sock')
+        server = ipc.Server(parser, self.run_command, False, ipc.read_only_commands('slow', 'fast'), ipc.WorkerPool(2), idle_function=idle_function)
+        original_idle_delay = ipc.IDLE_DELAY
+        ipc.IDLE_DELAY = 0.05
+        try:
+            thread = threading.Thread(target=server.serve, args=(ipc.listen(socket_path), [], socket_path, 1.0))
+            thread.start()
+
+            # Called until it has nothing to do, then again after commands have run
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(socket_path)
+            reader = sock.makefile('rb')
+            sock.sendall('slow\n')
+            self.slow_started.wait(10)
+            time.sleep(0.2)
+            self.release_slow.set()
+            self.assertEquals(json.loads(reader.readline())['output'], 'slow')
+            time.sleep(0.2)
+            reader.close()
+            sock.close()
+            thread.join()
+        finally:
+            ipc.IDLE_DELAY = original_idle_delay
+
+        self.assertTrue(len(idle_calls) >= 3)
+        self.assertEquals(len(idle_calls) % 3, 0)
+        self.assertFalse(any(idle_calls))
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self):
+        self.direc = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.direc, 'server.sock')
+        self.finished = threading.Event()
+        self.release_slow = threading.Event()
+
+        parser = argparse.ArgumentParser()
+        parsers = parser.add_subparsers(dest='command')
+        for name in ('count', 'forever', 'slow', 'fast'):
+            parsers.add_parser(name)
+
+        server = ipc.Server(parser, self.run_command, False)
+        listener = ipc.listen(self.socket_path)
+        self.thread = threading.Thread(target=server.serve, args=(listener, [], self.socket_path, 0.1))
+        self.thread.start()
+        self.client = ipc.CliClient(['unused'], socket_path=self.socket_path)
+        self.client.initialize()
+
+    def tearDown(self):
+        self.release_slow.set()
+        self.client.shutdown()
+        self.thread.join()
+        shutil.rmtree(self.direc)
+
+    def run_command(self, options):
+        if options.command == 'count':
+            return ('{}\n'.format(i) for i in range(3))
+        elif options.command == 'forever':
+            return self.forever()
+        elif options.command == 'slow':
+            return self.slow()
+        else:
+            return 'fast'
+
+    def forever(self):
+        try:
+            while True:
+                yield 'again\n'
+        finally:
+            self.finished.set()
+
+    def slow(self):
+        yield 'first\n'
+        self.release_slow.wait(10)
+        yield 'second\n'
+
+    def test_slow_stream(self):
+        stream = self.client.stream(['slow'])
+        self.assertEquals(next(stream), 'first\n')
+
+        # Other clients' commands run while the stream waits
+        other = ipc.CliClient(['unused'], socket_path=self.socket_path)
+        other.initialize()
+        start = time.time()
+        self.assertEquals(other.run(['fast']), 'fast')
+        self.assertTrue(time.time() - start < 1.0)
+        self.assertFalse(self.release_slow.is_set())
+        other.shutdown()
+
+        self.release_slow.set()
+        self.assertEquals(list(stream), ['second\n'])
+
+    def test_stream(self):
+        self.assertEquals(list(self.client.stream(['count'])), ['0\n', '1\n', '2\n'])
+        self.assertEquals(self.client.run(['count']), '0\n1\n2\n')
+
+    def test_cancel(self):
+        stream = self.client.stream(['forever'])
+        self.assertEquals([next(stream) for _ in range(3)], ['again\n'] * 3)
+        stream.close()
+        self.assertTrue(self.finished.wait(10))
+        self.assertEquals(self.client.run(['fast']), 'fast')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,287 @@
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from qscli import ipc, qscount
+
+class QscountTest(unittest.TestCase):
+    def setUp(self):
+        self.direc = tempfile.mkdtemp()
+        self.data_file = qscount.shard_file(self.direc, 'DEFAULT')
+
+    def tearDown(self):
+        shutil.rmtree(self.direc)
+
+    def run_cli(self, *args):
+        new_args = ('--config-dir', self.direc) + tuple(args)
+        return qscount.run(qscount.PARSER.parse_args(new_args))
+
+    def test_basic(self):
+        self.assertEquals(self.run_cli('count'), '0')
+        self.assertEquals(self.run_cli('incr'), '1')
+        self.assertEquals(self.run_cli('incr'), '2')
+        self.assertEquals(self.run_cli('count'), '2')
+
+    def test_journal(self):
+        self.run_cli('incr', 'first')
+        self.run_cli('new-set', 'first')
+        self.run_cli('incr', 'first')
+        self.run_cli('note', 'first', 'a note')
+
+        # Simple changes are only journaled
+        self.assertFalse(os.path.exists(qscount.shard_file(self.direc, 'first')))
+        self.assertEquals(self.run_cli('count', 'first'), '2')
+        self.assertEquals(self.run_cli('count', 'first', '--set', 'CURRENT'), '1')
+
+        # Other changes write a snapshot
+        self.run_cli('move', 'first', 'second')
+        self.assertEquals(self.run_cli('count', 'second'), '2')
+        self.run_cli('incr', 'second')
+        self.assertEquals(self.run_cli('count', 'second'), '3')
+
+    def test_compaction(self):
+        original_compact_after = qscount.COMPACT_AFTER
+        qscount.COMPACT_AFTER = 3
+        try:
+            for _ in range(10):
+                self.run_cli('incr')
+        finally:
+            qscount.COMPACT_AFTER = original_compact_after
+
+        self.assertEquals(self.run_cli('count'), '10')
+        with open(self.data_file) as stream:
+            generation = json.loads(stream.read())['generation']
+        self.assertEquals(len(qscount.read_journal(qscount.journal_file(self.data_file, generation))[0]), 2)
+
+    def test_torn_journal(self):
+        self.run_cli('incr')
+        with open(qscount.journal_file(self.data_file, 0), 'a') as stream:
+            stream.write('{"op": "in')
+
+        self.assertEquals(self.run_cli('count'), '1')
+        self.run_cli('incr')
+        self.assertEquals(self.run_cli('count'), '2')
+
+    def test_days(self):
+        now = time.time()
+        with qscount.open_counters(self.direc) as counter:
+            for timestamp in (now - 86400 * 2, now - 86400 * 2, now):
+                counter._change(dict(op='incr', counter='exercise.one', time=timestamp, set=0))
+            counter._change(dict(op='incr', counter='two', time=now - 86400 * 2, set=0))
+
+        self.assertEquals(self.run_cli('summary', '--days-ago', '2'), 'exercise.one: 2\ntwo: 1')
+        self.assertEquals(self.run_cli('summary', '--days-ago', '1'), '')
+        self.assertEquals(self.run_cli('list', '--days-ago', '0'), 'exercise.one')
+        self.assertEquals(self.run_cli('list'), 'exercise.one\ntwo')
+
+        two_days_ago = datetime.datetime.combine(datetime.date.today() - datetime.timedelta(days=2), datetime.time())
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        with qscount.open_counters(self.direc) as counter:
+            self.assertEquals(
+                counter.compare_counts(two_days_ago, today, today, today + datetime.timedelta(days=1)),
+                [('exercise.one', 2, 1), ('two', 1, 0)])
+
+            self.assertEquals(
+                counter.compare_counts(two_days_ago, datetime.datetime.now(), today, datetime.datetime.now()),
+                [('exercise.one', 3, 1), ('two', 1, 0)])
+
+        # The index survives compaction
+        self.run_cli('delete', 'two')
+        self.run_cli('merge', 'exercise.one', 'two')
+        with open(qscount.shard_file(self.direc, 'exercise.one')) as stream:
+            counters = json.loads(stream.read())['counters']
+        self.assertEquals(sum(counters['exercise.one']['days'].values()), 3)
+        self.assertEquals(self.run_cli('summary', '--days-ago', '2'), 'exercise.one: 2')
+
+    def test_count_range(self):
+        with qscount.open_counters(self.direc) as counter:
+            for timestamp in (1000, 2000, 2000, 3000, 2500):
+                counter._change(dict(op='incr', counter='DEFAULT', time=timestamp, set=0))
+
+        with qscount.open_counters(self.direc) as counter:
+            self.assertEquals([event['time'] for event in counter.events('DEFAULT', None)], [1000, 2000, 2000, 2500, 3000])
+            at = datetime.datetime.fromtimestamp
+            self.assertEquals(counter.count('DEFAULT', since=at(2000)), 4)
+            self.assertEquals(counter.count('DEFAULT', until=at(2000)), 3)
+            self.assertEquals(counter.count('DEFAULT', since=at(1500), until=at(2600)), 3)
+            self.assertEquals(counter.count('DEFAULT', since=at(3500)), 0)
+            self.assertEquals(counter.count('DEFAULT', since=at(2600), until=at(1500)), 0)
+
+        self.assertEquals(self.run_cli('count', '--since', 'today'), '0')
+        self.run_cli('incr')
+        self.assertEquals(self.run_cli('count', '--since', 'today'), '1')
+        self.assertEquals(self.run_cli('count', '--until', 'yesterday'), '5')
+
+    def test_fuzzy_date(self):
+        for string in ('today', '3 days ago', '2 hours ago', '2026-10-01', '2026-10-01T12:30:05', 'monday', 'last sat', 'next friday'):
+            parsed = qscount.parse_fuzzy_date(string)(datetime.datetime.now())
+            output = subprocess.check_output(['date', '-d', string, '+%s'])
+            self.assertTrue(abs(qscount.to_timestamp(parsed) - float(output)) < 2, string)
+
+        self.assertEquals(qscount.parse_fuzzy_date('first of june'), None)
+        self.assertEquals(qscount.fuzzy_date('yesterday'), qscount.fuzzy_date('1 day ago'))
+
+    def test_migrate_json(self):
+        with open(os.path.join(self.direc, qscount.DATA_FILE), 'w') as stream:
+            stream.write(json.dumps(dict(counters=dict(
+                DEFAULT=dict(events=[dict(time=1000, set=0)], notes=[], set=0),
+                other=dict(events=[], notes=[], set=0)))))
+
+        self.run_cli('incr')
+        self.assertEquals(self.run_cli('count'), '2')
+        self.assertEquals(self.run_cli('list'), 'DEFAULT')
+
+        # Rewritten as columns
+        self.run_cli('move', 'DEFAULT', 'moved')
+        with open(qscount.shard_file(self.direc, 'moved')) as stream:
+            data = json.loads(stream.read())
+        self.assertEquals(data['version'], qscount.DATA_VERSION)
+        self.assertEquals(qscount.decode_column('d', data['counters']['moved']['times'])[0], 1000)
+        self.assertEquals(self.run_cli('count', 'moved'), '2')
+
+    def test_merge(self):
+        with qscount.open_counters(self.direc) as counter:
+            for name, timestamp in (('first', 1000), ('second', 2000), ('first', 3000)):
+                counter._change(dict(op='incr', counter=name, time=timestamp, set=0))
+            counter._change(dict(op='note', counter='second', time=2500, note='a note'))
+            counter.merge('first', 'second')
+
+        with qscount.open_counters(self.direc) as counter:
+            self.assertEquals([event['time'] for event in counter.events('first', None)], [1000, 2000, 3000])
+            self.assertEquals(counter.count('first'), 3)
+            self.assertEquals(counter.store.counter('first').notes[0].note, 'a note')
+
+    def test_incr_times(self):
+        self.run_cli('incr', 'first', '--times', '3', '--at', '2 days ago')
+        self.run_cli('incr', 'first')
+        self.assertEquals(self.run_cli('count', 'first'), '4')
+        self.assertEquals(self.run_cli('count', 'first', '--until', 'yesterday'), '3')
+        self.assertEquals(self.run_cli('summary', '--days-ago', '2'), 'first: 3')
+
+    def test_import(self):
+        self.run_cli('incr', 'first', '--at', '2026-10-01T12:00:00')
+        self.run_cli('new-set', 'first')
+        with open(os.path.join(self.direc, 'events.jsonl'), 'w') as stream:
+            stream.write(json.dumps(dict(counter='first', time='2026-10-02T12:00:00', set=1)) + '\n')
+            stream.write(json.dumps(dict(counter='first', time=1000)) + '\n')
+            stream.write(json.dumps(dict(counter='second', time=1000)) + '\n')
+        self.assertEquals(self.run_cli('import', os.path.join(self.direc, 'events.jsonl')), '3')
+
+        with open(os.path.join(self.direc, 'events.csv'), 'w') as stream:
+            stream.write('counter,time,set\nfirst,2026-09-30T12:00:00,\nsecond,2000,0\n')
+        self.assertEquals(self.run_cli('import', '--format', 'csv', os.path.join(self.direc, 'events.csv')), '2')
+
+        # Merged into the history, and journaled as one change per counter
+        with qscount.open_counters(self.direc) as counter:
+            self.assertEquals(
+                [(event['time'], event['set']) for event in counter.events('first', None)],
+                [(1000, 1), (qscount.to_timestamp(datetime.datetime(2026, 9, 30, 12)), 1),
+                 (qscount.to_timestamp(datetime.datetime(2026, 10, 1, 12)), 0),
+                 (qscount.to_timestamp(datetime.datetime(2026, 10, 2, 12)), 1)])
+            self.assertEquals(counter.count('second'), 2)
+        first_journal = qscount.journal_file(qscount.shard_file(self.direc, 'first'), 0)
+        self.assertEquals(len(qscount.read_journal(first_journal)[0]), 4)
+
+    def test_import_in_daemon(self):
+        with ipc.CliClient([sys.executable, '-m', 'qscli.qscount', '--config-dir', self.direc, 'daemon']) as client:
+            # Events are not read from the daemon's standard in, which carries requests
+            error, count = client.run_many([['import'], ['count', 'first']], return_errors=True)
+            self.assertTrue('needs --record' in error.reply['error'])
+            self.assertEquals(count, '0')
+
+            self.assertEquals(client.run(['import', '--record', json.dumps(dict(counter='first', time=1000))]), '1')
+
+    def test_shards(self):
+        self.run_cli('incr', 'first')
+        self.run_cli('incr', 'second')
+        self.run_cli('incr', 'second')
+        self.run_cli('note', 'third', 'a note')
+        self.assertEquals(self.run_cli('list'), 'first\nsecond')
+        self.assertEquals(qscount.read_catalog(self.direc), set(['first', 'second']))
+
+        # Each counter has its own journal
+        for name, length in (('first', 1), ('second', 2), ('third', 1)):
+            self.assertEquals(len(qscount.read_journal(qscount.journal_file(qscount.shard_file(self.direc, name), 0))[0]), length)
+
+        self.run_cli('move', 'second', '../second')
+        self.assertEquals(os.path.dirname(os.path.dirname(qscount.shard_file(self.direc, '../second'))), os.path.join(self.direc, 'counters'))
+        self.run_cli('delete', 'first')
+        self.assertEquals(self.run_cli('list'), '../second')
+        self.assertEquals(self.run_cli('count', '../second'), '2')
+        self.assertEquals(self.run_cli('count', 'second'), '0')
+
+    def run_resident(self, shards, *args):
+        options = qscount.PARSER.parse_args(('--config-dir', self.direc) + args)
+        return shards.call(qscount.run_command, options)
+
+    def test_resident(self):
+        self.run_cli('incr')
+        shards = qscount.ResidentShards()
+        self.assertEquals(self.run_resident(shards, 'incr'), '2')
+
+        # Written behind
+        self.assertEquals(self.run_cli('count'), '1')
+        shards.flush()
+        self.assertEquals(self.run_cli('count'), '2')
+
+        # Changes made by other processes are read in
+        self.run_cli('incr')
+        self.assertEquals(self.run_resident(shards, 'count'), '3')
+
+        self.run_cli('move', 'DEFAULT', 'moved')
+        self.assertEquals(self.run_resident(shards, 'count', 'moved'), '3')
+        self.assertEquals(self.run_resident(shards, 'list'), 'moved')
+
+    def test_resident_pending(self):
+        shards = qscount.ResidentShards()
+        self.run_resident(shards, 'incr')
+
+        # Unwritten changes survive another process rewriting the data
+        self.run_cli('merge', 'DEFAULT', 'other')
+        self.assertEquals(self.run_resident(shards, 'count'), '1')
+
+        shards.flush()
+        self.assertEquals(self.run_cli('count'), '1')
+
+    def test_resident_close(self):
+        shards = qscount.ResidentShards()
+        self.run_resident(shards, 'incr')
+        timer, = [shard._timer for shard in shards._shards.values()]
+
+        # The timer writing changes behind is finished with, rather than left for interpreter shutdown
+        shards.close()
+        self.assertFalse(timer.is_alive())
+        self.assertEquals(self.run_cli('count'), '1')
+
+    def test_resident_catalog(self):
+        self.run_cli('incr', 'first')
+        shards = qscount.ResidentShards()
+
+        reads = []
+        original_read_catalog = qscount.read_catalog
+        def read_catalog(directory):
+            reads.append(directory)
+            return original_read_catalog(directory)
+        qscount.read_catalog = read_catalog
+        try:
+            self.assertEquals(self.run_resident(shards, 'list'), 'first')
+            self.assertEquals(self.run_resident(shards, 'count', 'first'), '1')
+            self.assertEquals(len(reads), 1)
+
+            # Read again once another process changes it
+            self.run_cli('incr', 'second')
+            del reads[:]
+            self.assertEquals(self.run_resident(shards, 'list'), 'first\nsecond')
+            self.assertEquals(self.run_resident(shards, 'list'), 'first\nsecond')
+            self.assertEquals(len(reads), 1)
+        finally:
+            qscount.read_catalog = original_read_catalog
+
+if __name__ == '__main__':
+    unittest.main()
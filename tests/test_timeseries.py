@@ -1,6 +1,13 @@
+import array
+import ast
+import bisect
+import datetime
 import json
+import os
 import shutil
+import struct
 import tempfile
+import time
 import unittest
 import sqlite3
 
@@ -93,5 +100,326 @@ class TimeseriesTest(unittest.TestCase):
         self.assertEquals(entry1['value'], 3)
         self.assertEquals(entry2['value'], 1)
 
+    def test_aggregate(self):
+        for series, value, timestamp in (('a', 1, 0), ('a', 3, 100), ('b', 5, 200), ('a', 2, 3600 * 3 + 10)):
+            self.run_cli('append', series, str(value), '--time', str(timestamp))
+
+        records = [json.loads(line) for line in self.run_cli('aggregate', '1h', '--record-stream', '-f', 'min', '-f', 'sum', '-f', 'count').splitlines()]
+        self.assertEquals(
+            [(record['isodate'], record['series'], record['value']) for record in records],
+            [('1970-01-01T00:00:00', 'a', [1, 4, 2]), ('1970-01-01T00:00:00', 'b', [5, 5, 1]), ('1970-01-01T03:00:00', 'a', [2, 2, 1])])
+
+        self.assertEquals(
+            self.run_cli('aggregate', '1h', '--series', 'a', '--missing', '-f', 'rng', '-f', 'mean').splitlines(),
+            ['1970-01-01 00:00:00 a 2.0 2.0 ', '1970-01-01 01:00:00 a None None ', '1970-01-01 02:00:00 a None None ', '1970-01-01 03:00:00 a 0.0 2.0 '])
+
+        # Functions sqlite cannot compute are computed in python
+        db = qstimeseries.ensure_database(self.direc)
+        for funcs in (['min', 'max', 'mean', 'rng', 'count', 'sum'], ['values']):
+            rows = list(qstimeseries.aggregate_values(db, None, datetime.timedelta(hours=1), funcs, include_empty=True))
+            python_rows = list(qstimeseries.aggregate_values(db, None, datetime.timedelta(hours=1), funcs + ['sorted_values'], include_empty=True))
+            self.assertEquals(rows, [row[:-1] for row in python_rows])
+            self.assertEquals(len(rows), 8)
+
+    def test_show_range(self):
+        for value in range(10):
+            self.run_cli('append', 'metric', str(value), '--time', str(1000 + value))
+        self.run_cli('append', 'other', '100', '--time', '1005')
+
+        def values(*args):
+            return [value['value'] for value in json.loads(self.run_cli('show', '--series', 'metric', '--json', *args))]
+
+        self.assertEquals(values('--since', '1003', '--until', '1005'), [3, 4, 5])
+        self.assertEquals(values('--limit', '2'), [0, 1])
+        self.assertEquals(values('--tail', '3'), [7, 8, 9])
+        self.assertEquals(values('--until', '1005', '--tail', '2'), [4, 5])
+        self.assertEquals(values('--since', '1002', '--index', '0', '--index', '-2'), [2, 8])
+        self.assertEquals(values('--since', '2000'), [])
+
+        db = qstimeseries.ensure_database(self.direc)
+        plan = ' '.join(str(row) for row in db.execute(
+            'EXPLAIN QUERY PLAN SELECT * FROM timeseries WHERE series = ? ORDER BY time DESC, id DESC LIMIT 1', ('metric',)))
+        self.assertFalse('TEMP B-TREE' in plan, plan)
+
+    def test_append_many(self):
+        with open(os.path.join(self.direc, 'values.jsonl'), 'w') as stream:
+            stream.write(json.dumps(dict(series='metric', value=1, time=1000)) + '\n')
+            stream.write(json.dumps(dict(series='metric', value='2', time=2000, id='two')) + '\n')
+        self.assertEquals(self.run_cli('append-many', os.path.join(self.direc, 'values.jsonl')), '2\n')
+
+        with open(os.path.join(self.direc, 'values.csv'), 'w') as stream:
+            stream.write('series,time,value,id\nmetric,3000,3,\nmetric,,20,two\nother,4000,4,\n')
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.run_cli('append-many', '--format', 'csv', os.path.join(self.direc, 'values.csv'))
+        self.assertEquals(len(json.loads(self.run_cli('show', '--json'))), 2)
+
+        self.run_cli('append-many', '--format', 'csv', '--update', os.path.join(self.direc, 'values.csv'))
+        self.assertEquals(
+            [(value['value'], value['id']) for value in json.loads(self.run_cli('show', '--series', 'metric', '--json'))],
+            [(1, 'internal--1'), (3, 'internal--3'), (20, 'two')])
+
+        self.assertEquals(self.run_cli(
+            'delete-many', '--record', json.dumps(dict(series='metric', id='two')),
+            '--record', json.dumps(dict(series='metric', id='internal--1')), '--record', json.dumps(dict(series='other', id='internal--3'))), '2\n')
+        self.assertEquals([value['value'] for value in json.loads(self.run_cli('show', '--json'))], [3, 4])
+        other_value, = json.loads(self.run_cli('show', '--series', 'other', '--json'))
+        self.assertEquals(self.run_cli('delete-many', '--record', json.dumps(dict(series='other', id=other_value['id']))), '1\n')
+
+    def test_delete_indexes(self):
+        for value in range(5):
+            self.run_cli('append', 'metric', str(value))
+        self.run_cli('show', '--series', 'metric', '--delete', '--index', '0', '--index', '2', '--index', '-1')
+        self.assertEquals([value['value'] for value in json.loads(self.run_cli('show', '--series', 'metric', '--json'))], [1, 3])
+
+    def test_delete_indexes_time_order(self):
+        # Appended out of time order, so that time order differs from id order
+        for value, timestamp in ((1, 300), (2, 100), (3, 200)):
+            self.run_cli('append', 'metric', str(value), '--time', str(timestamp))
+
+        last, = json.loads(self.run_cli('show', '--series', 'metric', '--index', '-1', '--json'))
+        self.assertEquals(last['value'], 1)
+        self.run_cli('show', '--series', 'metric', '--delete', '--index', '-1', '--index', '0')
+        self.assertEquals([value['value'] for value in json.loads(self.run_cli('show', '--series', 'metric', '--json'))], [3])
+
+    def test_rollups(self):
+        def append(value, timestamp, *args):
+            self.run_cli('append', 'metric', str(value), '--time', str(timestamp), *args)
+
+        append(1, 0)
+        append(5, 100)
+        self.run_cli('rollup', 'enable', 'metric', '--periods', '1m,1h')
+        self.assertEquals(self.run_cli('rollup', 'list'), 'metric 1m\nmetric 1h\n')
+
+        append(3, 30, '--id', 'three')
+        append(7, 3700)
+        append(2, 3710, '--id', 'two')
+        append(-1, 3720)
+        append(4, 3715, '--id', 'two', '--update')
+        self.run_cli('delete', 'metric', '--id', 'internal--6')
+        self.run_cli('delete-many', '--record', json.dumps(dict(series='metric', id='three')))
+
+        db = qstimeseries.ensure_database(self.direc)
+        funcs = ['min', 'max', 'mean', 'rng', 'count', 'sum']
+        for period in (datetime.timedelta(minutes=1), datetime.timedelta(minutes=2), datetime.timedelta(hours=1), datetime.timedelta(days=1)):
+            rollup_period = qstimeseries.find_rollup_period(db, 'metric', int(period.total_seconds()))
+            self.assertEquals(rollup_period, 60 if period < datetime.timedelta(hours=1) else 3600)
+            rows = list(qstimeseries.rollup_aggregate_rows(db, 'metric', rollup_period, int(period.total_seconds()), funcs))
+            self.assertEquals(rows, [
+                tuple(row) for row in
+                qstimeseries.python_aggregate_rows(db, 'metric', int(period.total_seconds()), [qstimeseries.AGGREGATION_FUNCTIONS[name] for name in funcs])])
+
+        # Rollups only include float values
+        self.run_cli('append', 'metric', 'text', '--string', '--time', '3730')
+        self.assertEquals(
+            self.run_cli('aggregate', '1h', '--series', 'metric', '-f', 'min', '-f', 'max', '-f', 'count').splitlines(),
+            ['1970-01-01 00:00:00 metric 1.0 5.0 2 ', '1970-01-01 01:00:00 metric 4.0 7.0 2 '])
+
+        self.run_cli('rollup', 'disable', 'metric', '--periods', '1m')
+        self.assertEquals(qstimeseries.find_rollup_period(db, 'metric', 120), None)
+        self.run_cli('rollup', 'disable', 'metric')
+        self.assertEquals(db.execute('SELECT count(*) FROM rollup_values').fetchone(), (0,))
+
+        # Aggregating the values themselves agrees
+        self.run_cli('append', 'metric', 'more text', '--string', '--time', '7300')
+        self.assertEquals(
+            self.run_cli('aggregate', '1h', '--series', 'metric', '-f', 'min', '-f', 'max', '-f', 'count').splitlines(),
+            ['1970-01-01 00:00:00 metric 1.0 5.0 2 ', '1970-01-01 01:00:00 metric 4.0 7.0 2 '])
+
+    def test_migrate(self):
+        # A database from before schema versions
+        db = sqlite3.connect(os.path.join(self.direc, 'data.sqlite'))
+        db.execute(qstimeseries.MIGRATIONS[0])
+        db.execute("INSERT INTO timeseries(series, float_value, time) VALUES ('metric', 1, datetime(1000, 'unixepoch'))")
+        db.commit()
+        db.close()
+
+        value, = json.loads(self.run_cli('show', '--series', 'metric', '--json'))
+        self.assertEquals(value['time'], 1000)
+
+        # Times are stored as unix times
+        self.run_cli('append', 'metric', '2', '--time', '2000.5')
+        self.assertEquals([value['time'] for value in json.loads(self.run_cli('show', '--series', 'metric', '--json'))], [1000, 2000.5])
+        self.assertEquals(self.run_cli('show', '--series', 'metric').splitlines()[1], '1970-01-01T00:33:20.500000 internal--2 metric 2.0')
+
+        db = qstimeseries.ensure_database(self.direc)
+        self.assertEquals(qstimeseries.schema_version(db), len(qstimeseries.MIGRATIONS))
+        # Only new databases use wal, since existing ones may be on network filesystems
+        self.assertEquals(db.execute('PRAGMA journal_mode').fetchone(), ('delete',))
+        plan = ' '.join(str(row) for row in db.execute(
+            'EXPLAIN QUERY PLAN SELECT * FROM timeseries WHERE series = ? ORDER BY time', ('metric',)))
+        self.assertTrue('timeseries_series_time' in plan, plan)
+        self.assertFalse('TEMP B-TREE' in plan, plan)
+
+    def test_concurrent_access(self):
+        db = qstimeseries.ensure_database(self.direc)
+        qstimeseries.append_many(db, [dict(series='metric', value=index, time=index) for index in range(2500)], float, False)
+        self.assertEquals(db.execute('PRAGMA journal_mode').fetchone(), ('wal',))
+
+        # A long read does not stop another process writing
+        reader = qstimeseries.ensure_database(self.direc, read_only=True)
+        shown = qstimeseries.show(reader, qstimeseries.build_parser().parse_args(['show', '--series', 'metric']))
+        first = next(shown)
+        self.run_cli('--busy-timeout', '0', 'append', 'metric', '1')
+        self.assertEquals(len((first + ''.join(shown)).splitlines()), 2500)
+        self.assertEquals(len(self.run_cli('show', '--series', 'metric').splitlines()), 2501)
+
+        with self.assertRaises(sqlite3.OperationalError):
+            reader.execute('DELETE FROM timeseries')
+
+        # Unless the database journals changes by rolling them back
+        db.close()
+        reader.close()
+        self.run_cli('--journal-mode', 'delete', 'append', 'metric', '1')
+        reader = qstimeseries.ensure_database(self.direc, read_only=True)
+        self.assertEquals(reader.execute('PRAGMA journal_mode').fetchone(), ('delete',))
+        shown = qstimeseries.show(reader, qstimeseries.build_parser().parse_args(['show', '--series', 'metric']))
+        next(shown)
+        with self.assertRaises(sqlite3.OperationalError):
+            self.run_cli('--busy-timeout', '0', 'append', 'metric', '1')
+        list(shown)
+        self.run_cli('--busy-timeout', '0', 'append', 'metric', '1')
+
+    def test_retry_append_many(self):
+        path = os.path.join(self.direc, 'values.jsonl')
+        with open(path, 'w') as stream:
+            stream.write(json.dumps(dict(series='metric', value=1, time=1000)) + '\n')
+            stream.write(json.dumps(dict(series='metric', value=2, time=2000)) + '\n')
+
+        # The records read for the first attempt are written by the retry
+        original_append_many = qstimeseries.append_many
+        attempts = []
+        def append_many_locked_once(db, records, value_type, update):
+            attempts.append(list(records))
+            if len(attempts) == 1:
+                raise sqlite3.OperationalError('database is locked')
+            return original_append_many(db, records, value_type, update)
+        qstimeseries.append_many = append_many_locked_once
+        try:
+            self.assertEquals(self.run_cli('append-many', path), '2\n')
+        finally:
+            qstimeseries.append_many = original_append_many
+
+        self.assertEquals(len(attempts), 2)
+        self.assertEquals([value['value'] for value in json.loads(self.run_cli('show', '--series', 'metric', '--json'))], [1, 2])
+
+    def test_retry_locked(self):
+        db = qstimeseries.ensure_database(self.direc)
+        attempts = []
+        def locked_twice():
+            attempts.append(None)
+            if len(attempts) < 3:
+                raise sqlite3.OperationalError('database is locked')
+            return 'done'
+        self.assertEquals(qstimeseries.retry_locked(db, locked_twice), 'done')
+
+        def always_locked():
+            raise sqlite3.OperationalError('database is locked')
+        with self.assertRaises(sqlite3.OperationalError):
+            qstimeseries.retry_locked(db, always_locked, timeout=0.05)
+
+    def test_export(self):
+        for time_value, value in ((3000, '3'), (1000, '1'), (2000, '2.5')):
+            self.run_cli('append', 'metric', value, '--time', str(time_value))
+        self.run_cli('append', 'metric', '--string', 'ignored', '--time', '1500')
+        self.run_cli('append', 'other', '5', '--time', '1500')
+
+        output = self.run_cli('export', '--series', 'metric')
+        self.assertTrue(output.startswith(qstimeseries.NPY_MAGIC))
+        header_length, = struct.unpack('<H', output[8:10])
+        header = ast.literal_eval(output[10:10 + header_length])
+        self.assertEquals(header, {'descr': '<f8', 'fortran_order': False, 'shape': (2, 3)})
+        self.assertEquals((10 + header_length) % 64, 0)
+        self.assertEquals(array.array('d', output[10 + header_length:]).tolist(), [1000, 2000, 3000, 1, 2.5, 3])
+
+        raw = self.run_cli('export', '--series', 'metric', '--format', 'raw', '--since', '1500')
+        self.assertEquals(array.array('d', raw).tolist(), [2000, 3000, 2.5, 3])
+
+        path = os.path.join(self.direc, 'metric.npy')
+        self.run_cli('export', '--series', 'metric', '--output', path)
+        with open(path, 'rb') as stream:
+            self.assertEquals(stream.read(), output)
+
+        empty = self.run_cli('export', '--series', 'missing', '--format', 'raw')
+        self.assertEquals(empty, '')
+
+    def test_aggregators(self):
+        def aggregate(name, values):
+            aggregator = qstimeseries.AGGREGATION_FUNCTIONS[name]()
+            for value in values:
+                aggregator.add(value)
+            return aggregator
+
+        self.assertEquals(aggregate('median', [4, 1, 3, 2]).result(), 2.5)
+        self.assertAlmostEquals(aggregate('p90', range(1, 11)).result(), 9.1)
+        self.assertEquals(aggregate('p99', [5]).result(), 5)
+        self.assertEquals(aggregate('median', []).result(), None)
+        self.assertAlmostEquals(aggregate('stddev', [2, 4, 4, 4, 5, 5, 7, 9]).result(), 2.0)
+
+        # Quantiles are estimated in bounded memory, and aggregators can be combined
+        random = __import__('random').Random(0)
+        values = [random.expovariate(1.0) for _ in range(20000)]
+        ordered = sorted(values)
+        for name, quantile in (('median', 0.5), ('p90', 0.9), ('p99', 0.99)):
+            first, second = aggregate(name, values[:15000]), aggregate(name, values[15000:])
+            first.merge(second)
+            self.assertTrue(len(first.centroids) < 200, len(first.centroids))
+            rank = bisect.bisect(ordered, first.result()) / float(len(values))
+            self.assertTrue(abs(rank - quantile) < 0.005, (name, rank))
+
+        for name in ('count', 'sum', 'min', 'max', 'rng', 'mean', 'stddev'):
+            first, second = aggregate(name, values[:15000]), aggregate(name, values[15000:])
+            first.merge(second)
+            self.assertAlmostEquals(first.result(), aggregate(name, values).result())
+
+        for time_value, value in ((0, '1'), (10, '3'), (20, '2'), (3600, '10')):
+            self.run_cli('append', 'metric', value, '--time', str(time_value))
+        self.assertEquals(
+            self.run_cli('aggregate', '1h', '-f', 'median', '-f', 'count', '-f', 'stddev').splitlines(),
+            ['1970-01-01 00:00:00 metric 2.0 3 0.816496580928 ', '1970-01-01 01:00:00 metric 10.0 1 0.0 '])
+
+    def test_retention(self):
+        db = qstimeseries.ensure_database(self.direc)
+        # Ten days of values before the last hour that 90 days of values are kept from
+        start = (int(time.time()) - 90 * 86400) // 3600 * 3600 - 10 * 86400
+        qstimeseries.append_many(db, [
+            dict(series='metric', value=index % 7, time=start + index * 1200)
+            for index in range(100 * 72)], float, False)
+        qstimeseries.append_many(db, [dict(series='other', value=1, time=start)], float, False)
+        before = dict(
+            (period, self.run_cli('aggregate', period, '--series', 'metric', '-f', 'mean', '-f', 'count', '-f', 'max'))
+            for period in ('1h', '1d'))
+
+        self.run_cli('retention', 'set', 'metric', '--raw', '90d', '--period', '1h')
+        self.assertEquals(self.run_cli('retention', 'list'), 'metric raw 90d period 1h\n')
+        self.assertEquals(self.run_cli('compact', '--batch-size', '100'), '{}\n'.format(10 * 72))
+        self.assertEquals(self.run_cli('compact'), '0\n')
+        self.assertTrue('compacted until' in self.run_cli('retention', 'list'))
+
+        # Compacted values are read as their mean over each hour
+        self.assertEquals(db.execute('SELECT count(*) FROM timeseries').fetchone(), (90 * 72 + 1,))
+        values = json.loads(self.run_cli('show', '--series', 'metric', '--json'))
+        self.assertEquals(len(values), 10 * 24 + 90 * 72)
+        self.assertEquals(values[0], dict(time=start, series='metric', id=None, value=1.0))
+        self.assertEquals(values[-1]['id'], 'internal--7200')
+        for period, output in before.items():
+            self.assertEquals(self.run_cli('aggregate', period, '--series', 'metric', '-f', 'mean', '-f', 'count', '-f', 'max'), output)
+        self.assertEquals(len(self.run_cli('aggregate', '1d', '--series', 'metric', '-f', 'median').splitlines()), len(before['1d'].splitlines()))
+        self.assertEquals(len(array.array('d', self.run_cli('export', '--series', 'metric', '--format', 'raw'))), 2 * len(values))
+        self.assertEquals(self.run_cli('series'), 'metric\nother\n')
+
+        # The hourly rollup is all that is left of the compacted values
+        with self.assertRaises(ValueError):
+            self.run_cli('rollup', 'disable', 'metric')
+        with self.assertRaises(ValueError):
+            self.run_cli('retention', 'set', 'metric', '--raw', '90d', '--period', '1d')
+        self.run_cli('rollup', 'enable', 'metric', '--periods', '1h')
+        self.assertEquals(self.run_cli('aggregate', '1d', '--series', 'metric', '-f', 'mean', '-f', 'count', '-f', 'max'), before['1d'])
+
+        # Space is returned to the file system
+        self.assertEquals(db.execute('PRAGMA freelist_count').fetchone(), (0,))
+        self.run_cli('retention', 'remove', 'metric')
+        self.assertEquals(self.run_cli('retention', 'list').split()[:3], ['metric', 'raw', 'forever'])
+        self.assertEquals(self.run_cli('compact', '--vacuum'), '0\n')
+
 if __name__ == '__main__':
     unittest.main()
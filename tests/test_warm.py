@@ -0,0 +1,69 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from qscli import warm
+
+class TestWarm(unittest.TestCase):
+    def setUp(self):
+        self.direc = tempfile.mkdtemp()
+        self.env = dict(os.environ, XDG_RUNTIME_DIR=self.direc)
+        self.server = subprocess.Popen(
+            [sys.executable, '-m', 'qscli.warm', '--serve', 'qstimeseries', '--idle-timeout', '10'],
+            env=self.env)
+
+        socket_path = os.path.join(self.direc, 'qscli', 'warm-qstimeseries.sock')
+        deadline = time.time() + 10
+        while not os.path.exists(socket_path) and time.time() < deadline:
+            time.sleep(0.05)
+
+    def tearDown(self):
+        self.server.terminate()
+        self.server.wait()
+        shutil.rmtree(self.direc)
+
+    def run_cli(self, *args):
+        process = subprocess.Popen(
+            [sys.executable, '-S', '-m', 'qscli.warm', 'qstimeseries', '--config-dir', os.path.join(self.direc, 'data')] + list(args),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=self.env)
+        stdout, stderr = process.communicate()
+        return process.returncode, stdout, stderr
+
+    def test_basic(self):
+        self.assertEquals(self.run_cli('append', 'metric', '1'), (0, '', ''))
+        returncode, stdout, _ = self.run_cli('show', '--series', 'metric', '--json')
+        self.assertEquals(returncode, 0)
+        value, = json.loads(stdout)
+        self.assertEquals(value['value'], 1)
+
+    def test_error(self):
+        returncode, stdout, stderr = self.run_cli('no-such-command')
+        self.assertEquals(returncode, 2)
+        self.assertEquals(stdout, '')
+        self.assertTrue('invalid choice' in stderr, stderr)
+
+    def test_insecure_directory(self):
+        os.chmod(os.path.join(self.direc, 'qscli'), 0755)
+        self.assertEquals(self.run_cli('append', 'metric', '1')[:2], (0, ''))
+        returncode, stdout, stderr = self.run_cli('show', '--series', 'metric', '--json')
+        self.assertEquals(returncode, 0)
+        self.assertEquals(len(json.loads(stdout)), 1)
+        self.assertTrue('Not using a server' in stderr, stderr)
+
+class TestDaemonCommand(unittest.TestCase):
+    def test_is_daemon_command(self):
+        self.assertTrue(warm.is_daemon_command(['daemon']))
+        self.assertTrue(warm.is_daemon_command(['--config-dir', 'data', 'daemon', '--socket', 'path']))
+        self.assertTrue(warm.is_daemon_command(['--debug', 'daemon']))
+        self.assertFalse(warm.is_daemon_command(['incr', 'daemon']))
+        self.assertFalse(warm.is_daemon_command(['--config-dir', 'data', 'append', 'daemon', '1']))
+        self.assertFalse(warm.is_daemon_command(['--config-dir=data', 'incr', 'daemon']))
+        self.assertFalse(warm.is_daemon_command([]))
+
+if __name__ == '__main__':
+    unittest.main()